@@ -0,0 +1,211 @@
+"""
+End-to-end benchmark of the downloader against the local mock ThingsBoard
+server (benchmarks/mock_server.py).
+
+Starts the mock server, runs main.py against it with a fresh config, data
+and log folder, and reports the number of requests, rows/s, the peak RSS of
+the downloader and the time spent in the fetch, convert, pivot and write
+stages. The result is saved to benchmarks/results/ under the current commit,
+so that regressions can be compared between commits with --compare.
+
+Usage:
+    python benchmarks/download_benchmark.py [--devices 2] [--keys 10]
+        [--days 30] [--interval-s 60] [--latency-ms 5] [--error-rate 0]
+        [--limit 1000] [--keys-per-request 20] [--max-workers 8]
+        [--streaming] [--windows] [--compare results/<file>.json]
+"""
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+from typing import Any, Dict
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BENCHMARK_DIR)
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+
+sys.path.append(PROJECT_DIR)
+
+from benchmarks.mock_server import add_mock_arguments, get_mock_settings, start_mock_server
+from utils.metrics import get_counter_total
+
+
+def get_commit() -> str:
+    """Return the short hash of the checked out commit, marked if the tree is dirty."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                cwd=PROJECT_DIR,
+                                capture_output=True,
+                                text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--", "*.py"],
+                               cwd=PROJECT_DIR,
+                               capture_output=True,
+                               text=True,
+                               check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if dirty else commit
+
+
+def write_config(config_dir: str, host: str,
+                 args: argparse.Namespace) -> None:
+    """Write config.json and keys.json for a benchmark run, based on the template."""
+    with open(os.path.join(PROJECT_DIR, "config",
+                           "config.template.json")) as f:
+        config = json.load(f)
+
+    config["thingsboard"]["host"] = host
+    config["download"].update({
+        "aggregation": None,
+        "interval": None,
+        "limit": args.limit,
+        "keys_per_request": args.keys_per_request,
+        "max_workers": args.max_workers,
+        "max_workers_per_device": args.max_workers,
+        "streaming": args.streaming,
+    })
+    config["download"]["windows"]["enabled"] = args.windows
+    config["devices"] = {
+        f"device_{i}": f"device-id-{i}"
+        for i in range(args.devices)
+    }
+
+    with open(os.path.join(config_dir, "config.json"), 'w') as f:
+        json.dump(config, f, indent=4)
+    with open(os.path.join(config_dir, "keys.json"), 'w') as f:
+        json.dump({f"key_{i}": True for i in range(args.keys)}, f, indent=4)
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    server = start_mock_server(0, get_mock_settings(args))
+    host = f"http://127.0.0.1:{server.server_address[1]}"
+
+    with tempfile.TemporaryDirectory() as run_dir:
+        env = dict(os.environ)
+        for name in ("config", "data", "logs"):
+            os.makedirs(os.path.join(run_dir, name))
+        env["TB_CONFIG_DIR"] = os.path.join(run_dir, "config")
+        env["TB_DATA_DIR"] = os.path.join(run_dir, "data")
+        env["TB_LOG_DIR"] = os.path.join(run_dir, "logs")
+        write_config(env["TB_CONFIG_DIR"], host, args)
+        metrics_file = os.path.join(run_dir, "metrics.json")
+
+        start = time.perf_counter()
+        subprocess.run([
+            sys.executable,
+            os.path.join(PROJECT_DIR, "main.py"), "--metrics-file",
+            metrics_file
+        ],
+                       env=env,
+                       check=True,
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        wall_s = time.perf_counter() - start
+
+        with open(metrics_file) as f:
+            report = json.load(f)
+
+    server.shutdown()
+    server.server_close()
+
+    rows = get_counter_total(report, "rows_downloaded")
+    return {
+        "commit": get_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "scenario": vars(args),
+        "wall_s": round(wall_s, 3),
+        "requests": server.get_stats(),
+        "rows": rows,
+        "bytes": get_counter_total(report, "bytes_received"),
+        "bytes_transferred": get_counter_total(report, "bytes_transferred"),
+        "retries": get_counter_total(report, "retries"),
+        "rows_per_s": round(rows / wall_s),
+        # ru_maxrss is in KB on Linux; main.py is the only child process
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        "stages_s": {
+            stage: round(seconds, 3)
+            for stage, seconds in report["stages_s"].items()
+        },
+    }
+
+
+def print_result(result: Dict[str, Any],
+                 baseline: Dict[str, Any] | None = None) -> None:
+    """Print a result, with the change relative to a baseline result."""
+    baseline_commit = baseline["commit"] if baseline else ""
+
+    def line(name: str, value: float, base: float | None) -> str:
+        text = f"{name:<20}{value:>12}"
+        if base:
+            text += f"  ({(value - base) / base:+.1%} vs {baseline_commit})"
+        return text
+
+    def get(res: Dict[str, Any] | None, *path: str) -> Any:
+        for p in path:
+            if res is None:
+                return None
+            res = res.get(p)
+        return res
+
+    print(f"Commit:             {result['commit']}")
+    print(line("Wall time (s)", result["wall_s"], get(baseline, "wall_s")))
+    for endpoint, count in sorted(result["requests"].items()):
+        print(
+            line(f"Requests ({endpoint})", count,
+                 get(baseline, "requests", endpoint)))
+    print(line("Rows", result["rows"], get(baseline, "rows")))
+    print(line("Rows/s", result["rows_per_s"], get(baseline, "rows_per_s")))
+    print(line("Bytes", result["bytes"], get(baseline, "bytes")))
+    print(
+        line("Bytes transferred", result["bytes_transferred"],
+             get(baseline, "bytes_transferred")))
+    print(line("Retries", result["retries"], get(baseline, "retries")))
+    print(
+        line("Peak RSS (MB)", result["peak_rss_mb"],
+             get(baseline, "peak_rss_mb")))
+    for stage in ("fetch", "convert", "pivot", "write"):
+        print(
+            line(f"Stage {stage} (s)", result["stages_s"].get(stage, 0.0),
+                 get(baseline, "stages_s", stage)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--devices", type=int, default=2)
+    add_mock_arguments(parser)
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--keys-per-request", type=int, default=20)
+    parser.add_argument("--max-workers", type=int, default=8)
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--windows", action="store_true")
+    parser.add_argument("--compare",
+                        help="Result file to compare against.")
+    args = parser.parse_args()
+    compare = args.compare
+    del args.compare
+
+    result = run_benchmark(args)
+
+    baseline = None
+    if compare:
+        with open(compare) as f:
+            baseline = json.load(f)
+        if baseline["scenario"] != result["scenario"]:
+            print("Warning: the baseline was run with a different scenario.")
+
+    print_result(result, baseline)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    result_file = os.path.join(
+        RESULTS_DIR,
+        f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{result['commit']}.json")
+    with open(result_file, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=4)
+    print(f"Saved result to {result_file}")
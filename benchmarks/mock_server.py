@@ -0,0 +1,212 @@
+"""
+Local stand-in for the ThingsBoard REST API, used by the benchmarks.
+
+Serves the endpoints the downloader uses:
+
+- POST /api/auth/login
+- GET  /api/plugins/telemetry/DEVICE/<id>/keys/timeseries
+- GET  /api/plugins/telemetry/DEVICE/<id>/values/timeseries
+  (raw data and agg=COUNT, with startTs, endTs, limit and orderBy)
+
+Every device has the keys key_0 ... key_<keys - 1> (and answers requests for
+any other key name the same way) with one synthetic measurement every
+interval_ms between start_ts and end_ts. The values are deterministic, so
+repeated runs download the same data. Every response is delayed by
+latency_s, and a share of error_rate of the telemetry requests fails with
+503 and a Retry-After header. Responses are gzipped for clients that accept
+it.
+
+Usage:
+    python benchmarks/mock_server.py [--port 8765] [--keys 10] [--days 30]
+"""
+import sys
+import gzip
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, NamedTuple, Optional
+from urllib.parse import parse_qs, urlparse
+
+TOKEN = "benchmark-token"
+
+
+class MockSettings(NamedTuple):
+    keys: int
+    start_ts: int
+    end_ts: int
+    interval_ms: int
+    latency_s: float
+    error_rate: float
+
+
+def get_value(key: str, ts: int) -> str:
+    """Deterministic synthetic value of a key at a timestamp."""
+    phase = sum(key.encode()) % 17
+    return f"{400 + 50 * math.sin(ts / 3.6e6 + phase):.6f}"
+
+
+class MockThingsBoard(ThreadingHTTPServer):
+    """Threaded HTTP server that counts the requests per endpoint."""
+
+    daemon_threads = True
+
+    def __init__(self, port: int, settings: MockSettings) -> None:
+        super().__init__(("127.0.0.1", port), MockHandler)
+        self.settings = settings
+        self.stats_lock = threading.Lock()
+        self.stats: Dict[str, int] = {}
+
+    def count(self, endpoint: str) -> None:
+        with self.stats_lock:
+            self.stats[endpoint] = self.stats.get(endpoint, 0) + 1
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.stats_lock:
+            return dict(self.stats)
+
+    def first_ts(self, startTs: int) -> int:
+        """Return the first measurement timestamp at or after startTs."""
+        start, step = self.settings.start_ts, self.settings.interval_ms
+        return start + max(0, math.ceil((startTs - start) / step)) * step
+
+    def get_timeseries(self, params: Dict[str, str]) -> Dict[str, Any]:
+        keys = params["keys"].split(",")
+        startTs = max(int(params.get("startTs", 0)), self.settings.start_ts)
+        # Half-open range [startTs, endTs)
+        endTs = min(int(params.get("endTs", self.settings.end_ts)),
+                    self.settings.end_ts + 1)
+        limit = int(params.get("limit", 100))
+        step = self.settings.interval_ms
+
+        if params.get("agg") == "COUNT":
+            interval = int(params["interval"])
+            result: Dict[str, Any] = {}
+            for key in keys:
+                points = []
+                for bucket_start in range(int(params["startTs"]), endTs,
+                                          interval):
+                    bucket_end = min(endTs, bucket_start + interval)
+                    lo = self.first_ts(max(bucket_start, startTs))
+                    count = max(0, math.ceil((bucket_end - lo) / step))
+                    if count:
+                        points.append({"ts": bucket_start, "value": count})
+                result[key] = points[:limit]
+            return result
+
+        first = self.first_ts(startTs)
+        last = self.first_ts(endTs) - step
+        if params.get("orderBy") == "DESC":
+            timestamps = range(last, max(first, last - (limit - 1) * step) - 1,
+                               -step)
+        else:
+            timestamps = range(first, min(last, first + (limit - 1) * step) +
+                               1, step)
+        return {
+            key: [{
+                "ts": ts,
+                "value": get_value(key, ts)
+            } for ts in timestamps]
+            for key in keys if len(timestamps) > 0
+        }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    server: MockThingsBoard
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def send_json(self,
+                  data: Any,
+                  status: int = 200,
+                  headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel=1)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path != "/api/auth/login":
+            self.send_json({"message": "Not found"}, 404)
+            return
+        self.server.count("login")
+        self.send_json({"token": TOKEN, "refreshToken": TOKEN})
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        settings = self.server.settings
+        time.sleep(settings.latency_s)
+
+        if self.headers.get("X-Authorization") != f"Bearer {TOKEN}":
+            self.send_json({"message": "Unauthorized"}, 401)
+        elif url.path.endswith("/keys/timeseries"):
+            self.server.count("keys")
+            self.send_json([f"key_{i}" for i in range(settings.keys)])
+        elif url.path.endswith("/values/timeseries"):
+            self.server.count("timeseries")
+            if random.random() < settings.error_rate:
+                self.server.count("errors")
+                self.send_json({"message": "Service unavailable"}, 503,
+                               {"Retry-After": "0"})
+                return
+            self.send_json(self.server.get_timeseries(params))
+        else:
+            self.send_json({"message": "Not found"}, 404)
+
+
+def start_mock_server(port: int, settings: MockSettings) -> MockThingsBoard:
+    """Start the mock server on a background thread (port 0 picks a free port)."""
+    server = MockThingsBoard(port, settings)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--keys", type=int, default=10)
+    parser.add_argument("--days", type=float, default=30)
+    parser.add_argument("--interval-s",
+                        type=float,
+                        default=60,
+                        help="Seconds between two measurements of a key.")
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+
+
+def get_mock_settings(args: argparse.Namespace) -> MockSettings:
+    start_ts = int(
+        datetime(2024, 12, 1, tzinfo=timezone.utc).timestamp() * 1000)
+    return MockSettings(keys=args.keys,
+                        start_ts=start_ts,
+                        end_ts=start_ts + int(args.days * 86400000) - 1,
+                        interval_ms=int(args.interval_s * 1000),
+                        latency_s=args.latency_ms / 1000,
+                        error_rate=args.error_rate)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--port", type=int, default=8765)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockThingsBoard(args.port, get_mock_settings(args))
+    print(f"Serving mock ThingsBoard on http://127.0.0.1:{args.port}",
+          file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.get_stats()), file=sys.stderr)
@@ -0,0 +1,196 @@
+"""
+Benchmark of the Parquet storage options on the local data of a device.
+
+Writes the stored data of a device once per storage option (dtypes,
+system_name encoding, compression, row group sizing and a long/narrow
+layout for sparse keys) to a temporary folder, and reports the file size
+and the time of a full scan and of a range scan (one key, a tenth of the
+time range) compared with the default options. It also suggests key_dtypes
+for the storage config that store every key without loss.
+
+Usage:
+    python benchmarks/storage_benchmark.py --device <name> [--year 2025]
+        [--repeat 5] [--sparse-threshold 0.5]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import polars as pl
+from typing import Callable, Dict, List, Optional, Tuple
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.data_files import load_local_data
+from utils.storage import (KEY_DTYPES, StorageSettings, get_storage_settings,
+                           write_parquet_file)
+from utils.watermarks import NON_KEY_COLUMNS
+from utils.paths import DATA_DIR
+
+DEFAULT_SETTINGS = StorageSettings(compression="zstd",
+                                   compression_level=None,
+                                   row_group_ms=None,
+                                   categorical_system_name=False,
+                                   key_dtypes={})
+
+
+def load_device_data(device_name: str, years: Optional[List[str]]) -> pl.DataFrame:
+    """Load the stored data of a device (of the given years) with Float64 keys."""
+    frames = []
+    for year in sorted(os.listdir(DATA_DIR)):
+        if not year.isdigit() or (years and year not in years):
+            continue
+        df = load_local_data(os.path.join(DATA_DIR, year), device_name)
+        if df is not None:
+            frames.append(df)
+    if not frames:
+        raise SystemExit(f"No local data of device {device_name}.")
+    df = pl.concat(frames, how="diagonal_relaxed")
+    return df.with_columns(
+        pl.col(c).cast(pl.Float64) for c, dtype in df.schema.items()
+        if c not in NON_KEY_COLUMNS and dtype.is_numeric())
+
+
+def suggest_key_dtypes(df: pl.DataFrame) -> Dict[str, str]:
+    """Suggest the smallest dtype that holds every value of a key without loss."""
+    suggestions = {}
+    for key, dtype in df.schema.items():
+        if key in NON_KEY_COLUMNS or not dtype.is_numeric():
+            continue
+        values = df[key].drop_nulls()
+        if values.len() == 0:
+            continue
+        if values.is_in([0.0, 1.0]).all():
+            suggestions[key] = "Boolean"
+        elif (values == values.round(0)).all():
+            low, high = values.min(), values.max()
+            for name, bits in (("Int8", 8), ("Int16", 16), ("Int32", 32),
+                               ("Int64", 64)):
+                if -2**(bits - 1) <= low and high < 2**(bits - 1):  # type: ignore[operator]
+                    suggestions[key] = name
+                    break
+        elif (values.cast(pl.Float32).cast(pl.Float64).round(4) == values).all():
+            suggestions[key] = "Float32"
+    return suggestions
+
+
+def get_sparse_keys(df: pl.DataFrame, threshold: float) -> List[str]:
+    """Return the keys with a larger share of nulls than threshold."""
+    keys = [c for c in df.columns if c not in NON_KEY_COLUMNS]
+    null_shares = df.select(pl.col(keys).null_count() / df.height).row(
+        0, named=True)
+    return [key for key in keys if null_shares[key] > threshold]
+
+
+def write_long_layout(df: pl.DataFrame, sparse_keys: List[str],
+                      folder: str) -> List[str]:
+    """Write the dense keys in wide and the sparse keys in long format."""
+    wide_file = os.path.join(folder, "wide.parquet")
+    long_file = os.path.join(folder, "long.parquet")
+    write_parquet_file(df.drop(sparse_keys), wide_file, DEFAULT_SETTINGS)
+    df.select("ts", *sparse_keys) \
+        .unpivot(index="ts", variable_name="key", value_name="value") \
+        .drop_nulls("value") \
+        .with_columns(pl.col("key").cast(pl.Categorical)) \
+        .sort("ts") \
+        .write_parquet(long_file)
+    return [wide_file, long_file]
+
+
+def time_scans(files: List[str], key: str, range_ts: Tuple[int, int],
+               repeat: int) -> Tuple[float, float]:
+    """Return the best time of a full scan and of a range scan of one key."""
+
+    def range_scan() -> None:
+        for file in files:
+            lf = pl.scan_parquet(file).filter(
+                pl.col("ts").is_between(*range_ts, closed="left"))
+            schema = lf.collect_schema()
+            if key in schema:
+                lf.select("ts", key).collect()
+            elif "key" in schema:
+                lf.filter(pl.col("key") == key).collect()
+
+    def full_scan() -> None:
+        for file in files:
+            pl.read_parquet(file)
+
+    def best(function: Callable[[], None]) -> float:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    return best(full_scan), best(range_scan)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--device", required=True)
+    parser.add_argument("--year", action="append")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--sparse-threshold", type=float, default=0.5)
+    args = parser.parse_args()
+
+    df = load_device_data(args.device, args.year)
+    keys = [c for c in df.columns if c not in NON_KEY_COLUMNS]
+    suggested = suggest_key_dtypes(df)
+    sparse_keys = get_sparse_keys(df, args.sparse_threshold)
+    min_ts, max_ts = df.select(
+        pl.col("ts").min().alias("min_ts"),
+        pl.col("ts").max().alias("max_ts")).row(0)
+    range_start = min_ts + (max_ts - min_ts) // 2
+    range_ts = (range_start, range_start + (max_ts - min_ts) // 10 + 1)
+    # The range scan reads the sparsest key, which the long layout moves
+    scan_key = sparse_keys[0] if sparse_keys else keys[0]
+
+    variants: Dict[str, StorageSettings] = {
+        "default (Float64, zstd)": DEFAULT_SETTINGS,
+        "configured": get_storage_settings(),
+        "suggested key_dtypes": DEFAULT_SETTINGS._replace(key_dtypes={
+            key: KEY_DTYPES[dtype]
+            for key, dtype in suggested.items()
+        }),
+        "all keys Float32": DEFAULT_SETTINGS._replace(
+            key_dtypes={key: pl.Float32() for key in keys}),
+        "system_name categorical": DEFAULT_SETTINGS._replace(
+            categorical_system_name=True),
+        "zstd level 9": DEFAULT_SETTINGS._replace(compression_level=9),
+        "zstd level 19": DEFAULT_SETTINGS._replace(compression_level=19),
+        "lz4": DEFAULT_SETTINGS._replace(compression="lz4"),
+        "snappy": DEFAULT_SETTINGS._replace(compression="snappy"),
+        "row groups of 1 h": DEFAULT_SETTINGS._replace(row_group_ms=3600000),
+        "row groups of 1 d": DEFAULT_SETTINGS._replace(row_group_ms=86400000),
+    }
+
+    print(f"Device:      {args.device} ({df.height} rows, {len(keys)} keys)")
+    print(f"Sparse keys: {sparse_keys}")
+    print(f"Suggested key_dtypes: {suggested}")
+    print()
+    print(f"{'Option':<32}{'Size (KB)':>12}{'vs default':>12}"
+          f"{'Full scan (ms)':>16}{'Range scan (ms)':>17}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results: Dict[str, List[str]] = {}
+        for i, (name, settings) in enumerate(variants.items()):
+            file = os.path.join(tmp_dir, f"{i}.parquet")
+            write_parquet_file(df, file, settings)
+            results[name] = [file]
+        if sparse_keys:
+            long_dir = os.path.join(tmp_dir, "long")
+            os.makedirs(long_dir)
+            results["long layout for sparse keys"] = write_long_layout(
+                df, sparse_keys, long_dir)
+
+        default_size = None
+        for name, files in results.items():
+            size = sum(os.path.getsize(file) for file in files)
+            default_size = default_size or size
+            full_s, range_s = time_scans(files, scan_key, range_ts,
+                                         args.repeat)
+            print(f"{name:<32}{size / 1024:>12.1f}"
+                  f"{(size / default_size - 1) * 100:>+11.1f}%"
+                  f"{full_s * 1000:>16.2f}{range_s * 1000:>17.2f}")
@@ -0,0 +1,138 @@
+"""
+Micro-benchmark of the telemetry conversion.
+
+Compares the previous row-wise conversion (one dict and one
+safe_convert_to_float call per measurement) with the columnar
+telemetry_to_dataframe on a synthetic payload and checks that both return
+the same DataFrame (up to the rounding of exact ties in the 4th decimal).
+
+It also compares decoding the raw JSON body with json.loads followed by
+telemetry_to_dataframe against read_telemetry_json, which decodes the body
+one key at a time into columns, by time and by the peak of Python
+allocations (tracemalloc does not see the buffers of Polars).
+
+Usage:
+    python benchmarks/telemetry_conversion.py [--points 1000000] [--keys 40]
+"""
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import tracemalloc
+import polars as pl
+from typing import Any, Callable, Dict, List
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.data_files import (convert_telemetry_values, read_telemetry_json,
+                              safe_convert_to_float, telemetry_to_dataframe)
+
+
+def telemetry_to_dataframe_rowwise(
+        data: Dict[str, List[Dict[str, Any]]]) -> pl.DataFrame:
+    """Reference implementation: the previous per-row conversion loop."""
+    rows = []
+    for key, measurements in data.items():
+        for m in measurements:
+            value = safe_convert_to_float(m["value"])
+            rows.append({"ts": m["ts"], "key": key, "value": value})
+
+    return pl.DataFrame(rows,
+                        schema={
+                            "ts": pl.Int64,
+                            "key": pl.Utf8,
+                            "value": pl.Float64
+                        })
+
+
+def generate_payload(points: int,
+                     keys: int) -> Dict[str, List[Dict[str, Any]]]:
+    """Generate a ThingsBoard-like payload with a mix of numeric, boolean and invalid values."""
+    random.seed(0)
+    points_per_key = points // keys
+    start_ts = 1735689600000
+    data: Dict[str, List[Dict[str, Any]]] = {}
+    for k in range(keys):
+        measurements = []
+        for i in range(points_per_key):
+            r = random.random()
+            if r < 0.9:
+                value = f"{random.uniform(-1000, 1000):.6f}"
+            elif r < 0.97:
+                value = random.choice(["true", "false", "True", "FALSE"])
+            else:
+                value = "n/a"
+            measurements.append({"ts": start_ts + i * 1000, "value": value})
+        data[f"key_{k}"] = measurements
+    return data
+
+
+def time_function(function: Callable[[Any], pl.DataFrame], data: Any,
+                  repeat: int) -> float:
+    """Return the best wall-clock time of repeat calls."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(data)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def peak_python_mb(function: Callable[[Any], pl.DataFrame], data: Any) -> float:
+    """Return the peak of the Python allocations of one call in MB."""
+    tracemalloc.start()
+    function(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024**2
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--points", type=int, default=1_000_000)
+    parser.add_argument("--keys", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    payload = generate_payload(args.points, args.keys)
+
+    df_rowwise = telemetry_to_dataframe_rowwise(payload)
+    df_columnar = telemetry_to_dataframe(payload)
+    assert df_rowwise.schema == df_columnar.schema
+    assert df_rowwise.drop("value").equals(df_columnar.drop("value"))
+    assert df_rowwise["value"].is_null().equals(
+        df_columnar["value"].is_null())
+    # Values exactly halfway between two 4-decimal numbers may be rounded in
+    # different directions by Python's round and Polars, hence the tolerance.
+    difference = (df_rowwise["value"] - df_columnar["value"]).abs()
+    assert (difference.fill_nan(0.0) < 1.5e-4).all(), "Conversions differ"
+
+    rowwise = time_function(telemetry_to_dataframe_rowwise, payload,
+                            args.repeat)
+    columnar = time_function(telemetry_to_dataframe, payload, args.repeat)
+
+    print(f"Points:   {args.points // args.keys * args.keys}")
+    print(f"Row-wise: {rowwise:.3f} s")
+    print(f"Columnar: {columnar:.3f} s")
+    print(f"Speedup:  {rowwise / columnar:.1f}x")
+
+    body = json.dumps(payload).encode()
+
+    def decode_dict(body: bytes) -> pl.DataFrame:
+        return telemetry_to_dataframe(json.loads(body))
+
+    def decode_columnar(body: bytes) -> pl.DataFrame:
+        return convert_telemetry_values(read_telemetry_json(body))
+
+    assert decode_dict(body).equals(decode_columnar(body)), "Decodings differ"
+    dict_s = time_function(decode_dict, body, args.repeat)
+    columnar_s = time_function(decode_columnar, body, args.repeat)
+
+    print()
+    print(f"JSON body: {len(body) / 1024**2:.1f} MB")
+    print(f"json.loads + dict:   {dict_s:.3f} s, "
+          f"Python peak {peak_python_mb(decode_dict, body):.1f} MB")
+    print(f"read_telemetry_json: {columnar_s:.3f} s, "
+          f"Python peak {peak_python_mb(decode_columnar, body):.1f} MB")
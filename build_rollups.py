@@ -0,0 +1,66 @@
+import os
+import argparse
+from datetime import datetime
+import logging
+from typing import Dict, List
+
+from utils.data_files import (Segment, get_device_lock, get_segments,
+                              migrate_legacy_file)
+from utils.rollups import get_rollup_tiers, update_rollups
+from utils.paths import LOG_DIR, DATA_DIR
+
+# Create a log filename with the current date (YYYY-MM-DD)
+log_filename = os.path.join(LOG_DIR,
+                            f"{datetime.now().strftime('%Y-%m-%d')}.log")
+
+logging.basicConfig(
+    level=logging.INFO,
+    format=
+    "%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s",
+    handlers=[logging.FileHandler(log_filename),
+              logging.StreamHandler()])
+
+parser = argparse.ArgumentParser(
+    description=
+    "Build the rollup tiers from the local raw data, e.g. after enabling rollups."
+)
+parser.add_argument("--device",
+                    action="append",
+                    help="Only process this device (can be repeated).")
+parser.add_argument("--year",
+                    action="append",
+                    help="Only process this year (can be repeated).")
+args = parser.parse_args()
+
+tiers = get_rollup_tiers()
+if not tiers:
+    parser.error("Rollups are disabled, enable them in config.json first.")
+logging.info(f"Building rollup tiers {[tier for tier, _ in tiers]}.")
+
+for year in sorted(os.listdir(DATA_DIR)):
+    year_path = os.path.join(DATA_DIR, year)
+    if not (year.isdigit() and os.path.isdir(year_path)):
+        continue
+    if args.year and year not in args.year:
+        continue
+
+    devices = sorted({
+        entry.removesuffix(".parquet")
+        for entry in os.listdir(year_path)
+    })
+    for device_name in devices:
+        if args.device and device_name not in args.device:
+            continue
+
+        logging.info(f"Building rollups of {device_name} in {year}.")
+        with get_device_lock(year_path, device_name):
+            migrate_legacy_file(year_path, device_name)
+            # One month partition at a time, to bound the memory use
+            partitions: Dict[str, List[Segment]] = {}
+            for segment in get_segments(year_path, device_name):
+                partitions.setdefault(os.path.dirname(segment.path),
+                                      []).append(segment)
+            for segments in partitions.values():
+                update_rollups(device_name, int(year),
+                               min(segment.min_ts for segment in segments),
+                               max(segment.max_ts for segment in segments))
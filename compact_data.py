@@ -0,0 +1,62 @@
+import os
+import argparse
+from datetime import datetime
+import logging
+
+from utils.data_files import (compact_local_data, get_device_lock,
+                              migrate_legacy_file)
+from utils.paths import LOG_DIR, DATA_DIR
+
+# Create a log filename with the current date (YYYY-MM-DD)
+log_filename = os.path.join(LOG_DIR,
+                            f"{datetime.now().strftime('%Y-%m-%d')}.log")
+
+logging.basicConfig(
+    level=logging.INFO,
+    format=
+    "%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s",
+    handlers=[logging.FileHandler(log_filename),
+              logging.StreamHandler()])
+
+parser = argparse.ArgumentParser(
+    description=
+    "Migrate yearly Parquet files to month partitions and merge small segments."
+)
+parser.add_argument("--device",
+                    action="append",
+                    help="Only process this device (can be repeated).")
+parser.add_argument("--year",
+                    action="append",
+                    help="Only process this year (can be repeated).")
+parser.add_argument(
+    "--max-segments",
+    type=int,
+    default=1,
+    help="Compact month partitions with more segments than this (default: 1).")
+parser.add_argument("--migrate-only",
+                    action="store_true",
+                    help="Only migrate yearly files, do not compact.")
+args = parser.parse_args()
+
+for year in sorted(os.listdir(DATA_DIR)):
+    year_path = os.path.join(DATA_DIR, year)
+    if not (year.isdigit() and os.path.isdir(year_path)):
+        continue
+    if args.year and year not in args.year:
+        continue
+
+    # Devices are stored either as a legacy yearly file or a folder
+    devices = sorted({
+        entry.removesuffix(".parquet")
+        for entry in os.listdir(year_path)
+    })
+    for device_name in devices:
+        if args.device and device_name not in args.device:
+            continue
+
+        logging.info(f"Processing {device_name} in {year}.")
+        # Wait for a running download that saves the same device
+        with get_device_lock(year_path, device_name):
+            migrate_legacy_file(year_path, device_name)
+            if not args.migrate_only:
+                compact_local_data(year_path, device_name, args.max_segments)
@@ -1,123 +1,208 @@
 import os
-import requests
-import polars as pl
+import socket
+import argparse
 from datetime import datetime
 import logging
+import signal
+import threading
 import time
 
-from utils.thingsboard_api import get_jwt_token, get_telemetry_data
+from utils.thingsboard_api import get_jwt_token, create_session
 from utils.config_files import load_json_config, get_keys_to_download
-from utils.data_files import telemetry_to_dataframe, save_local_data
-from utils.download_interval import download_interval
-from utils.os_functions import ensure_data_dir
-from utils.paths import LOG_DIR, DATA_DIR
-
-# Create a log file with the current date (YYYY-MM-DD)
-log_filename = os.path.join(LOG_DIR,
-                            f"{datetime.now().strftime('%Y-%m-%d')}.log")
-
-logging.basicConfig(
-    level=logging.INFO,
-    format=
-    "%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s",
-    handlers=[
-        logging.FileHandler(log_filename),
-        logging.StreamHandler(
-        )  # This allows logs to be printed to the console as well
-    ])
-
-logging.info("=========================================")
-logging.info("Starting data download from ThingsBoard")
-
-# config
-config = load_json_config("config.json")
-devices = config["devices"]
-keys = get_keys_to_download()
-
-# Record start time
-start_time = time.time()
-start_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-logging.info(f"Script started at: {start_datetime}")
-
-logging.info(f"Downloading data for keys: {keys}")
-
-# Create a persistent session.
-with requests.Session() as session:
-    # Retrieve the JWT token using the session.
-    jwt_token: str = get_jwt_token(session=session)
-
-    for device_name, device_id in devices.items():
-        try:
-            # Get start and end timestamp for downloading data
-            startTS, endTS = download_interval(jwt_token, device_name,
-                                               device_id, session)
-
-            logging.info(f"Downloading data for device: {device_name}.")
-
-            df_chunk = []
-
-            # Download data for each key
-            for key in keys:
-                current_timestamp = startTS
-
-                # Download until no new data is returned & endTS is reached
-                while (True):
-                    telemetry_data = get_telemetry_data(
-                        jwt_token=jwt_token,
-                        device_id=device_id,
-                        keys=key,
-                        startTS=current_timestamp,
-                        endTS=endTS,
-                        agg=config["download"]["aggregation"],
-                        interval=config["download"]["interval"],
-                        limit=config["download"]["limit"] or 1000,
-                        orderBy="ASC",
-                        session=session)
-
-                    if len(telemetry_data) == 0 or len(
-                            telemetry_data[key]) == 1:
-                        break
-
-                    df_key = telemetry_to_dataframe(telemetry_data)
-                    df_chunk.append(df_key)
-
-                    # Update the current timestamp to the last timestamp in the downloaded chunk
-                    current_timestamp = df_key.select(
-                        pl.col("ts").max()).to_series()[0] + 1
-
-            logging.info(f"Performing pivot for device: {device_name}")
-
-            if len(df_chunk) == 0:
-                logging.info(f"No data downloaded for device: {device_name}")
-                continue
-
-            df_long = pl.concat(df_chunk)
-
-            # Pivot the DataFrame: index by "ts", columns: "key", values: "value".
-            # This groups rows with the same timestamp into a single row.
-            df_wide=df_long.sort("ts") \
-                .pivot(index="ts", on="key", values="value") \
-                .with_columns(pl.from_epoch("ts", time_unit="ms").alias("datetime")) \
-                .with_columns(pl.lit(device_name).alias("system_name"))
-
-            # Save the data to a local Parquet file split by year
-            for year in df_wide["datetime"].dt.year().unique().to_list():
-                data_path = os.path.join(DATA_DIR, str(year))
-                ensure_data_dir(data_path)
-
-                save_local_data(
-                    path=data_path,
-                    file_name=device_name,
-                    df=df_wide.filter(pl.col("datetime").dt.year() == year))
-        except Exception as e:
-            logging.error(f"Error downloading data for device: {device_name}")
-            logging.error(e)
-
-# Record end time
-end_time = time.time()
-duration = end_time - start_time
-end_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-logging.info(f"Script ended at: {end_datetime}")
-logging.info(f"Total duration: {duration:.2f} seconds")
+from utils.daemon import run_daemon
+from utils.distributed import run_worker
+from utils.device_keys import get_device_keys_to_download
+from utils.download import (download_devices, get_concurrency_limits,
+                            plan_device_tasks)
+from utils.reconcile import plan_reconcile_tasks
+from utils.http_cache import page_cache
+from utils.metrics import get_report, write_prometheus_textfile, write_report
+from utils.tracing import (PROFILERS, get_tracing_settings, span,
+                           start_tracing, stop_tracing, write_trace)
+from utils.paths import LOG_DIR
+
+
+def main() -> None:
+    # Create a log file with the current date (YYYY-MM-DD)
+    log_filename = os.path.join(LOG_DIR,
+                                f"{datetime.now().strftime('%Y-%m-%d')}.log")
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format=
+        "%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s",
+        handlers=[
+            logging.FileHandler(log_filename),
+            logging.StreamHandler(
+            )  # This allows logs to be printed to the console as well
+        ])
+
+    parser = argparse.ArgumentParser(
+        description="Download telemetry data from ThingsBoard.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only estimate the number of requests and rows, do not download.")
+    mode.add_argument(
+        "--resume",
+        action="store_true",
+        help="Only resume the open tasks of an interrupted run.")
+    mode.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and poll every device on the configured interval.")
+    parser.add_argument(
+        "--reconcile",
+        action="store_true",
+        help="Compare the local data with ThingsBoard per time bucket and only "
+        "download the buckets with missing measurements again.")
+    parser.add_argument(
+        "--refresh-http-cache",
+        action="store_true",
+        help="Request all pages from ThingsBoard and replace the cached ones.")
+    parser.add_argument(
+        "--distributed",
+        metavar="RUN_ID",
+        help="Share the devices with the other workers of this run id through "
+        "lease files on shared storage.")
+    parser.add_argument(
+        "--worker-id",
+        default=f"{socket.gethostname()}-{os.getpid()}",
+        help="Name of this worker in a distributed run (default: host-pid).")
+    parser.add_argument(
+        "--metrics-file",
+        help=
+        "Write the run report to this JSON file instead of the configured one."
+    )
+    parser.add_argument(
+        "--trace",
+        nargs="?",
+        const="",
+        metavar="FILE",
+        help="Record the spans of the run in Chrome trace-event format (for "
+        "chrome://tracing or ui.perfetto.dev) to FILE or to the configured "
+        "trace file.")
+    parser.add_argument(
+        "--profile",
+        choices=PROFILERS,
+        help="Also profile the configured stages with cProfile or by "
+        "sampling their stacks (implies --trace).")
+    args = parser.parse_args()
+    if args.reconcile and (args.resume or args.daemon):
+        parser.error(
+            "--reconcile cannot be combined with --resume or --daemon.")
+    if args.distributed and (args.dry_run or args.resume or args.daemon):
+        parser.error("--distributed cannot be combined with --dry-run, "
+                     "--resume or --daemon.")
+
+    logging.info("=========================================")
+    logging.info("Starting data download from ThingsBoard")
+
+    # config
+    config = load_json_config("config.json")
+    devices = config["devices"]
+    keys = get_keys_to_download()
+    if args.reconcile and config["download"]["aggregation"] not in (None,
+                                                                    "NONE"):
+        parser.error("--reconcile requires raw downloads (aggregation null).")
+    # Reconciling compares with the current data on ThingsBoard, which may
+    # have changed since the pages were cached
+    if page_cache is not None and (args.refresh_http_cache or args.reconcile):
+        page_cache.skip_reads = True
+
+    # Record start time
+    start_time = time.time()
+    start_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    # Tracing is opt-in, from the config or the command line
+    tracing = get_tracing_settings()
+    trace_enabled = (tracing.enabled or args.trace is not None
+                     or args.profile is not None)
+    if trace_enabled:
+        start_tracing(profiler=args.profile or tracing.profiler,
+                      profile_stages=tracing.profile_stages,
+                      sample_interval_ms=tracing.sample_interval_ms,
+                      max_events=tracing.max_events)
+
+    logging.info(f"Script started at: {start_datetime}")
+
+    logging.info(f"Downloading data for keys: {keys}")
+
+    # Only request the keys every device publishes (see update_local_keys.py)
+    device_keys = get_device_keys_to_download(devices, keys)
+
+    # Create a persistent session with (by default) one connection per worker.
+    max_workers, _ = get_concurrency_limits()
+    pool_size = config["thingsboard"].get("pool_size") or max_workers
+    with create_session(pool_size=pool_size) as session, span("run"):
+        # Retrieve the JWT token using the session.
+        jwt_token: str = get_jwt_token(session=session)
+
+        if args.daemon:
+            # Poll until SIGINT or SIGTERM; the current poll is finished first.
+            stop = threading.Event()
+            for signal_number in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signal_number, lambda *_: stop.set())
+            run_daemon(jwt_token=jwt_token,
+                       devices=devices,
+                       device_keys=device_keys,
+                       session=session,
+                       stop=stop)
+        elif args.distributed:
+            # Download the devices this worker claims until none is left
+            run_worker(jwt_token=jwt_token,
+                       devices=devices,
+                       device_keys=device_keys,
+                       session=session,
+                       run_id=args.distributed,
+                       worker_id=args.worker_id,
+                       planner=plan_reconcile_tasks
+                       if args.reconcile else plan_device_tasks)
+        else:
+            # Download all devices and keys with bounded parallelism. With
+            # --reconcile, only the holes in the local data are downloaded.
+            download_devices(jwt_token=jwt_token,
+                             devices=devices,
+                             device_keys=device_keys,
+                             session=session,
+                             dry_run=args.dry_run,
+                             resume_only=args.resume,
+                             planner=plan_reconcile_tasks
+                             if args.reconcile else plan_device_tasks)
+
+    # Record end time
+    end_time = time.time()
+    duration = end_time - start_time
+    end_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    logging.info(f"Script ended at: {end_datetime}")
+    logging.info(f"Total duration: {duration:.2f} seconds")
+
+    # Write the run report (JSON) and, if configured, a Prometheus textfile
+    metrics_config = config.get("metrics") or {}
+    report = get_report(started_at=start_datetime,
+                        ended_at=end_datetime,
+                        run_duration_seconds=round(duration, 3),
+                        run_end_timestamp_seconds=int(end_time))
+    report_file = args.metrics_file or metrics_config.get(
+        "report_file") or os.path.join(LOG_DIR, "last_run_report.json")
+    write_report(report, report_file)
+    logging.info(f"Run report written to {report_file}")
+
+    if metrics_config.get("prometheus_textfile"):
+        write_prometheus_textfile(report, metrics_config["prometheus_textfile"])
+
+    if trace_enabled:
+        stop_tracing()
+        trace_file = args.trace or tracing.trace_file or os.path.join(
+            LOG_DIR,
+            f"{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}_trace.json")
+        for file in write_trace(trace_file):
+            logging.info(f"Trace written to {file}")
+
+
+# Write processes (see "write_processes") are spawned and import this
+# module, so the download must only run when it is executed as a script.
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import os
+import sys
+import argparse
+from datetime import datetime, timezone
+from typing import Optional
+
+from utils.query import scan_local_data
+
+parser = argparse.ArgumentParser(
+    description="Query the local data and export the result.")
+parser.add_argument("--device",
+                    action="append",
+                    help="Device to query (can be repeated, default: all).")
+parser.add_argument("--key",
+                    action="append",
+                    help="Key to query (can be repeated, default: all).")
+parser.add_argument(
+    "--start",
+    help="Start of the time range (ISO date or time in UTC, inclusive).")
+parser.add_argument(
+    "--end", help="End of the time range (ISO date or time in UTC, exclusive).")
+parser.add_argument("--tier",
+                    help="Query this rollup tier (e.g. 1h) instead of raw data.")
+parser.add_argument(
+    "--output",
+    help="Write the result to this .parquet or .csv file instead of printing it.")
+args = parser.parse_args()
+
+
+def parse_time(value: Optional[str]) -> Optional[int]:
+    """Convert an ISO date or time (UTC unless given) to a Unix timestamp in ms."""
+    if value is None:
+        return None
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+
+lf = scan_local_data(devices=args.device,
+                     start_ts=parse_time(args.start),
+                     end_ts=parse_time(args.end),
+                     keys=args.key,
+                     tier=args.tier)
+
+if args.output is None:
+    print(lf.collect(engine="streaming"))
+elif args.output.endswith(".parquet"):
+    lf.sink_parquet(args.output)
+elif args.output.endswith(".csv"):
+    lf.sink_csv(args.output)
+else:
+    sys.exit(f"Unsupported output format: {os.path.splitext(args.output)[1]}")
@@ -0,0 +1,24 @@
+import os
+import sys
+import json
+import tempfile
+
+# The utils modules read the config and the data folder on import, so the
+# tests run against a temporary project folder that is set up before any
+# of them is imported.
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DIR = tempfile.mkdtemp(prefix="tb_downloader_test_")
+
+for name, env in (("data", "TB_DATA_DIR"), ("logs", "TB_LOG_DIR"),
+                  ("config", "TB_CONFIG_DIR")):
+    os.makedirs(os.path.join(TEST_DIR, name), exist_ok=True)
+    os.environ[env] = os.path.join(TEST_DIR, name)
+
+with open(os.path.join(PROJECT_DIR, "config", "config.template.json")) as f:
+    test_config = json.load(f)
+test_config["download"].update(aggregation=None, interval=None)
+test_config["devices"] = {"dev0": "id0", "dev1": "id1"}
+with open(os.path.join(TEST_DIR, "config", "config.json"), "w") as f:
+    json.dump(test_config, f)
+
+sys.path.insert(0, PROJECT_DIR)
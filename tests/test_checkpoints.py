@@ -0,0 +1,68 @@
+import os
+from typing import Any, Callable, Dict, List
+
+import polars as pl
+import pytest
+import requests
+
+from utils import download
+from utils.checkpoints import CheckpointJournal
+from utils.paths import CHECKPOINT_FILE
+
+
+def open_task(device_name: str) -> Dict[str, Any]:
+    return {
+        "device_name": device_name,
+        "startTS": {"k0": 0},
+        "endTS": 1000,
+        "end_exclusive": False,
+        "cursors": {"k0": 500}
+    }
+
+
+@pytest.fixture
+def journal_file() -> Any:
+    yield CHECKPOINT_FILE
+    if os.path.exists(CHECKPOINT_FILE):
+        os.remove(CHECKPOINT_FILE)
+
+
+def test_partial_poll_keeps_open_tasks_of_other_devices(
+        journal_file: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    """A daemon poll of some devices only resumes and completes their tasks."""
+    CheckpointJournal().add_tasks({
+        "task-dev0": open_task("dev0"),
+        "task-dev1": open_task("dev1")
+    })
+    resumed: List[str] = []
+
+    def download_key_batch(jwt_token: str, device_id: str, keys: List[str],
+                           startTS: Dict[str, int], endTS: int,
+                           session: requests.Session,
+                           handle_page: Callable[[pl.DataFrame, Dict[str, int]],
+                                                 None], *args: Any) -> None:
+        resumed.append(device_id)
+
+    monkeypatch.setattr(download, "download_key_batch", download_key_batch)
+    failed = download.download_devices(jwt_token="token",
+                                       devices={"dev1": "id1"},
+                                       device_keys={"dev1": ["k0"]},
+                                       session=requests.Session(),
+                                       resume_only=True)
+
+    assert failed == set()
+    assert resumed == ["id1"]
+    # The task of dev0 is still open for its next poll
+    assert list(CheckpointJournal().get_open_tasks()) == ["task-dev0"]
+
+
+def test_tasks_of_unconfigured_devices_are_dropped(
+        journal_file: str) -> None:
+    CheckpointJournal().add_tasks({
+        "task-dev0": open_task("dev0"),
+        "task-removed": open_task("removed")
+    })
+    journal = CheckpointJournal()
+    journal.remove_devices(["dev0", "dev1"])
+
+    assert list(CheckpointJournal().get_open_tasks()) == ["task-dev0"]
@@ -0,0 +1,81 @@
+import json
+from typing import Any, Dict, List, Optional
+
+from utils.http_cache import CacheEntry, slice_body
+
+# Measurements of key "a" every 10 ms from 0 to 90 ms
+MEASUREMENTS: List[Dict[str, Any]] = [{"ts": ts, "value": str(ts)} for ts in range(0, 100, 10)]
+
+
+def page(start_ts: int, end_ts: int, limit: int) -> Dict[str, Any]:
+    """The body that ThingsBoard returns for [start_ts, end_ts)."""
+    return {
+        "a": [m for m in MEASUREMENTS
+              if start_ts <= m["ts"] < end_ts][:limit]
+    }
+
+
+def get_response(cached: Dict[str, CacheEntry], bodies: Dict[str, Any],
+                 start_ts: int, end_ts: int,
+                 limit: int) -> Optional[Dict[str, List[Dict[str, Any]]]]:
+    body = slice_body(cached, bodies.get, {
+        "keys": "a",
+        "startTs": start_ts,
+        "endTs": end_ts,
+        "limit": limit,
+        "orderBy": "ASC"
+    })
+    return None if body is None else json.loads(body)
+
+
+def cache_pages(*ranges: Any) -> Any:
+    cached = {
+        f"page{i}": CacheEntry(0, "series", ("a", ), start_ts, end_ts, limit)
+        for i, (start_ts, end_ts, limit) in enumerate(ranges)
+    }
+    bodies = {
+        f"page{i}": page(start_ts, end_ts, limit)
+        for i, (start_ts, end_ts, limit) in enumerate(ranges)
+    }
+    return cached, bodies
+
+
+def test_same_range() -> None:
+    cached, bodies = cache_pages((0, 100, 20))
+    assert get_response(cached, bodies, 0, 100, 20) == page(0, 100, 20)
+
+
+def test_sub_range() -> None:
+    cached, bodies = cache_pages((0, 100, 20))
+    assert get_response(cached, bodies, 25, 65, 20) == page(25, 65, 20)
+
+
+def test_smaller_limit() -> None:
+    cached, bodies = cache_pages((0, 100, 20))
+    assert get_response(cached, bodies, 10, 100, 3) == page(10, 100, 3)
+    # A full page still holds all measurements up to its last one
+    cached, bodies = cache_pages((0, 100, 5))
+    assert get_response(cached, bodies, 10, 100, 3) == page(10, 100, 3)
+
+
+def test_larger_limit() -> None:
+    # A full page says nothing about the measurements after its last one
+    cached, bodies = cache_pages((0, 100, 5))
+    assert get_response(cached, bodies, 0, 100, 8) is None
+    # unless the next cached page continues after it
+    cached, bodies = cache_pages((0, 100, 5), (41, 100, 5))
+    assert get_response(cached, bodies, 0, 100, 8) == page(0, 100, 8)
+    # but not if that page is full before endTs as well
+    assert get_response(cached, bodies, 20, 100, 20) is None
+    cached, bodies = cache_pages((0, 100, 5), (41, 100, 10))
+    assert get_response(cached, bodies, 20, 100, 20) == page(20, 100, 20)
+
+
+def test_end_ts_is_exclusive() -> None:
+    cached, bodies = cache_pages((0, 100, 20))
+    assert get_response(cached, bodies, 0, 50, 20) == page(0, 50, 20)
+    assert {"ts": 50, "value": "50"} not in page(0, 50, 20)["a"]
+    # A full page whose last measurement lies right before endTs covers it
+    cached, bodies = cache_pages((0, 100, 5))
+    assert get_response(cached, bodies, 0, 41, 20) == page(0, 41, 20)
+    assert get_response(cached, bodies, 0, 42, 20) is None
@@ -1,10 +1,12 @@
 import os
-import requests
+import argparse
 from datetime import datetime
 import logging
 
-from utils.thingsboard_api import get_jwt_token, get_telemetry_keys
+from utils.thingsboard_api import get_jwt_token, create_session
 from utils.config_files import load_json_config, add_missing_telemetry_keys
+from utils.device_keys import refresh_device_keys
+from utils.download import get_concurrency_limits
 from utils.paths import LOG_DIR
 
 # Create a log filename with the current date (YYYY-MM-DD)
@@ -15,18 +17,37 @@ logging.basicConfig(filename=log_filename,
                     level=logging.INFO,
                     format="%(asctime)s - %(levelname)s - %(message)s")
 
+parser = argparse.ArgumentParser(
+    description=
+    "Discover the telemetry keys of all devices and update keys.json and device_keys.json."
+)
+parser.add_argument(
+    "--max-age-h",
+    type=float,
+    default=None,
+    help="Only refresh devices whose keys are older than this (default: all).")
+args = parser.parse_args()
+
 # config
 devices = load_json_config("config.json")["devices"]
 
-# Create a persistent session.
-with requests.Session() as session:
+# Create a persistent session with one connection per worker.
+max_workers, _ = get_concurrency_limits()
+with create_session(pool_size=max_workers) as session:
     # Retrieve the JWT token using the session.
     jwt_token: str = get_jwt_token(session=session)
 
-    for device in devices.keys():
-        # Get all device specific telemetry keys from ThingsBoard
-        keys = get_telemetry_keys(jwt_token,
-                                  str(devices.get(device)),
-                                  session=session)
-        # Compares local and remote keys and add missing keys to the config file
-        add_missing_telemetry_keys(keys)
+    # Discover the keys of all (stale) devices concurrently
+    device_keys = refresh_device_keys(
+        jwt_token,
+        {device: str(device_id)
+         for device, device_id in devices.items()},
+        session=session,
+        max_workers=max_workers,
+        max_age_s=None if args.max_age_h is None else args.max_age_h * 3600)
+
+    # Compares local and remote keys and add missing keys to the config file
+    add_missing_telemetry_keys({
+        key: True
+        for entry in device_keys.values() for key in entry["keys"]
+    })
@@ -0,0 +1,139 @@
+import os
+import json
+import logging
+import threading
+from typing import Any, Dict, List
+
+from .paths import CHECKPOINT_FILE, DEVICE_CHECKPOINTS_DIR
+
+# The checkpoint journal records the download tasks of the current run in
+# data/checkpoint.json:
+#
+#   {"tasks": {"<task id>": {"device_name": "device_name_1",
+#                            "cursors": {"key_1": 1738759266000, ...},
+#                            "endTS": 1738800000000, ...}, ...}}
+#
+# "cursors" holds the timestamp from which every unfinished key of the task
+# still has to be downloaded. It only advances after the pages before it are
+# saved, and a task is removed once it is complete. The journal is removed
+# when all tasks of the run are complete, so an existing journal always
+# describes an interrupted run.
+#
+# Workers of a distributed run (see utils/distributed.py) keep one journal
+# per device instead, data/.checkpoints/<device>.json, so that a worker
+# that takes a device over resumes exactly the tasks of that device.
+
+
+class CheckpointJournal:
+    """Thread-safe, atomically persisted journal of the open download tasks."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.tasks: Dict[str, Dict[str, Any]] = {}
+
+        if os.path.exists(CHECKPOINT_FILE):
+            try:
+                with open(CHECKPOINT_FILE, 'r') as f:
+                    self.tasks = json.load(f)["tasks"]
+            except (OSError, ValueError, KeyError) as e:
+                logging.error(f"Error reading checkpoint journal: {e}")
+
+    def dump(self) -> None:
+        """Write the journal (called with the lock held)."""
+        if not self.tasks:
+            if os.path.exists(CHECKPOINT_FILE):
+                os.remove(CHECKPOINT_FILE)
+            return
+        tmp_file = f"{CHECKPOINT_FILE}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({"tasks": self.tasks}, f, indent=4)
+        os.replace(tmp_file, CHECKPOINT_FILE)
+
+    def get_open_tasks(self) -> Dict[str, Dict[str, Any]]:
+        """Return the tasks of an interrupted run by task id."""
+        with self.lock:
+            return {
+                task_id: dict(entry)
+                for task_id, entry in self.tasks.items()
+            }
+
+    def add_tasks(self, entries: Dict[str, Dict[str, Any]]) -> None:
+        """Record newly planned tasks."""
+        with self.lock:
+            self.tasks.update(entries)
+            self.dump()
+
+    def update_task(self, task_id: str, cursors: Dict[str, int]) -> None:
+        """
+        Record the progress of a task after its pages up to the cursors were
+        saved. A task without cursors is complete and removed.
+        """
+        with self.lock:
+            if task_id not in self.tasks:
+                return
+            if cursors:
+                self.tasks[task_id]["cursors"] = dict(cursors)
+            else:
+                del self.tasks[task_id]
+            self.dump()
+
+    def remove_devices(self, device_names: List[str]) -> None:
+        """
+        Drop the tasks of devices that are no longer configured, i.e. that
+        are missing in device_names.
+        """
+        with self.lock:
+            tasks = {
+                task_id: entry
+                for task_id, entry in self.tasks.items()
+                if entry["device_name"] in device_names
+            }
+            if len(tasks) < len(self.tasks):
+                self.tasks = tasks
+                self.dump()
+
+
+class DeviceCheckpointJournal(CheckpointJournal):
+    """
+    Checkpoint journal of some devices, stored in one file per device. Only
+    the files of the given devices are read and written.
+    """
+
+    def __init__(self, device_names: List[str]) -> None:
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.device_names = list(device_names)
+
+        for device_name in self.device_names:
+            file_path = self.get_file_path(device_name)
+            if not os.path.exists(file_path):
+                continue
+            try:
+                with open(file_path, 'r') as f:
+                    self.tasks.update(json.load(f)["tasks"])
+            except (OSError, ValueError, KeyError) as e:
+                logging.error(
+                    f"Error reading checkpoint journal of device {device_name}: {e}")
+
+    @staticmethod
+    def get_file_path(device_name: str) -> str:
+        return os.path.join(DEVICE_CHECKPOINTS_DIR, f"{device_name}.json")
+
+    def dump(self) -> None:
+        """Write the journal of every device (called with the lock held)."""
+        os.makedirs(DEVICE_CHECKPOINTS_DIR, exist_ok=True)
+        for device_name in self.device_names:
+            file_path = self.get_file_path(device_name)
+            tasks = {
+                task_id: entry
+                for task_id, entry in self.tasks.items()
+                if entry["device_name"] == device_name
+            }
+            if not tasks:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+                continue
+            tmp_file = f"{file_path}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({"tasks": tasks}, f, indent=4)
+            os.replace(tmp_file, file_path)
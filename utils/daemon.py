@@ -0,0 +1,97 @@
+import time
+import random
+import logging
+import threading
+import requests
+from typing import Dict, List
+
+from .download import download_devices, get_write_settings
+from .metrics import get_report, write_prometheus_textfile
+from .pipeline import WritePipeline
+from .config_files import load_json_config
+
+config = load_json_config("config.json")
+
+
+def get_poll_intervals(devices: Dict[str, str]) -> Dict[str, float]:
+    """
+    Return the poll interval of every device in seconds: the device's entry
+    in "device_intervals_s" of the daemon config, or "poll_interval_s".
+    """
+    daemon_config = config.get("daemon") or {}
+    default_interval = daemon_config.get("poll_interval_s") or 60
+    device_intervals = daemon_config.get("device_intervals_s") or {}
+    return {
+        device_name: device_intervals.get(device_name) or default_interval
+        for device_name in devices
+    }
+
+
+def run_daemon(jwt_token: str, devices: Dict[str, str],
+               device_keys: Dict[str, List[str]], session: requests.Session,
+               stop: threading.Event) -> None:
+    """
+    Poll every device on its own interval until stop is set.
+
+    The session, the JWT token (which is refreshed when it expires) and the
+    watermark index stay in memory between polls, so every poll only
+    downloads the new tail of every key since its watermark. Devices that
+    are due at the same time are downloaded together. Every poll is
+    scheduled up to "jitter_s" seconds late, so that devices with the same
+    interval spread out over time. The write pipeline (and its write
+    processes) is created once and serves all polls. After every poll, the
+    Prometheus textfile is updated if it is configured.
+    """
+    if not devices:
+        logging.warning("No devices to poll, the daemon stops.")
+        return
+    intervals = get_poll_intervals(devices)
+    jitter_s = (config.get("daemon") or {}).get("jitter_s", 5)
+    prometheus_textfile = (config.get("metrics")
+                           or {}).get("prometheus_textfile")
+
+    # All devices are due at the start. The schedule keeps the cadence of
+    # every device, the jitter is added on top of it.
+    scheduled = {device_name: time.monotonic() for device_name in devices}
+    next_poll = {
+        device_name: ts + random.uniform(0, jitter_s)
+        for device_name, ts in scheduled.items()
+    }
+    logging.info(f"Daemon started, polling {len(devices)} device(s) every "
+                 f"{min(intervals.values())}-{max(intervals.values())} s.")
+
+    pipeline = WritePipeline(*get_write_settings())
+    try:
+        while not stop.is_set():
+            now = time.monotonic()
+            due = [name for name, ts in next_poll.items() if ts <= now]
+            if not due:
+                stop.wait(min(next_poll.values()) - now)
+                continue
+
+            poll_start = time.monotonic()
+            try:
+                download_devices(jwt_token=jwt_token,
+                                 devices={name: devices[name]
+                                          for name in due},
+                                 device_keys=device_keys,
+                                 session=session,
+                                 pipeline=pipeline)
+            except Exception as e:
+                logging.error(f"Error polling devices {due}: {e}")
+            logging.info(f"Polled {len(due)} device(s) in "
+                         f"{time.monotonic() - poll_start:.2f} seconds.")
+
+            # Never schedule a poll in the past if a poll took longer than
+            # the device's interval.
+            for name in due:
+                scheduled[name] = max(scheduled[name] + intervals[name],
+                                      time.monotonic())
+                next_poll[name] = scheduled[name] + random.uniform(0, jitter_s)
+
+            if prometheus_textfile:
+                write_prometheus_textfile(get_report(), prometheus_textfile)
+    finally:
+        pipeline.close()
+
+    logging.info("Daemon stopped.")
@@ -1,80 +1,399 @@
 import os
+import sys
+import json
+import time
 import logging
+import threading
 import polars as pl
-from typing import Optional, Dict, List, Any
+from datetime import datetime, timezone
+from typing import IO, Optional, Dict, List, Any, NamedTuple
 from pathlib import Path
 
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
 
-def load_local_data(path: str, file_name: str) -> Optional[pl.DataFrame]:
+from .storage import prepare_for_storage, write_parquet_file
+
+# Local storage layout (per year folder and device):
+#
+#   data/<year>/<device>/month=<MM>/<min ts>_<max ts>_<sequence>.parquet
+#
+# Every save appends a new segment file to the month partitions it touches.
+# The file name carries the segment's time range, so overlaps and the latest
+# timestamp are known without opening any file, and the sequence number
+# (the write time in ns) orders segments from oldest to newest. Segments may
+# overlap; rows with the same timestamp are merged column by column, and the
+# value of the newest segment wins.
+# Compaction merges the segments of a month partition into one segment,
+# which takes the sequence number of the newest merged segment.
+# Devices that still have a single yearly file data/<year>/<device>.parquet
+# are migrated to this layout on their next save or by compact_data.py.
+
+
+# Download tasks of the same device save concurrently; saves (including
+# compaction and rollups) of the same device and year are serialized, also
+# with other processes (write processes, compact_data.py, build_rollups.py)
+# through a lock file data/<year>/<device>/.lock. The locks are reentrant,
+# so callers can hold them across several saves.
+
+
+def lock_file(file: IO[bytes]) -> None:
+    """Block until this process holds the exclusive lock of an open file."""
+    if sys.platform == "win32":
+        while True:
+            try:
+                msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                # LK_LOCK gives up after 10 seconds
+                continue
+    else:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+
+
+def unlock_file(file: IO[bytes]) -> None:
+    if sys.platform == "win32":
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+class DeviceLock:
     """
-    Attempt to read the local Parquet file for a given device.
-    Returns a Polars DataFrame if the file exists and is not empty, otherwise None.
+    Reentrant lock of a device's data in a year folder, held by one thread
+    of one process at a time. The lock file is locked by the outermost
+    with-block of the holding thread.
     """
 
-    filepath = os.path.join(path, f"{file_name}.parquet")
+    def __init__(self, lock_path: str) -> None:
+        self.lock_path = lock_path
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.file: Optional[IO[bytes]] = None
 
-    if os.path.exists(filepath):
-        try:
-            df = pl.read_parquet(filepath)
+    def __enter__(self) -> "DeviceLock":
+        self.lock.acquire()
+        if self.depth == 0:
+            try:
+                os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+                file = open(self.lock_path, "a+b")
+                try:
+                    lock_file(file)
+                except BaseException:
+                    file.close()
+                    raise
+                self.file = file
+            except BaseException:
+                self.lock.release()
+                raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.depth -= 1
+        if self.depth == 0 and self.file is not None:
+            try:
+                unlock_file(self.file)
+            finally:
+                self.file.close()
+                self.file = None
+        self.lock.release()
+
+
+device_locks: Dict[str, DeviceLock] = {}
+device_locks_lock = threading.Lock()
+
+
+def get_device_lock(path: str, file_name: str) -> DeviceLock:
+    """Return the lock that serializes writes to a device's data in a year folder."""
+    with device_locks_lock:
+        return device_locks.setdefault(
+            os.path.join(path, file_name),
+            DeviceLock(os.path.join(path, file_name, ".lock")))
+
+
+class Segment(NamedTuple):
+    path: str
+    min_ts: int
+    max_ts: int
+    sequence: int
+
+
+def get_legacy_file_path(path: str, file_name: str) -> str:
+    return os.path.join(path, f"{file_name}.parquet")
+
+
+def get_partition_name(ts: int) -> str:
+    month = datetime.fromtimestamp(ts / 1000, tz=timezone.utc).month
+    return f"month={month:02d}"
+
+
+def get_segments(path: str, file_name: str) -> List[Segment]:
+    """
+    Return all segment files of a device in a year folder, ordered from the
+    oldest to the newest write.
+    """
+    device_dir = os.path.join(path, file_name)
+    if not os.path.isdir(device_dir):
+        return []
+
+    segments = []
+    for partition in os.listdir(device_dir):
+        partition_dir = os.path.join(device_dir, partition)
+        if not os.path.isdir(partition_dir):
+            continue
+        for segment_file in os.listdir(partition_dir):
+            if not segment_file.endswith(".parquet"):
+                continue
+            try:
+                min_ts, max_ts, sequence = segment_file.removesuffix(
+                    ".parquet").split("_")
+                segments.append(
+                    Segment(os.path.join(partition_dir, segment_file),
+                            int(min_ts), int(max_ts), int(sequence)))
+            except ValueError:
+                logging.warning(f"Ignoring unknown file: {segment_file}")
+
+    return sorted(segments, key=lambda segment: segment.sequence)
+
+
+def write_segment(path: str,
+                  file_name: str,
+                  df: pl.DataFrame,
+                  sequence: Optional[int] = None) -> Segment:
+    """
+    Write a DataFrame (sorted by ts, within one month) as a new segment,
+    by default with the current time as sequence number. The file is
+    written under a temporary name first, so that readers never see a
+    partially written segment.
+    """
+    min_ts, max_ts = df.select(
+        pl.col("ts").min().alias("min_ts"),
+        pl.col("ts").max().alias("max_ts")).row(0)
+    partition_dir = os.path.join(path, file_name, get_partition_name(min_ts))
+    os.makedirs(partition_dir, exist_ok=True)
+
+    if sequence is None:
+        sequence = time.time_ns()
+    filepath = os.path.join(partition_dir,
+                            f"{min_ts}_{max_ts}_{sequence}.parquet")
+    write_parquet_file(df, f"{filepath}.tmp")
+    os.replace(f"{filepath}.tmp", filepath)
+    return Segment(filepath, min_ts, max_ts, sequence)
+
+
+def read_segments(segments: List[Segment],
+                  min_ts: Optional[int] = None,
+                  max_ts: Optional[int] = None) -> pl.DataFrame:
+    """
+    Read segments (optionally only the rows between min_ts and max_ts) into
+    one DataFrame sorted by ts. Rows with the same ts in several segments are
+    merged column by column, keeping the latest non-null value. Columns with
+    different dtypes in different segments are cast to their supertype.
+    """
+    frames = []
+    for segment in segments:
+        lf = pl.scan_parquet(segment.path)
+        if min_ts is not None:
+            lf = lf.filter(pl.col("ts") >= min_ts)
+        if max_ts is not None:
+            lf = lf.filter(pl.col("ts") <= max_ts)
+        frames.append(lf)
+    return merge_duplicate_timestamps(
+        pl.concat(frames, how="diagonal_relaxed").collect())
+
+
+def merge_duplicate_timestamps(df: pl.DataFrame) -> pl.DataFrame:
+    """
+    Merge rows with the same ts into one row, taking the last non-null value
+    of every column, and sort by ts. Keys can be downloaded from different
+    start timestamps, so a later segment may hold only some of the keys of a
+    timestamp that is already stored.
+    """
+    duplicated = pl.col("ts").is_duplicated()
+    if not df.select(duplicated.any()).item():
+        return df.sort("ts")
+    merged = df.filter(duplicated).group_by("ts", maintain_order=True).agg(
+        pl.all().drop_nulls().last())
+    return pl.concat([df.filter(~duplicated), merged],
+                     how="diagonal_relaxed").sort("ts")
+
+
+def migrate_legacy_file(path: str, file_name: str) -> None:
+    """
+    Split a yearly file data/<year>/<device>.parquet into month segments and
+    remove it afterwards.
+    """
+    filepath = get_legacy_file_path(path, file_name)
+    if not os.path.exists(filepath):
+        return
+
+    df = pl.read_parquet(filepath)
+    if df.height > 0:
+        df = df.sort("ts")
+        partitions = df.with_columns(
+            pl.from_epoch("ts", time_unit="ms").dt.month().alias(
+                "_month")).partition_by("_month", include_key=False)
+        for partition in partitions:
+            write_segment(path, file_name, partition)
+
+    os.remove(filepath)
+    logging.info(
+        f"Migrated {filepath} to month partitions ({df.height} rows).")
+
+
+def load_local_data(path: str, file_name: str) -> Optional[pl.DataFrame]:
+    """
+    Attempt to read the local data of a given device in a year folder.
+    Returns a Polars DataFrame if any data exists, otherwise None.
+    """
+    try:
+        segments = get_segments(path, file_name)
+        frames = []
+        if segments:
+            frames.append(read_segments(segments))
+        legacy_filepath = get_legacy_file_path(path, file_name)
+        if os.path.exists(legacy_filepath):
+            frames.append(pl.read_parquet(legacy_filepath))
+
+        if frames:
+            df = pl.concat(frames, how="diagonal_relaxed")
             if df.height > 0:
-                return df
-        except Exception as e:
-            logging.error(f"Error reading local data for {file_name}: {e}")
+                return df.sort("ts")
+    except Exception as e:
+        logging.error(f"Error reading local data for {file_name}: {e}")
     return None
 
 
-def save_local_data(path: str, file_name: str, df: pl.DataFrame) -> None:
+def save_local_data(path: str,
+                    file_name: str,
+                    df: pl.DataFrame,
+                    max_segments: Optional[int] = None) -> bool:
     """
-    Save the given DataFrame to the device's local Parquet file.
-    If a file already exists, combine the old and new data and write back.
+    Save the given DataFrame to the device's local month partitions.
+
+    The new rows are appended as a new segment per month; existing segments
+    are never rewritten. Only where the new rows overlap the time range of
+    existing segments, the stored rows of that range are read, and new rows
+    that are identical to them are dropped (e.g. the last row of the previous
+    run, which is downloaded again). Changed rows are written as well and
+    supersede the stored ones, because readers merge rows with the same
+    timestamp column by column, preferring the newest segment. If
+    max_segments is given, month partitions with more segments are
+    compacted afterwards. Saves of the same device are serialized. Returns
+    whether the data was saved.
     """
-    filepath = os.path.join(path, f"{file_name}.parquet")
+    try:
+        with get_device_lock(path, file_name):
+            migrate_legacy_file(path, file_name)
+            segments = get_segments(path, file_name)
 
-    existing_df = load_local_data(path, file_name)
+            df = prepare_for_storage(df.sort("ts"))
+            partitions = df.with_columns(
+                pl.from_epoch("ts", time_unit="ms").dt.month().alias(
+                    "_month")).partition_by("_month", include_key=False)
 
-    try:
-        if existing_df is not None:
-            # Combine and remove duplicates based on timestamp
-            combined_df = pl.concat([existing_df, df],
-                                    how="diagonal").unique(subset=["ts"],
-                                                           keep="last")
-            logging.info(
-                f"Adding {df.height} rows to existing data for device.")
-        else:
-            combined_df = df
-
-        combined_df.sort("ts").write_parquet(filepath)
-        logging.info(
-            f"Saved data for device {file_name}. Total rows now: {combined_df.height}"
-        )
+            rows_written = 0
+            for partition in partitions:
+                min_ts, max_ts = partition.select(
+                    pl.col("ts").min().alias("min_ts"),
+                    pl.col("ts").max().alias("max_ts")).row(0)
+                overlapping = [
+                    segment for segment in segments
+                    if segment.min_ts <= max_ts and segment.max_ts >= min_ts
+                ]
+
+                if overlapping:
+                    # Remove rows that are already stored unchanged
+                    stored = read_segments(overlapping, min_ts, max_ts)
+                    if set(partition.columns) <= set(stored.columns):
+                        # Compare in the dtypes of the new rows, the stored
+                        # segments may have been written with other dtypes.
+                        stored_rows = stored.select(partition.columns).cast(
+                            partition.schema, strict=False).select(
+                                pl.struct(partition.columns).hash().alias("_row"))
+                        partition = partition.filter(~pl.struct(
+                            partition.columns).hash().is_in(stored_rows["_row"]))
+
+                if partition.height > 0:
+                    write_segment(path, file_name, partition)
+                    rows_written += partition.height
+
+            logging.info(f"Adding {df.height} rows to existing data for device.")
+
+            if max_segments is not None:
+                compact_local_data(path, file_name, max_segments)
+
+            logging.info(f"Saved data for device {file_name}: {rows_written} "
+                         f"new or changed row(s).")
+        return True
     except Exception as e:
         logging.error(f"Error saving data for device {file_name}: {e}")
+        return False
+
+
+def compact_local_data(path: str, file_name: str,
+                       max_segments: int = 1) -> None:
+    """
+    Merge the segments of every month partition of a device that has more
+    than max_segments segments into a single segment. The merged segment
+    keeps the sequence number of the newest merged one, so that segments
+    written meanwhile stay newer. Must be called with the device's lock
+    held.
+    """
+    partitions: Dict[str, List[Segment]] = {}
+    for segment in get_segments(path, file_name):
+        partitions.setdefault(os.path.dirname(segment.path),
+                              []).append(segment)
+
+    for partition_dir, segments in partitions.items():
+        if len(segments) <= max_segments:
+            continue
+        compacted = write_segment(path, file_name, read_segments(segments),
+                                  max(segment.sequence for segment in segments))
+        for segment in segments:
+            # The merged segment replaced the newest one if its range is the same
+            if segment.path != compacted.path:
+                os.remove(segment.path)
+        logging.info(
+            f"Compacted {len(segments)} segments in {partition_dir}.")
 
 
 def get_local_latest_timestamp(path: str, file_name: str) -> Optional[int]:
     """
-    Check if a local Parquet file exists and return the max timestamp.
-    Assumes the data has a 'timestamp' column in Unix epoch seconds.
-    Returns None if the file doesn't exist or is empty.
+    Return the max timestamp of the local data of a device in a year folder.
+    For segments, the timestamp is taken from the file names; yearly files
+    that are not migrated yet are read.
+    Returns None if no data exists.
     """
-    df = load_local_data(path=path, file_name=file_name)
-    if df is None:
+    candidate_timestamps = [
+        segment.max_ts for segment in get_segments(path, file_name)
+    ]
+
+    legacy_filepath = get_legacy_file_path(path, file_name)
+    if os.path.exists(legacy_filepath):
+        try:
+            latest = pl.scan_parquet(legacy_filepath).select(
+                pl.col("ts").max()).collect().item()
+            if latest is not None:
+                candidate_timestamps.append(latest)
+        except Exception as e:
+            logging.error(
+                f"Error getting latest timestamp for {file_name}: {e}")
+
+    if not candidate_timestamps:
         logging.info(f"No local file for {file_name}.")
         return None
-    try:
-        if df.height == 0 or 'ts' not in df.columns:
-            return None
-        latest = df.select(pl.col("ts").max()).to_series()[0]
-        return latest
-    except Exception as e:
-        logging.error(f"Error getting latest timestamp for {file_name}: {e}")
-        return None
+    return max(candidate_timestamps)
 
 
 def get_latest_local_timestamp_across_years(device_name: str,
                                             base_dir: str) -> Optional[int]:
     """
-    Search all subdirectories (e.g., year folders) within base_dir for the device file and
+    Search all subdirectories (e.g., year folders) within base_dir for the device data and
     return the highest (latest) timestamp found.
     """
     base = Path(base_dir)
@@ -83,9 +402,9 @@ def get_latest_local_timestamp_across_years(device_name: str,
     # Iterate over all subdirectories whose names are digits.
     for subfolder in base.iterdir():
         if subfolder.is_dir() and subfolder.name.isdigit():
-            file_path = subfolder / f"{device_name}.parquet"
-            if file_path.exists():
-                # Get the latest timestamp from that file.
+            if (subfolder / device_name).is_dir() or (
+                    subfolder / f"{device_name}.parquet").exists():
+                # Get the latest timestamp from that year.
                 ts = get_local_latest_timestamp(path=str(subfolder),
                                                 file_name=device_name)
                 if ts is not None:
@@ -120,11 +439,11 @@ def safe_convert_to_float(x: Any) -> Optional[float]:
         return None
 
 
-def telemetry_to_dataframe(
-        data: Dict[str, List[Dict[str, Any]]]) -> pl.DataFrame:
+def telemetry_to_dataframe(data: Dict[str, List[Dict[str, Any]]],
+                           text_keys: Optional[List[str]] = None) -> pl.DataFrame:
     """
     Convert telemetry data (a dict where each key maps to a list of measurements)
-    into a Polars DataFrame where all measurements sharing the same timestamp are on the same row.
+    into a long-format Polars DataFrame with the columns 'ts', 'key' and 'value'.
     
     Expected input structure:
     {
@@ -133,24 +452,103 @@ def telemetry_to_dataframe(
         ...
     }
     
-    Returns a DataFrame with one column for the timestamp ('ts') and one column per key.
-    The values are converted to floats.
+    The measurements are collected into 'ts', 'key' and 'value' arrays first
+    and then converted by convert_telemetry_values.
     """
-    # First, convert the dictionary into a list of rows in long format.
-    rows = []
+    # Collect the measurements into flat columns.
+    ts: List[Any] = []
+    keys: List[str] = []
+    values: List[Any] = []
     for key, measurements in data.items():
-        for m in measurements:
-            # Convert the 'value' to float. Adjust conversion if needed.
-            value = safe_convert_to_float(m["value"])
-            rows.append({"ts": m["ts"], "key": key, "value": value})
+        ts.extend([m["ts"] for m in measurements])
+        values.extend([m["value"] for m in measurements])
+        keys.extend([key] * len(measurements))
+
+    # Values arrive as strings, but may also be numbers or booleans, so they
+    # are normalized to strings and parsed in one vectorized pass.
+    df_raw = pl.DataFrame({
+        "ts": pl.Series(ts, dtype=pl.Int64),
+        "key": pl.Series(keys, dtype=pl.Utf8),
+        "value": pl.Series(values, dtype=pl.Utf8, strict=False)
+    })
+    return convert_telemetry_values(df_raw, text_keys)
+
+
+def skip_whitespace(text: str, i: int) -> int:
+    while i < len(text) and text[i] in " \t\n\r":
+        i += 1
+    return i
+
+
+def read_telemetry_json(body: bytes) -> pl.DataFrame:
+    """
+    Decode the raw body of a telemetry response into a long-format DataFrame
+    with the columns 'ts', 'key' and 'value' (as strings).
+
+    Instead of decoding the whole body into one object tree, the body is
+    decoded one key at a time, and the measurements of every key are moved
+    into columns before the next key is decoded, so only the measurements
+    of one key exist as Python objects at a time. The body itself (and its
+    decoded text) is still held in memory as a whole.
+    """
+    text = body.decode()
+    decoder = json.JSONDecoder()
+    frames = []
+
+    i = skip_whitespace(text, 0)
+    if text[i:i + 1] != "{":
+        raise ValueError("Telemetry response is not a JSON object.")
+    i = skip_whitespace(text, i + 1)
+    while text[i:i + 1] != "}":
+        key, i = decoder.raw_decode(text, i)
+        i = skip_whitespace(text, i)
+        if text[i:i + 1] != ":":
+            raise ValueError(f"Expected ':' at position {i} of the response.")
+        measurements, i = decoder.raw_decode(text, skip_whitespace(text, i + 1))
+        if measurements:
+            frames.append(
+                pl.DataFrame({
+                    "ts": pl.Series([m["ts"] for m in measurements],
+                                    dtype=pl.Int64),
+                    "key": pl.Series([key] * len(measurements), dtype=pl.Utf8),
+                    "value": pl.Series([m["value"] for m in measurements],
+                                       dtype=pl.Utf8,
+                                       strict=False)
+                }))
+        del measurements
+        i = skip_whitespace(text, i)
+        if text[i:i + 1] == ",":
+            i = skip_whitespace(text, i + 1)
+
+    if not frames:
+        return pl.DataFrame(schema={
+            "ts": pl.Int64,
+            "key": pl.Utf8,
+            "value": pl.Utf8
+        })
+    return pl.concat(frames)
+
+
+def convert_telemetry_values(df_raw: pl.DataFrame,
+                             text_keys: Optional[List[str]] = None) -> pl.DataFrame:
+    """
+    Convert the string values of a long-format DataFrame to floats in the
+    same way as safe_convert_to_float, but column-wise: boolean strings are
+    mapped to 1.0/0.0, all other values are parsed as floats (null if not
+    numeric) and rounded to 4 decimals.
+
+    If text_keys is given, a 'text' column holds the values of these keys as
+    strings (and null for all other keys), so that they can be stored
+    without conversion.
+    """
+    text = pl.col("value").str.strip_chars()
+    lower_text = text.str.to_lowercase()
 
-    # Create a Polars DataFrame from the long list.
     # Force the schema so that "value" is always a float (Float64)
-    df_long = pl.DataFrame(rows,
-                           schema={
-                               "ts": pl.Int64,
-                               "key": pl.Utf8,
-                               "value": pl.Float64
-                           })
-
-    return df_long
+    return df_raw.with_columns(
+        pl.when(lower_text == "true").then(1.0).when(
+            lower_text == "false").then(0.0).otherwise(
+                text.cast(pl.Float64, strict=False).round(4)).cast(
+                    pl.Float64).alias("value"),
+        *([pl.when(pl.col("key").is_in(text_keys)).then(
+            pl.col("value")).alias("text")] if text_keys else []))
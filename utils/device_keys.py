@@ -0,0 +1,96 @@
+import os
+import time
+import logging
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from .thingsboard_api import get_telemetry_keys
+from .config_files import dump_json_config, load_json_config
+from .paths import CONFIG_DIR
+
+# The device-to-keys map stores the telemetry keys every device publishes
+# in config/device_keys.json, with the time every key was first seen and the
+# time of the device's last refresh (in ms):
+#
+#   {"device_name_1": {"updated_at": 1738759266000,
+#                      "keys": {"key_1": 1738759266000, ...}}, ...}
+#
+# Keys are only ever added, so keys that a device stopped publishing are
+# still downloaded up to their last measurement.
+
+DEVICE_KEYS_FILE = "device_keys.json"
+
+
+def load_device_keys() -> Dict[str, Dict[str, Any]]:
+    """Load the device-to-keys map, or return an empty map if it does not exist."""
+    if not os.path.exists(os.path.join(CONFIG_DIR, DEVICE_KEYS_FILE)):
+        return {}
+    return load_json_config(DEVICE_KEYS_FILE)
+
+
+def refresh_device_keys(jwt_token: str,
+                        devices: Dict[str, str],
+                        session: requests.Session,
+                        max_workers: int,
+                        max_age_s: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Discover the keys of all devices whose entry in the device-to-keys map
+    is missing or older than max_age_s (all devices if max_age_s is None)
+    concurrently, and save the map once at the end. Devices whose discovery
+    fails keep their previous entry. Returns the updated map.
+    """
+    device_keys = load_device_keys()
+    now = int(time.time() * 1000)
+    stale_devices = [
+        device_name for device_name in devices
+        if device_name not in device_keys or max_age_s is None
+        or now - device_keys[device_name]["updated_at"] > max_age_s * 1000
+    ]
+    logging.info(f"Discovering keys of {len(stale_devices)} of "
+                 f"{len(devices)} device(s).")
+
+    def discover(device_name: str) -> Optional[List[str]]:
+        try:
+            return list(
+                get_telemetry_keys(jwt_token,
+                                   devices[device_name],
+                                   session=session))
+        except Exception as e:
+            logging.error(f"Error discovering keys of device {device_name}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for device_name, keys in zip(stale_devices,
+                                     executor.map(discover, stale_devices)):
+            if keys is None:
+                continue
+            entry = device_keys.setdefault(device_name, {"keys": {}})
+            new_keys = [key for key in keys if key not in entry["keys"]]
+            for key in new_keys:
+                entry["keys"][key] = now
+            entry["updated_at"] = now
+            if new_keys:
+                logging.info(
+                    f"Found {len(new_keys)} new key(s) of device {device_name}.")
+
+    dump_json_config(DEVICE_KEYS_FILE, device_keys)
+    return device_keys
+
+
+def get_device_keys_to_download(devices: Dict[str, str],
+                                keys: List[str]) -> Dict[str, List[str]]:
+    """
+    Return the selected keys that every device publishes according to the
+    device-to-keys map. Devices that are not in the map get all selected keys.
+    """
+    device_keys = load_device_keys()
+    result = {}
+    for device_name in devices:
+        if device_name in device_keys:
+            result[device_name] = [
+                key for key in keys if key in device_keys[device_name]["keys"]
+            ]
+        else:
+            result[device_name] = list(keys)
+    return result
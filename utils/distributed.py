@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import random
+import logging
+import requests
+from typing import Any, Dict, List
+
+from .download import (Planner, download_devices, get_concurrency_limits,
+                       plan_device_tasks)
+from .leases import FINAL_STATES, LeaseManager
+from .checkpoints import DeviceCheckpointJournal
+from .metrics import get_report, merge_reports, write_atomic
+from .config_files import load_json_config
+from .paths import LEASES_DIR
+
+config = load_json_config("config.json")
+
+# In a distributed run, several workers (processes on the same or on
+# different hosts) download the devices of the same run id into a data
+# folder on shared storage. The workers claim devices through the lease
+# files of the run (see utils/leases.py):
+#
+#   <lease dir>/<run id>/<device>/<generation>.json
+#   <lease dir>/<run id>/reports/<worker id>.json
+#   <lease dir>/<run id>/report.json
+#
+# Every worker claims a few devices at a time, downloads them and marks
+# their leases as "done" or "failed". The progress of every device is kept
+# in its own checkpoint journal (data/.checkpoints/<device>.json), so a
+# worker that takes over the device of a crashed worker resumes it at the
+# last saved page. Every save is fenced on the lease, i.e. a worker that
+# lost a device stops writing it. When no device is left, every worker
+# writes its report and merges the reports of all workers so far into the
+# report of the run.
+
+
+def get_distributed_settings() -> Dict[str, Any]:
+    """Return the lease folder, lease duration, poll interval and claim size."""
+    settings = config.get("distributed") or {}
+    max_workers, max_workers_per_device = get_concurrency_limits()
+    return {
+        "lease_dir": settings.get("lease_dir") or LEASES_DIR,
+        "lease_ttl_s": settings.get("lease_ttl_s") or 600,
+        "poll_interval_s": settings.get("poll_interval_s") or 30,
+        "devices_per_claim": settings.get("devices_per_claim")
+        or max(1, max_workers // max_workers_per_device)
+    }
+
+
+def write_run_report(run_dir: str, worker_id: str,
+                     outcomes: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Write the report of this worker and merge the reports of all workers
+    of the run into report.json. Returns the merged report.
+    """
+    reports_dir = os.path.join(run_dir, "reports")
+    os.makedirs(reports_dir, exist_ok=True)
+    report = get_report(worker_id=worker_id, devices=outcomes)
+    write_atomic(os.path.join(reports_dir, f"{worker_id}.json"),
+                 json.dumps(report, indent=4))
+
+    reports: List[Dict[str, Any]] = []
+    for name in sorted(os.listdir(reports_dir)):
+        if name.endswith(".json"):
+            with open(os.path.join(reports_dir, name), 'r') as f:
+                reports.append(json.load(f))
+    # A device that a worker lost is reported by the worker that took it over
+    devices: Dict[str, str] = {}
+    for worker_report in reports:
+        for device_name, state in worker_report["devices"].items():
+            if devices.get(device_name) in (None, "lost"):
+                devices[device_name] = state
+    merged_report = merge_reports(
+        reports,
+        workers=[worker_report["worker_id"] for worker_report in reports],
+        devices=devices)
+    write_atomic(os.path.join(run_dir, "report.json"),
+                 json.dumps(merged_report, indent=4))
+    return merged_report
+
+
+def run_worker(jwt_token: str,
+               devices: Dict[str, str],
+               device_keys: Dict[str, List[str]],
+               session: requests.Session,
+               run_id: str,
+               worker_id: str,
+               planner: Planner = plan_device_tasks) -> Dict[str, str]:
+    """
+    Download the devices of a distributed run together with the other
+    workers of the same run id, until every device is "done" or "failed".
+
+    The worker claims up to "devices_per_claim" devices without a lease or
+    with an expired lease, in an order of its own so that workers rarely
+    compete for the same device. If every remaining device is held by
+    other workers, it waits "poll_interval_s" seconds and tries again, so
+    that it takes over the devices of workers that stopped. Returns the
+    outcome of every device this worker claimed: "done", "failed", or
+    "lost" if another worker took it over meanwhile or its lease could not
+    be released (then it is claimed again once the lease expired).
+    """
+    settings = get_distributed_settings()
+    run_dir = os.path.join(settings["lease_dir"], run_id)
+    leases = LeaseManager(run_dir, worker_id, settings["lease_ttl_s"])
+    leases.start()
+    logging.info(f"Worker {worker_id} joined run {run_id} ({run_dir}).")
+
+    device_names = list(devices)
+    random.Random(worker_id).shuffle(device_names)
+    outcomes: Dict[str, str] = {}
+    try:
+        while True:
+            claimed: List[str] = []
+            for device_name in device_names:
+                if len(claimed) >= settings["devices_per_claim"]:
+                    break
+                # A lost device is claimed again once its lease expired
+                if outcomes.get(device_name) in (
+                        None, "lost") and leases.claim(device_name):
+                    claimed.append(device_name)
+
+            if claimed:
+                logging.info(f"Claimed device(s) {claimed}.")
+                try:
+                    failed = download_devices(
+                        jwt_token=jwt_token,
+                        devices={name: devices[name]
+                                 for name in claimed},
+                        device_keys=device_keys,
+                        session=session,
+                        planner=planner,
+                        journal=DeviceCheckpointJournal(claimed),
+                        owns_device=leases.owns)
+                except Exception as e:
+                    logging.error(f"Error downloading devices {claimed}: {e}")
+                    failed = set(claimed)
+                for device_name in claimed:
+                    state = "failed" if device_name in failed else "done"
+                    try:
+                        released = leases.release(device_name, state)
+                    except OSError as e:
+                        # The device is downloaded again by the worker that
+                        # takes over its expired lease
+                        logging.error(f"Error releasing the lease of device "
+                                      f"{device_name}: {e}")
+                        leases.forget(device_name)
+                        released = False
+                    outcomes[device_name] = state if released else "lost"
+                continue
+
+            states = leases.get_states(device_names)
+            pending = [
+                name for name, state in states.items()
+                if state not in FINAL_STATES
+            ]
+            if not pending:
+                break
+            logging.info(f"{len(pending)} device(s) are downloaded by other "
+                         f"workers, checking their leases again in "
+                         f"{settings['poll_interval_s']} seconds.")
+            time.sleep(settings["poll_interval_s"])
+    finally:
+        leases.close()
+
+    merged_report = write_run_report(run_dir, worker_id, outcomes)
+    logging.info(f"Worker {worker_id} finished: downloaded {len(outcomes)} "
+                 f"device(s), the run report of {len(merged_report['workers'])} "
+                 f"worker(s) covers {len(merged_report['devices'])} of "
+                 f"{len(devices)} device(s).")
+    return outcomes
@@ -0,0 +1,774 @@
+import os
+import uuid
+import logging
+import threading
+import requests
+import polars as pl
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from itertools import zip_longest
+from typing import (Any, Callable, Dict, List, NamedTuple, Optional, Set,
+                    Tuple)
+
+from .thingsboard_api import get_telemetry_body
+from .data_files import (convert_telemetry_values, get_device_lock,
+                         read_telemetry_json, save_local_data)
+from .download_interval import download_interval
+from .os_functions import ensure_data_dir
+from .page_size import PageSizeController
+from .rollups import get_rollup_tiers, update_rollups
+from .window_planner import (estimate_window, plan_windows, probe_density,
+                             refine_density)
+from .watermarks import (NON_KEY_COLUMNS, get_key_timestamps,
+                         update_watermarks)
+from .storage import get_text_keys
+from .staging import (BYTES_PER_LONG_ROW, StagingBuffer, clear_staged_data,
+                      get_staging_path, pivot_staged_data)
+from .checkpoints import CheckpointJournal
+from .hot_cache import mark_changed, update_hot_caches
+from .pipeline import WritePipeline
+from .metrics import ROWS_BUCKETS, increment, observe, timed
+from .tracing import begin_async, end_async, span
+from .config_files import load_json_config
+from .paths import DATA_DIR, STAGING_DIR
+
+config = load_json_config("config.json")
+
+
+def get_concurrency_limits() -> Tuple[int, int]:
+    """
+    Return the global and per-device concurrency limits from the config file.
+    Both default to 1, which downloads one (device, key batch) at a time.
+    """
+    max_workers = config["download"].get("max_workers") or 1
+    max_workers_per_device = config["download"].get(
+        "max_workers_per_device") or max_workers
+    return max_workers, min(max_workers_per_device, max_workers)
+
+
+def get_key_batches(startTS: Dict[str, int]) -> List[List[str]]:
+    """
+    Split the keys into batches of at most "keys_per_request" keys, each of
+    which is downloaded with a single request per page. Keys are batched in
+    the order of their start timestamps, so that keys lagging behind share a
+    batch instead of holding back the pagination of up-to-date keys.
+    """
+    batch_size = config["download"].get("keys_per_request") or 1
+    keys = sorted(startTS, key=lambda key: startTS[key])
+    return [keys[i:i + batch_size] for i in range(0, len(keys), batch_size)]
+
+
+def download_key_batch(jwt_token: str,
+                       device_id: str,
+                       keys: List[str],
+                       startTS: Dict[str, int],
+                       endTS: int,
+                       session: requests.Session,
+                       handle_page: Callable[[pl.DataFrame, Dict[str, int]],
+                                             None],
+                       end_exclusive: bool = False,
+                       page_sizer: Optional[PageSizeController] = None) -> None:
+    """
+    Page through the telemetry of several keys from their startTS to endTS,
+    requesting all unfinished keys of the batch at once, and pass every
+    downloaded page as long-format DataFrame to handle_page, together with
+    the cursors of the keys that are not finished yet. With
+    end_exclusive, measurements at endTS are dropped, so that they are only
+    downloaded by the window that starts at endTS.
+
+    Every key keeps its own pagination cursor. A request starts at the
+    smallest cursor of the unfinished keys, and measurements below a key's own
+    cursor are dropped, so no rows are duplicated or lost at page boundaries.
+    A key drops out of the batch once it returns no new measurements, or, for
+    raw data, fewer measurements than the page limit (the ThingsBoard limit
+    applies per key, so the key is exhausted up to endTS).
+    With a page_sizer, the limit of every request is taken from it and every
+    response that was not served from the HTTP page cache is reported back
+    to it.
+    """
+    limit = config["download"]["limit"] or 1000
+    aggregation = config["download"]["aggregation"]
+    cursors: Dict[str, int] = {key: startTS[key] for key in keys}
+    text_keys = get_text_keys()
+
+    # Download until every key of the batch is finished
+    while cursors:
+        with span("page", device_id=device_id,
+                  keys=len(cursors)) as page_args:
+            request_start = min(cursors.values())
+            if page_sizer is not None:
+                limit = page_sizer.get(device_id)
+            response_info: Dict[str, Any] = {}
+            try:
+                with timed("fetch"):
+                    body = get_telemetry_body(
+                        jwt_token=jwt_token,
+                        device_id=device_id,
+                        keys=list(cursors),
+                        startTS=request_start,
+                        endTS=endTS,
+                        agg=aggregation,
+                        interval=config["download"]["interval"],
+                        limit=limit,
+                        orderBy="ASC",
+                        session=session,
+                        response_info=response_info)
+            except Exception:
+                if page_sizer is not None:
+                    page_sizer.observe_error(device_id, limit)
+                raise
+
+            with timed("convert"):
+                df_raw = read_telemetry_json(body)
+                del body
+                # Measurements per key in the response, and the new
+                # measurements from the cursor of each key on
+                response_rows = dict(df_raw.group_by("key").len().iter_rows())
+                cursor = pl.col("key").replace_strict(cursors,
+                                                      return_dtype=pl.Int64)
+                df_new = df_raw.filter(pl.col("ts") >= cursor)
+                if end_exclusive:
+                    df_new = df_new.filter(pl.col("ts") < endTS)
+                last_ts = dict(
+                    df_new.group_by("key").agg(pl.col("ts").max()).iter_rows())
+
+            # Cached responses say nothing about the server's latency
+            if page_sizer is not None and not response_info.get("cached"):
+                page_sizer.observe(device_id, limit,
+                                   max(response_rows.values(), default=0),
+                                   response_info["latency_s"],
+                                   response_info["bytes"])
+
+            for key in list(cursors):
+                if key in last_ts:
+                    # Continue after the last timestamp of this key
+                    cursors[key] = last_ts[key] + 1
+
+                exhausted = aggregation in (
+                    None, "NONE") and response_rows.get(key, 0) < limit
+                if exhausted or (key not in last_ts
+                                 and cursors[key] == request_start):
+                    del cursors[key]
+
+            page_rows = df_new.height
+            page_args.update(limit=limit,
+                             bytes=response_info.get("bytes"),
+                             cached=bool(response_info.get("cached")),
+                             rows=page_rows)
+            observe("page_rows", page_rows, ROWS_BUCKETS, device_id=device_id)
+            increment("rows_downloaded", page_rows, device_id=device_id)
+
+            if page_rows:
+                with timed("convert"):
+                    df_page = convert_telemetry_values(df_new, text_keys)
+                handle_page(df_page, cursors)
+
+
+def get_streaming_settings() -> Tuple[bool, int]:
+    """
+    Return whether streaming mode is enabled and its memory budget in MB.
+    In streaming mode, downloaded pages are spilled to a staging area on disk
+    and pivoted lazily in time slices that fit into the memory budget.
+    """
+    streaming = bool(config["download"].get("streaming"))
+    memory_budget_mb = config["download"].get("memory_budget_mb") or 1024
+    return streaming, memory_budget_mb
+
+
+def get_checkpoint_pages() -> int:
+    """Return after how many pages a download task saves its progress."""
+    return config["download"].get("checkpoint_pages") or 100
+
+
+class SavedData(NamedTuple):
+    """
+    The earliest timestamp of a save, and the latest timestamp and the
+    number of rows of every key.
+    """
+    min_ts: int
+    key_timestamps: Dict[str, int]
+    key_rows: Dict[str, int]
+
+
+def split_years(df_wide: pl.DataFrame) -> Dict[int, pl.DataFrame]:
+    """Split wide-format data by year in a single pass."""
+    return {
+        year: df_year
+        for (year, ), df_year in df_wide.with_columns(
+            pl.col("datetime").dt.year().alias("_year")).partition_by(
+                "_year", include_key=False, as_dict=True).items()
+    }
+
+
+def save_year_data(device_name: str, df_wide: pl.DataFrame) -> List[SavedData]:
+    """
+    Save wide-format data of a device to the local Parquet files, split by
+    year, and update the rollup tiers (if enabled). Returns what was saved
+    per year, which record_saved_data applies to the watermarks. Raises
+    RuntimeError if a save fails.
+    """
+    saved_data = []
+    for year, df_year in split_years(df_wide).items():
+        data_path = os.path.join(DATA_DIR, str(year))
+        ensure_data_dir(data_path)
+
+        # Hold the device's lock until the rollups are updated, so that they
+        # are always computed from the latest raw data.
+        with span("save", device=device_name, year=year,
+                  rows=df_year.height, columns=df_year.width), \
+                get_device_lock(data_path, device_name):
+            with timed("write"):
+                saved = save_local_data(
+                    path=data_path,
+                    file_name=device_name,
+                    df=df_year,
+                    max_segments=config.get("storage", {}).get(
+                        "max_segments_per_partition"))
+            if not saved:
+                raise RuntimeError(
+                    f"Saving data for device {device_name} in {year} failed.")
+            if get_rollup_tiers():
+                with timed("rollup"):
+                    update_rollups(device_name, year,
+                                   *df_year.select(
+                                       pl.col("ts").min().alias("min_ts"),
+                                       pl.col("ts").max().alias("max_ts")).row(0))
+
+        key_columns = [c for c in df_year.columns if c not in NON_KEY_COLUMNS]
+        saved_data.append(
+            SavedData(
+                df_year.select(pl.col("ts").min()).item(),
+                get_key_timestamps(df_year),
+                df_year.select(pl.col(key_columns).count()).row(0,
+                                                                named=True)))
+    return saved_data
+
+
+def record_saved_data(device_name: str, saved_data: List[SavedData]) -> None:
+    """
+    Advance the device's watermarks, count the rows written and mark the
+    device's hot cache for an update.
+    """
+    for saved in saved_data:
+        update_watermarks(device_name, saved.key_timestamps)
+        mark_changed(device_name, saved.min_ts)
+        for key, rows in saved.key_rows.items():
+            increment("rows_written", rows, device=device_name, key=key)
+
+
+def save_staged_device_data(device_name: str, staging_path: str,
+                            memory_budget_mb: int) -> List[SavedData]:
+    """
+    Pivot the pages of a device staged in staging_path slice by slice and
+    save every slice, then remove the staged pages.
+    """
+    logging.info(f"Performing streaming pivot for device: {device_name}")
+
+    saved_data = []
+    for df_wide in pivot_staged_data(device_name, staging_path,
+                                     memory_budget_mb):
+        saved_data.extend(save_year_data(device_name, df_wide))
+
+    clear_staged_data(staging_path)
+    return saved_data
+
+
+def save_device_data(device_name: str,
+                     df_chunk: List[pl.DataFrame]) -> List[SavedData]:
+    """
+    Pivot the downloaded pages of a device into wide format and save them to
+    the local Parquet files, split by year.
+    """
+    if len(df_chunk) == 0:
+        return []
+
+    logging.info(f"Performing pivot for device: {device_name}")
+
+    with timed("pivot"):
+        df_long = pl.concat(df_chunk)
+
+        # Pivot the DataFrame: index by "ts", columns: "key", values: "value".
+        # This groups rows with the same timestamp into a single row.
+        df_wide=df_long.sort("ts") \
+            .pivot(index="ts", on="key", values="value") \
+            .with_columns(pl.from_epoch("ts", time_unit="ms").alias("datetime")) \
+            .with_columns(pl.lit(device_name).alias("system_name"))
+
+        # Keys stored as strings take their values from the text column
+        if "text" in df_long.columns:
+            df_text = df_long.filter(pl.col("text").is_not_null()) \
+                .pivot(index="ts", on="key", values="text")
+            df_wide = df_wide.drop(df_text.columns[1:]) \
+                .join(df_text, on="ts", how="left")
+
+    # Save the data to a local Parquet file split by year
+    return save_year_data(device_name, df_wide)
+
+
+class DownloadTask(NamedTuple):
+    """Download of a key batch of a device from the keys' startTS to endTS."""
+    task_id: str
+    device_name: str
+    startTS: Dict[str, int]
+    endTS: int
+    end_exclusive: bool
+
+
+def task_to_entry(task: DownloadTask) -> Dict[str, Any]:
+    """Convert a task to its checkpoint journal entry."""
+    return {
+        "device_name": task.device_name,
+        "cursors": task.startTS,
+        "endTS": task.endTS,
+        "end_exclusive": task.end_exclusive
+    }
+
+
+def entry_to_task(task_id: str, entry: Dict[str, Any]) -> DownloadTask:
+    """Convert a checkpoint journal entry back to a task that resumes at the cursors."""
+    return DownloadTask(task_id, entry["device_name"], entry["cursors"],
+                        entry["endTS"], entry["end_exclusive"])
+
+
+class TaskWriter:
+    """
+    Receives the pages of a download task and hands them to the write
+    pipeline every checkpoint_pages pages. After every save, the writer
+    commits the task's cursors to the checkpoint journal, so that an
+    interrupted task resumes right after the last saved page. In streaming
+    mode, the pages are staged on disk between two saves and pivoted lazily
+    in memory-bounded slices. With owns_device, the lease of the device is
+    checked when a save is queued, again right before it is written and
+    before its progress is committed, and a save without the lease fails.
+    """
+
+    def __init__(self,
+                 task: DownloadTask,
+                 journal: CheckpointJournal,
+                 pipeline: WritePipeline,
+                 checkpoint_pages: int,
+                 streaming: bool,
+                 spill_rows: int,
+                 memory_budget_mb: int,
+                 owns_device: Optional[Callable[[str], bool]] = None) -> None:
+        self.task = task
+        self.journal = journal
+        self.pipeline = pipeline
+        self.owns_device = owns_device
+        self.checkpoint_pages = checkpoint_pages
+        self.streaming = streaming
+        self.spill_rows = spill_rows
+        self.memory_budget_mb = memory_budget_mb
+        self.saves: List[Future] = []
+        self.pages: List[pl.DataFrame] = []
+        self.pending_pages = 0
+        self.cursors: Dict[str, int] = dict(task.startTS)
+        self.buffer = self.new_buffer()
+
+    def new_buffer(self) -> StagingBuffer:
+        # Every save gets its own staging folder, because the pages of the
+        # next save are staged while the writer still reads the previous.
+        return StagingBuffer(
+            get_staging_path(self.task.device_name,
+                             f"{self.task.task_id}_{len(self.saves)}"),
+            self.spill_rows)
+
+    def handle_page(self, df: pl.DataFrame, cursors: Dict[str, int]) -> None:
+        if self.streaming:
+            self.buffer.append(df)
+        else:
+            self.pages.append(df)
+        self.cursors = dict(cursors)
+        self.pending_pages += 1
+
+        if self.pending_pages >= self.checkpoint_pages:
+            self.commit()
+
+    def check_lease(self) -> None:
+        """In a distributed run, only the owner of a device's lease saves it."""
+        device_name = self.task.device_name
+        if self.owns_device is not None and not self.owns_device(device_name):
+            raise RuntimeError(f"The lease of device {device_name} was lost.")
+
+    def commit(self) -> None:
+        """Queue a save of the pages received so far and of the task's progress."""
+        # Stop downloading as soon as a previous save of the task failed
+        for save in self.saves:
+            error = save.exception() if save.done() else None
+            if error is not None:
+                raise error
+
+        device_name, task_id = self.task.device_name, self.task.task_id
+        self.check_lease()
+        cursors = self.cursors
+
+        def on_saved(saved_data: List[SavedData]) -> None:
+            record_saved_data(device_name, saved_data)
+            self.check_lease()
+            self.journal.update_task(task_id, cursors)
+
+        after = self.saves[-1] if self.saves else None
+        if self.streaming:
+            self.buffer.flush()
+            save = self.pipeline.submit(device_name,
+                                        save_staged_device_data,
+                                        device_name,
+                                        self.buffer.staging_path,
+                                        self.memory_budget_mb,
+                                        on_done=on_saved,
+                                        after=after,
+                                        before=self.check_lease)
+            self.saves.append(save)
+            self.buffer = self.new_buffer()
+        else:
+            self.saves.append(
+                self.pipeline.submit(device_name,
+                                     save_device_data,
+                                     device_name,
+                                     self.pages,
+                                     on_done=on_saved,
+                                     after=after,
+                                     before=self.check_lease))
+            self.pages = []
+        self.pending_pages = 0
+
+    def finish(self) -> None:
+        """
+        Save the remaining pages, mark the task as complete and wait for
+        all saves of the task. Raises the error of a failed save.
+        """
+        self.cursors = {}
+        self.commit()
+        for save in self.saves:
+            save.result()
+
+
+def get_write_settings() -> Tuple[int, int, int]:
+    """
+    Return the number of writers, the size of every writer's queue (in
+    saves) and the number of write processes (0 writes in the writer
+    threads) of the write pipeline.
+    """
+    writers = config["download"].get("write_workers") or 2
+    queue_size = config["download"].get("write_queue_size") or 2
+    processes = config["download"].get("write_processes") or 0
+    return writers, queue_size, processes
+
+
+def get_page_sizer() -> Optional[PageSizeController]:
+    """
+    Return a controller that tunes the page size per device, if adaptive
+    page sizing is enabled in the config file.
+    """
+    settings = config["download"].get("adaptive_limit") or {}
+    if not settings.get("enabled"):
+        return None
+    return PageSizeController(
+        default_limit=config["download"]["limit"] or 1000,
+        min_limit=settings.get("min_limit") or 100,
+        max_limit=settings.get("max_limit") or 10000,
+        target_latency_s=settings.get("target_latency_s") or 2.0,
+        max_page_mb=settings.get("max_page_mb") or 32)
+
+
+def get_window_settings() -> Tuple[bool, int, int, int]:
+    """
+    Return whether time-window sharding is enabled, the number of buckets of
+    a density probe, how often dense buckets are probed again, and the target
+    number of rows (of the densest key) per window. By default a window holds
+    10 pages.
+    """
+    windows = config["download"].get("windows") or {}
+    limit = config["download"]["limit"] or 1000
+    return (bool(windows.get("enabled")), windows.get("probe_buckets") or 100,
+            windows.get("probe_depth", 2), windows.get("window_rows")
+            or 10 * limit)
+
+
+def plan_device_tasks(
+        jwt_token: str, device_name: str, device_id: str, keys: List[str],
+        session: requests.Session,
+        dry_run: bool) -> Tuple[List[DownloadTask], Tuple[int, int]]:
+    """
+    Plan the download tasks of a device and estimate the number of requests
+    and rows they need.
+
+    The keys are split into batches. With time-window sharding, the range of
+    every batch is additionally split into windows that can be downloaded
+    concurrently; the windows are sized from cheap agg=COUNT density probes.
+    The windows are consecutive and half-open, so stitching them together in
+    order yields no gaps or duplicates at window edges. The probe also runs
+    in dry-run mode to provide the estimate; otherwise the estimate is (0, 0).
+    """
+    sharding, probe_buckets, probe_depth, window_rows = get_window_settings()
+    limit = config["download"]["limit"] or 1000
+
+    startTS, endTS = download_interval(jwt_token, device_name, device_id,
+                                       keys, session)
+
+    tasks = []
+    estimated_requests, estimated_rows = 0, 0
+    for batch in get_key_batches(startTS):
+        batch_start = min(startTS[key] for key in batch)
+        windows = [(batch_start, endTS)]
+
+        if (sharding or dry_run) and batch_start < endTS:
+            buckets = probe_density(jwt_token, device_id, batch, batch_start,
+                                    endTS, probe_buckets, session)
+            buckets = refine_density(jwt_token, device_id, batch, buckets,
+                                     probe_buckets, window_rows, probe_depth,
+                                     session)
+            if sharding:
+                windows = plan_windows(buckets, endTS, window_rows)
+            for window in windows:
+                window_requests, window_rows_estimate = estimate_window(
+                    buckets, window, limit)
+                estimated_requests += window_requests
+                estimated_rows += window_rows_estimate
+
+        for window_start, window_end in windows:
+            window_keys = [
+                key for key in batch if startTS[key] < window_end
+                or window_end == endTS
+            ]
+            if not window_keys:
+                continue
+            tasks.append(
+                DownloadTask(
+                    uuid.uuid4().hex, device_name, {
+                        key: max(startTS[key], window_start)
+                        for key in window_keys
+                    }, window_end, window_end != endTS))
+
+    return tasks, (estimated_requests, estimated_rows)
+
+
+# Plans the tasks of a device: (jwt_token, device_name, device_id, keys,
+# session, dry_run) -> (tasks, (estimated requests, estimated rows))
+Planner = Callable[
+    [str, str, str, List[str], requests.Session, bool],
+    Tuple[List[DownloadTask], Tuple[int, int]]]
+
+
+def download_devices(jwt_token: str,
+                     devices: Dict[str, str],
+                     device_keys: Dict[str, List[str]],
+                     session: requests.Session,
+                     dry_run: bool = False,
+                     resume_only: bool = False,
+                     planner: Planner = plan_device_tasks,
+                     journal: Optional[CheckpointJournal] = None,
+                     owns_device: Optional[Callable[[str], bool]] = None,
+                     pipeline: Optional[WritePipeline] = None) -> Set[str]:
+    """
+    Download the keys of all devices (device_keys maps every device to its
+    keys) concurrently and save the results per device.
+
+    Every (device, key batch, time window) is a separate task on a shared
+    thread pool that is bounded by "max_workers". A semaphore per device
+    additionally bounds the number of tasks of the same device that run at
+    the same time ("max_workers_per_device").
+
+    Every task hands its pages to the write pipeline every
+    "checkpoint_pages" pages and keeps downloading while a writer saves them
+    (see utils/pipeline.py); the writer records the task's per-key cursors
+    in the checkpoint journal (data/checkpoint.json) after every save. If a
+    run is interrupted or a task fails, the data saved so far is kept and
+    the open tasks of the journal are resumed at their cursors at the start
+    of the next run, before new tasks are planned.
+    With resume_only, only the open tasks are resumed.
+    With dry_run, only the planned requests and rows are logged.
+    The tasks of every device are planned by planner (by default from the
+    watermarks to now, see utils/reconcile.py for the alternative).
+
+    Workers of a distributed run pass the journal of their devices and
+    owns_device, which fences every save on the device's lease (see
+    utils/distributed.py). Callers that download repeatedly (the daemon)
+    pass a write pipeline that they keep open between the calls; otherwise
+    a pipeline is created and closed per call. Returns the devices whose
+    download is incomplete.
+    """
+    max_workers, max_workers_per_device = get_concurrency_limits()
+    logging.info(f"Downloading with {max_workers} worker(s), at most "
+                 f"{max_workers_per_device} per device.")
+
+    # In streaming mode, every task spills its pages to disk once it holds
+    # more than its share of a quarter of the memory budget; the rest of the
+    # budget is left for the pivot.
+    streaming, memory_budget_mb = get_streaming_settings()
+    spill_rows = max(
+        1, memory_budget_mb * 1024**2 // (4 * max_workers * BYTES_PER_LONG_ROW))
+    checkpoint_pages = get_checkpoint_pages()
+
+    device_semaphores = {
+        device_name: threading.BoundedSemaphore(max_workers_per_device)
+        for device_name in devices
+    }
+    page_sizer = get_page_sizer()
+    if journal is None:
+        journal = CheckpointJournal()
+    failed: Set[str] = set()
+
+    def plan_task(
+        device_name: str
+    ) -> Optional[Tuple[List[DownloadTask], Tuple[int, int]]]:
+        if not device_keys.get(device_name):
+            return [], (0, 0)
+        try:
+            with span("plan", device=device_name):
+                return planner(jwt_token, device_name, devices[device_name],
+                               device_keys[device_name], session, dry_run)
+        except Exception as e:
+            logging.error(
+                f"Error determining download interval for device: {device_name}"
+            )
+            logging.error(e)
+            return None
+
+    def run_task(task: DownloadTask) -> None:
+        device_id = devices[task.device_name]
+        with device_semaphores[task.device_name], span(
+                "task",
+                device=task.device_name,
+                task_id=task.task_id,
+                keys=list(task.startTS),
+                start_ts=min(task.startTS.values(), default=None),
+                end_ts=task.endTS):
+            writer = TaskWriter(task, journal, write_pipeline, checkpoint_pages,
+                                streaming, spill_rows, memory_budget_mb,
+                                owns_device)
+            download_key_batch(jwt_token, device_id, list(task.startTS),
+                               task.startTS, task.endTS, session,
+                               writer.handle_page, task.end_exclusive,
+                               page_sizer)
+            writer.finish()
+
+    def run_tasks(executor: ThreadPoolExecutor,
+                  device_tasks: Dict[str, List[DownloadTask]]) -> None:
+        # Every device is traced from the submit of its first task to the
+        # end of its last one
+        remaining_tasks = {
+            device_name: len(tasks)
+            for device_name, tasks in device_tasks.items()
+        }
+        for device_name, tasks in device_tasks.items():
+            begin_async("device", device_name, tasks=len(tasks))
+
+        futures: Dict[Future, DownloadTask] = {}
+        # Submit tasks round-robin over the devices, so that the workers are
+        # spread over the devices instead of waiting on one device's semaphore.
+        for round_tasks in zip_longest(*device_tasks.values()):
+            for task in round_tasks:
+                if task is not None:
+                    futures[executor.submit(run_task, task)] = task
+
+        device_failures = len(failed)
+        for future in as_completed(futures):
+            device_name = futures[future].device_name
+            try:
+                future.result()
+            except Exception as e:
+                if device_name not in failed:
+                    logging.error(
+                        f"Error downloading data for device: {device_name}")
+                    logging.error(e)
+                failed.add(device_name)
+            remaining_tasks[device_name] -= 1
+            if remaining_tasks[device_name] == 0:
+                end_async("device",
+                          device_name,
+                          failed=device_name in failed)
+
+        if len(failed) > device_failures:
+            logging.warning(
+                f"Download of {len(failed) - device_failures} device(s) is "
+                f"incomplete, the data saved so far is kept and resumed in "
+                f"the next run.")
+
+    # Remove the staged pages of an interrupted streaming run; their tasks
+    # resume at the last saved page. Only the devices of this call are
+    # cleared, as other processes may be staging other devices.
+    for device_name in devices:
+        clear_staged_data(os.path.join(STAGING_DIR, device_name))
+
+    # The download workers hand the pages to the writers and continue
+    # downloading while the writers save them. Saves that are still queued
+    # are finished before returning.
+    if pipeline is None:
+        writers, queue_size, write_processes = get_write_settings()
+        write_pipeline = WritePipeline(writers, queue_size,
+                                       0 if dry_run else write_processes)
+    else:
+        write_pipeline = pipeline
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Only the open tasks of the devices of this call are resumed; the
+            # journal keeps the others (e.g. of devices a daemon polls later)
+            # unless their device is no longer configured.
+            if not dry_run:
+                journal.remove_devices(list(config["devices"]) + list(devices))
+            open_tasks = {
+                task_id: entry
+                for task_id, entry in journal.get_open_tasks().items()
+                if entry["device_name"] in devices
+            }
+            if open_tasks and not dry_run:
+                resumed_tasks: Dict[str, List[DownloadTask]] = {}
+                for task_id, entry in open_tasks.items():
+                    task = entry_to_task(task_id, entry)
+                    resumed_tasks.setdefault(task.device_name, []).append(task)
+                logging.info(
+                    f"Resuming {sum(len(t) for t in resumed_tasks.values())} "
+                    f"task(s) of an interrupted run.")
+                run_tasks(executor, resumed_tasks)
+            elif resume_only:
+                logging.info("No interrupted run to resume.")
+
+            if resume_only:
+                if page_sizer is not None:
+                    page_sizer.save()
+                return failed
+
+            # Plan the tasks of all devices (including density probes) concurrently
+            device_tasks: Dict[str, List[DownloadTask]] = {}
+            total_requests, total_rows = 0, 0
+            for device_name, plan in zip(devices, executor.map(plan_task,
+                                                               devices)):
+                if plan is None:
+                    failed.add(device_name)
+                    continue
+                tasks, (estimated_requests, estimated_rows) = plan
+                total_requests += estimated_requests
+                total_rows += estimated_rows
+                if dry_run:
+                    logging.info(
+                        f"Plan for device {device_name}: {len(tasks)} task(s), "
+                        f"~{estimated_requests} request(s), ~{estimated_rows} row(s)."
+                    )
+                elif tasks:
+                    device_tasks[device_name] = tasks
+                    logging.info(f"Downloading data for device: {device_name}.")
+                else:
+                    logging.info(f"No data downloaded for device: {device_name}")
+
+            if dry_run:
+                logging.info(
+                    f"Dry run: ~{total_requests} request(s), ~{total_rows} row(s) "
+                    f"in total.")
+                return failed
+
+            journal.add_tasks({
+                task.task_id: task_to_entry(task)
+                for tasks in device_tasks.values() for task in tasks
+            })
+            run_tasks(executor, device_tasks)
+    finally:
+        if pipeline is None:
+            write_pipeline.close()
+        else:
+            write_pipeline.wait()
+        update_hot_caches()
+
+    # Remember the tuned page sizes for the next run
+    if page_sizer is not None:
+        page_sizer.save()
+    return failed
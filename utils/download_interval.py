@@ -1,41 +1,52 @@
 from datetime import datetime
-import os
 import time
 import logging
 import requests
-from typing import Tuple
+from typing import Dict, List, Tuple
 
 from utils.thingsboard_api import get_earliest_thingsboard_timestamp
-from utils.data_files import get_latest_local_timestamp_across_years
+from utils.watermarks import get_device_watermarks
 from utils.config_files import load_json_config
-from utils.paths import DATA_DIR
 
 config = load_json_config("config.json")
 
 
 def download_interval(jwt_token: str, device_name: str, device_id: str,
-                      session: requests.Session) -> Tuple[int, int]:
+                      keys: List[str],
+                      session: requests.Session) -> Tuple[Dict[str, int], int]:
+    """
+    Return the start timestamp of every key and the end timestamp for
+    downloading data of a device.
 
-    # search for the latest timestamp across all year folders.
-    latest_local_ts = get_latest_local_timestamp_across_years(
-        device_name, DATA_DIR)
+    Every key starts at its own watermark, the latest timestamp downloaded
+    for it. Keys without a watermark start at the device's latest watermark,
+    or at the earliest ThingsBoard timestamp if the device has no local data.
+    """
 
-    if latest_local_ts is None:
+    # latest downloaded timestamp per key from the watermark index.
+    watermarks = get_device_watermarks(device_name, keys)
+
+    if not watermarks:
         cloud_earliest_ts = get_earliest_thingsboard_timestamp(
             jwt_token=jwt_token, device_id=device_id, session=session)
     else:
         cloud_earliest_ts = None
 
     # start timestamp for downloading data
-    startTS: int = latest_local_ts or cloud_earliest_ts or 0
+    device_startTS: int = max(watermarks.values(),
+                              default=None) or cloud_earliest_ts or 0
 
     config_start_ts = config["download"]["start_unix_ms"]
-    if config_start_ts and config_start_ts > startTS:
-        startTS = config_start_ts
-
-    formatted_time = datetime.fromtimestamp(startTS /
-                                            1000).strftime("%Y-%m-%d %H:%M:%S")
-    logging.info(f"Timestamp to start downloading from: {formatted_time}")
+    startTS: Dict[str, int] = {}
+    for key in keys:
+        startTS[key] = watermarks.get(key, device_startTS)
+        if config_start_ts and config_start_ts > startTS[key]:
+            startTS[key] = config_start_ts
+
+    if startTS:
+        formatted_time = datetime.fromtimestamp(
+            min(startTS.values()) / 1000).strftime("%Y-%m-%d %H:%M:%S")
+        logging.info(f"Timestamp to start downloading from: {formatted_time}")
 
     # end timestamp for downloading data
     endTS = int(time.time() * 1000)
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import logging
+import threading
+import polars as pl
+from typing import Dict, List, Optional, Tuple
+
+from .query import scan_local_data
+from .watermarks import NON_KEY_COLUMNS
+from .metrics import timed, write_atomic
+from .config_files import load_json_config
+from .paths import HOT_CACHE_DIR
+
+config = load_json_config("config.json")
+
+# The hot cache keeps the most recent days of every device in an
+# uncompressed Arrow IPC (Feather v2) file next to the Parquet archive:
+#
+#   data/hot/<device>.arrow
+#   data/hot/index.json   {"<device>": {"start_ts": ..., "days": ...,
+#                                         "updated_at": ...}}
+#
+# Readers memory-map the files, so reading recent data neither decompresses
+# nor copies anything. The index records from which timestamp on a cache
+# holds all stored data of its device.
+#
+# After every download, the caches of the devices that received data are
+# updated: cached rows before the earliest saved timestamp are kept, the
+# rest is read again from the archive, and days older than "days" are
+# dropped. If a cache exceeds "max_mb_per_device", its oldest days are
+# evicted until it fits. Every update replaces the file atomically, and
+# readers that still map the previous file keep reading it unchanged.
+
+DAY_MS = 86400000
+HOT_CACHE_INDEX_FILE = os.path.join(HOT_CACHE_DIR, "index.json")
+
+# Earliest saved timestamp per device since the last update of its cache
+changed_devices: Dict[str, int] = {}
+changed_devices_lock = threading.Lock()
+
+
+def get_hot_cache_settings() -> Optional[Tuple[int, int]]:
+    """
+    Return the number of days to cache and the maximum cache size per device
+    in bytes, or None if the hot cache is disabled.
+    """
+    settings = config.get("hot_cache") or {}
+    if not settings.get("enabled"):
+        return None
+    days = settings.get("days") or 7
+    max_mb = settings.get("max_mb_per_device") or 256
+    return days, int(max_mb * 1024**2)
+
+
+def get_hot_cache_path(device_name: str) -> str:
+    return os.path.join(HOT_CACHE_DIR, f"{device_name}.arrow")
+
+
+def load_hot_cache_index() -> Dict[str, Dict[str, int]]:
+    if not os.path.exists(HOT_CACHE_INDEX_FILE):
+        return {}
+    with open(HOT_CACHE_INDEX_FILE, 'r') as f:
+        return json.load(f)
+
+
+def read_hot_cache(device_name: str,
+                   start_ts: Optional[int] = None,
+                   keys: Optional[List[str]] = None) -> Optional[pl.DataFrame]:
+    """
+    Return the cached recent data of a device (from start_ts on, with the
+    given keys), memory-mapped without copying, or None if the device has
+    no cache or start_ts lies before the cached range.
+    """
+    file_path = get_hot_cache_path(device_name)
+    entry = load_hot_cache_index().get(device_name)
+    if entry is None or not os.path.exists(file_path):
+        return None
+    if start_ts is not None and start_ts < entry["start_ts"]:
+        return None
+
+    df = pl.read_ipc(file_path, memory_map=True)
+    if start_ts is not None:
+        # The rows are sorted by ts, so the filter is a zero-copy slice
+        df = df.slice(df["ts"].search_sorted(start_ts, side="left"))
+    if keys is not None:
+        df = df.select(
+            [c for c in [*NON_KEY_COLUMNS, *keys] if c in df.columns])
+    return df
+
+
+def mark_changed(device_name: str, min_ts: int) -> None:
+    """Record that data of a device from min_ts on was saved."""
+    with changed_devices_lock:
+        changed_devices[device_name] = min(
+            min_ts, changed_devices.get(device_name, min_ts))
+
+
+def evict_old_days(df: pl.DataFrame, start_ts: int,
+                   max_bytes: int) -> Tuple[pl.DataFrame, int]:
+    """
+    Drop the oldest days of a cache until its estimated size fits into
+    max_bytes. Returns the remaining rows and the new start of the cache.
+    """
+    size = df.estimated_size()
+    if size <= max_bytes or df.height == 0:
+        return df, start_ts
+    bytes_per_row = size / df.height
+    days = df.group_by((pl.col("ts") // DAY_MS * DAY_MS).alias("day")) \
+        .len().sort("day", descending=True)
+
+    # Keep the newest days that fit into the budget
+    rows = 0
+    for day, day_rows in days.iter_rows():
+        if (rows + day_rows) * bytes_per_row > max_bytes:
+            start_ts = day + DAY_MS
+            break
+        rows += day_rows
+    return df.filter(pl.col("ts") >= start_ts), start_ts
+
+
+def update_hot_caches() -> None:
+    """Update the caches of all devices that received data since the last update."""
+    settings = get_hot_cache_settings()
+    with changed_devices_lock:
+        changes = dict(changed_devices)
+        changed_devices.clear()
+    if settings is None or not changes:
+        return
+    days, max_bytes = settings
+    os.makedirs(HOT_CACHE_DIR, exist_ok=True)
+    index = load_hot_cache_index()
+    now = int(time.time() * 1000)
+    cutoff = (now - days * DAY_MS) // DAY_MS * DAY_MS
+
+    entries: Dict[str, Optional[Dict[str, int]]] = {}
+    for device_name, changed_from in changes.items():
+        with timed("hot_cache"):
+            try:
+                entries[device_name] = update_hot_cache(
+                    device_name, index.get(device_name), changed_from,
+                    cutoff, days, max_bytes, now)
+            except Exception as e:
+                logging.error(
+                    f"Error updating the hot cache of device {device_name}: {e}")
+                entries[device_name] = None
+
+    # Other processes may have updated the caches of other devices meanwhile
+    index = load_hot_cache_index()
+    for device_name, entry in entries.items():
+        if entry is None:
+            index.pop(device_name, None)
+        else:
+            index[device_name] = entry
+    write_atomic(HOT_CACHE_INDEX_FILE, json.dumps(index, indent=4))
+
+
+def update_hot_cache(device_name: str, entry: Optional[Dict[str, int]],
+                     changed_from: int, cutoff: int, days: int,
+                     max_bytes: int, now: int) -> Dict[str, int]:
+    """Rewrite the cache of one device and return its new index entry."""
+    file_path = get_hot_cache_path(device_name)
+    frames = []
+    read_from, start_ts = cutoff, cutoff
+    if entry is not None and entry.get("days") == days and os.path.exists(
+            file_path):
+        # Keep the cached rows before the first changed timestamp
+        read_from = max(cutoff, changed_from)
+        start_ts = max(cutoff, min(entry["start_ts"], read_from))
+        frames.append(
+            pl.read_ipc(file_path, memory_map=False).filter(
+                (pl.col("ts") >= cutoff) & (pl.col("ts") < read_from)))
+    frames.append(scan_local_data([device_name], start_ts=read_from).collect())
+
+    df = pl.concat(frames, how="diagonal_relaxed").sort("ts")
+    df, evicted_ts = evict_old_days(df, start_ts, max_bytes)
+    if evicted_ts > start_ts:
+        logging.warning(
+            f"Hot cache of device {device_name} exceeds its size limit, "
+            f"evicted the data before {evicted_ts}.")
+
+    df.write_ipc(f"{file_path}.tmp", compression="uncompressed")
+    os.replace(f"{file_path}.tmp", file_path)
+    logging.info(f"Updated the hot cache of device {device_name} "
+                 f"({df.height} rows).")
+    return {"start_ts": evicted_ts, "days": days, "updated_at": now}
@@ -0,0 +1,347 @@
+import os
+import gzip
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from .metrics import increment
+from .config_files import load_json_config
+from .paths import HTTP_CACHE_DIR
+
+config = load_json_config("config.json")
+
+# The HTTP page cache stores the gzipped bodies of telemetry responses whose
+# time range ended more than "immutable_after_days" ago, as historical data
+# on ThingsBoard practically never changes:
+#
+#   data/http_cache/<first 2 hex digits>/<sha256 of the request>.json.gz
+#
+# A response is identified by the host, device, keys, startTs, endTs, agg,
+# interval and orderBy of its request. The first line of every file holds
+# these parameters and the limit of the request, the body follows.
+#
+# The limit is not part of the key, because adaptive page sizes change it
+# from run to run, and with it the startTs of every later page. A raw
+# (not aggregated) request in ascending order is answered from the cached
+# pages of the same device whose range [startTs, endTs) overlaps it: a page
+# with fewer measurements of a key than its limit holds all of them up to
+# its endTs, otherwise all of them up to its last one. Every key of the
+# request is followed through these pages until its first "limit"
+# measurements from startTs, or all of them up to endTs, are found (see
+# slice_body). An aggregated request is served from a page with the same
+# range, whatever its limit, as the downloader continues after the last
+# returned interval.
+#
+# The cache holds at most "max_mb" of compressed bodies; beyond that, the
+# least recently used ones are deleted. The last use of a body is its
+# file's modification time, so the order survives restarts.
+
+
+class CacheEntry(NamedTuple):
+    size: int
+    series: str
+    keys: Tuple[str, ...]
+    start_ts: int
+    end_ts: int
+    limit: Optional[int]
+
+
+def get_cache_key(host: str, device_id: str, params: Dict[str, Any]) -> str:
+    """Hash the request parameters that identify a cached response."""
+    request = [
+        host, device_id,
+        *(params.get(name) for name in ("keys", "startTs", "endTs", "agg",
+                                        "interval", "orderBy"))
+    ]
+    return hashlib.sha256(json.dumps(request).encode()).hexdigest()
+
+
+def get_series_key(host: str, device_id: str, params: Dict[str, Any]) -> str:
+    """Hash the request parameters that cached responses must share to be reused."""
+    request = [
+        host, device_id,
+        *(params.get(name) for name in ("agg", "interval", "orderBy"))
+    ]
+    return hashlib.sha256(json.dumps(request).encode()).hexdigest()
+
+
+def is_aggregated(params: Dict[str, Any]) -> bool:
+    return params.get("agg") not in (None, "NONE")
+
+
+def is_sliceable(params: Dict[str, Any]) -> bool:
+    """Whether a request can be answered from slices of other cached pages."""
+    return (not is_aggregated(params) and params.get("orderBy") == "ASC"
+            and params.get("limit") is not None)
+
+
+def slice_body(pages: Dict[str, CacheEntry],
+               read_page: Callable[[str], Optional[Dict[str, Any]]],
+               params: Dict[str, Any]) -> Optional[bytes]:
+    """
+    Return the response to a raw request in ascending order from the
+    cached pages of the same device (read_page returns the decoded body of
+    a page), or None if they do not cover it.
+
+    Every key is followed from startTs through the pages: the page that
+    started closest before the key's position holds all measurements up to
+    its endTs (exclusive) if it returned fewer than its limit, otherwise up
+    to its last one. Its measurements up to there are taken, and the next
+    page continues after them, until "limit" measurements are found or
+    endTs (exclusive) is reached.
+    """
+    limit = params["limit"]
+    start_ts, end_ts = params["startTs"], params["endTs"]
+    sliced: Dict[str, List[Dict[str, Any]]] = {}
+    for key in params["keys"].split(","):
+        selected: List[Dict[str, Any]] = []
+        position = start_ts
+        while len(selected) < limit and position < end_ts:
+            candidates = sorted(
+                (entry.start_ts, page_key, entry.end_ts, entry.limit)
+                for page_key, entry in pages.items()
+                if key in entry.keys and entry.limit is not None and entry.limit > 0
+                and entry.start_ts <= position < entry.end_ts)
+            for _, page_key, page_end_ts, page_limit in reversed(candidates):
+                data = read_page(page_key)
+                if data is None:
+                    continue
+                measurements = data.get(key, [])
+                # The page holds all measurements of the key before covered
+                covered = page_end_ts if len(
+                    measurements) < page_limit else measurements[-1]["ts"] + 1
+                if covered <= position:
+                    continue
+                until = min(covered, end_ts)
+                selected.extend(measurement for measurement in measurements
+                                if position <= measurement["ts"] < until)
+                position = until
+                break
+            else:
+                return None
+        if selected:
+            sliced[key] = selected[:limit]
+    return json.dumps(sliced).encode()
+
+
+class HttpPageCache:
+    """
+    LRU cache of compressed response bodies on disk, safe to use from
+    several threads. The entries on disk are indexed on first use.
+    """
+
+    def __init__(self, folder: str, max_bytes: int,
+                 immutable_after_ms: int) -> None:
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.immutable_after_ms = immutable_after_ms
+        self.lock = threading.Lock()
+        # Entry per cache key, from least to most recently used
+        self.entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self.indexed = False
+        # Cache keys per series, to find the pages that may cover a request
+        self.series: Dict[str, Set[str]] = {}
+        self.total_bytes = 0
+        # Only store responses, e.g. to refresh the cache from ThingsBoard
+        self.skip_reads = False
+
+    def load_entries(self) -> "OrderedDict[str, CacheEntry]":
+        """
+        Index the cached files by their last use and evict the least
+        recently used if max_mb was lowered (lock held). Files without a
+        readable header (e.g. of an older version) are deleted.
+        """
+        if not self.indexed:
+            files = []
+            if os.path.isdir(self.folder):
+                for root, _, names in os.walk(self.folder):
+                    for name in names:
+                        if not name.endswith(".json.gz"):
+                            continue
+                        file_path = os.path.join(root, name)
+                        try:
+                            stat = os.stat(file_path)
+                            with gzip.open(file_path, 'rb') as f:
+                                header = json.loads(f.readline())
+                            entry = CacheEntry(stat.st_size, header["series"],
+                                               tuple(header["keys"]),
+                                               header["startTs"],
+                                               header["endTs"], header["limit"])
+                        except (OSError, EOFError, ValueError, KeyError,
+                                TypeError) as e:
+                            logging.warning(f"Removing unreadable cached "
+                                            f"response {file_path}: {e}")
+                            self.delete_path(file_path)
+                            continue
+                        files.append(
+                            (stat.st_mtime, name[:-len(".json.gz")], entry))
+            for _, key, entry in sorted(files):
+                self.add_entry(key, entry)
+            self.indexed = True
+            self.evict()
+        return self.entries
+
+    def add_entry(self, key: str, entry: CacheEntry) -> None:
+        """Index an entry as the most recently used (lock held)."""
+        self.pop_entry(key)
+        self.entries[key] = entry
+        self.series.setdefault(entry.series, set()).add(key)
+        self.total_bytes += entry.size
+
+    def pop_entry(self, key: str) -> Optional[CacheEntry]:
+        """Remove an entry from the index (lock held)."""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
+            self.series[entry.series].discard(key)
+            if not self.series[entry.series]:
+                del self.series[entry.series]
+        return entry
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.folder, key[:2], f"{key}.json.gz")
+
+    def is_cacheable(self, endTS: Optional[int]) -> bool:
+        """Whether a request up to endTS only returns immutable data."""
+        return endTS is not None and endTS <= int(
+            time.time() * 1000) - self.immutable_after_ms
+
+    def get_pages(self, host: str, device_id: str,
+                  params: Dict[str, Any]) -> Dict[str, CacheEntry]:
+        """
+        Return the cached pages of the same device, aggregation and order
+        that overlap the range of a request and hold one of its keys (lock
+        held).
+        """
+        entries = self.load_entries()
+        keys = set(params["keys"].split(","))
+        return {
+            page_key: entries[page_key]
+            for page_key in self.series.get(
+                get_series_key(host, device_id, params), ())
+            if entries[page_key].start_ts < params["endTs"]
+            and entries[page_key].end_ts > params["startTs"]
+            and not keys.isdisjoint(entries[page_key].keys)
+        }
+
+    def read(self, key: str) -> Optional[bytes]:
+        """Return the cached body of a key, or None if it cannot be read."""
+        try:
+            with open(self.get_path(key), 'rb') as f:
+                _, body = gzip.decompress(f.read()).split(b"\n", 1)
+            os.utime(self.get_path(key))
+        except (OSError, EOFError, ValueError) as e:
+            logging.warning(f"Error reading cached response {key}: {e}")
+            self.remove(key)
+            return None
+        with self.lock:
+            if key in self.load_entries():
+                self.load_entries().move_to_end(key)
+        return body
+
+    def get(self, host: str, device_id: str,
+            params: Dict[str, Any]) -> Optional[bytes]:
+        """Return the response to a request from the cache, or None on a miss."""
+        if self.skip_reads:
+            return None
+        key = get_cache_key(host, device_id, params)
+        with self.lock:
+            entry = self.load_entries().get(key)
+        # The page of the same request. The limit of an aggregated request
+        # only bounds the intervals of a page.
+        if entry is not None and (is_aggregated(params)
+                                  or entry.limit == params.get("limit")):
+            body = self.read(key)
+            if body is not None or not is_sliceable(params):
+                return body
+        if not is_sliceable(params):
+            return None
+
+        with self.lock:
+            pages = self.get_pages(host, device_id, params)
+        bodies: Dict[str, Optional[Dict[str, Any]]] = {}
+
+        def read_page(page_key: str) -> Optional[Dict[str, Any]]:
+            if page_key not in bodies:
+                body = self.read(page_key)
+                bodies[page_key] = None if body is None else json.loads(body)
+            return bodies[page_key]
+
+        return slice_body(pages, read_page, params)
+
+    def put(self, host: str, device_id: str, params: Dict[str, Any],
+            body: bytes) -> None:
+        """Store the body of a request and evict the least recently used."""
+        key = get_cache_key(host, device_id, params)
+        header = {
+            "series": get_series_key(host, device_id, params),
+            "keys": params["keys"].split(","),
+            "startTs": params["startTs"],
+            "endTs": params["endTs"],
+            "limit": params.get("limit")
+        }
+        file_path = self.get_path(key)
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            tmp_file = f"{file_path}.{threading.get_ident()}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(
+                    gzip.compress(json.dumps(header).encode() + b"\n" + body))
+            os.replace(tmp_file, file_path)
+            size = os.path.getsize(file_path)
+        except OSError as e:
+            # The response is still used, only the next run downloads it again
+            logging.warning(f"Error caching response {key}: {e}")
+            return
+
+        with self.lock:
+            self.load_entries()
+            self.add_entry(
+                key,
+                CacheEntry(size, header["series"], tuple(header["keys"]),
+                           header["startTs"], header["endTs"],
+                           header["limit"]))
+            self.evict()
+
+    def evict(self) -> None:
+        """Delete the least recently used bodies until they fit (lock held)."""
+        evicted = 0
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            old_key = next(iter(self.entries))
+            self.pop_entry(old_key)
+            self.delete_path(self.get_path(old_key))
+            evicted += 1
+        if evicted:
+            increment("http_cache_evictions", evicted)
+
+    def remove(self, key: str) -> None:
+        with self.lock:
+            self.load_entries()
+            self.pop_entry(key)
+        self.delete_path(self.get_path(key))
+
+    def delete_path(self, file_path: str) -> None:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+
+def create_page_cache() -> Optional[HttpPageCache]:
+    """Create the page cache from the config file, or None if it is disabled."""
+    settings = config.get("http_cache") or {}
+    if not settings.get("enabled"):
+        return None
+    max_mb = settings.get("max_mb") or 1024
+    immutable_after_days = settings.get("immutable_after_days")
+    if immutable_after_days is None:
+        immutable_after_days = 7
+    return HttpPageCache(HTTP_CACHE_DIR, int(max_mb * 1024**2),
+                         int(immutable_after_days * 86400000))
+
+
+page_cache = create_page_cache()
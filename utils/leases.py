@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import logging
+import threading
+from typing import Any, Dict, Iterable, NamedTuple, Optional
+
+# Device leases of a distributed run, in a folder on storage that all
+# workers share:
+#
+#   <lease dir>/<run id>/<device>/<generation>.json
+#       {"owner": "<worker id>", "state": "running", "expires_at": ...}
+#
+# The lease file with the highest generation is the current lease of a
+# device. A worker claims a device by creating the next generation, which
+# only succeeds for one worker because the file is created with os.link (an
+# atomic, exclusive create that also works on network file systems). The
+# next generation may only be created while the current lease is expired,
+# so a device is taken over once its owner stopped renewing the lease. The
+# owner renews its lease by replacing the content of its own generation;
+# it has lost the lease as soon as a higher generation exists.
+#
+# Leases end in the state "done" or "failed", which no worker takes over.
+# expires_at is a wall-clock timestamp, so the clocks of the hosts have to
+# be synchronized (e.g. by NTP) to well within the lease duration.
+
+FINAL_STATES = ("done", "failed")
+
+
+class Lease(NamedTuple):
+    generation: int
+    owner: str
+    state: str
+    expires_at: float
+
+
+class LeaseManager:
+    """
+    Claims, renews and releases the device leases of one worker. A
+    background thread renews all held leases every third of ttl_s.
+    """
+
+    def __init__(self, run_dir: str, worker_id: str, ttl_s: float) -> None:
+        self.run_dir = run_dir
+        self.worker_id = worker_id
+        self.ttl_s = ttl_s
+        # Serializes the renewals of the lease renewal thread and the worker
+        self.lock = threading.RLock()
+        # Generation and expiry of every lease held by this worker
+        self.held: Dict[str, Lease] = {}
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.renew_leases,
+                                       name="lease-renewal",
+                                       daemon=True)
+
+    def start(self) -> None:
+        os.makedirs(self.run_dir, exist_ok=True)
+        self.thread.start()
+
+    def close(self) -> None:
+        self.stop.set()
+        self.thread.join()
+
+    def get_device_dir(self, device_name: str) -> str:
+        return os.path.join(self.run_dir, device_name)
+
+    def get_lease_path(self, device_name: str, generation: int) -> str:
+        return os.path.join(self.get_device_dir(device_name),
+                            f"{generation}.json")
+
+    def read_lease(self, device_name: str) -> Optional[Lease]:
+        """Return the current lease of a device, or None if it has none."""
+        device_dir = self.get_device_dir(device_name)
+        while os.path.isdir(device_dir):
+            generations = [
+                int(name[:-len(".json")]) for name in os.listdir(device_dir)
+                if name.endswith(".json") and name[:-len(".json")].isdigit()
+            ]
+            if not generations:
+                return None
+            generation = max(generations)
+            try:
+                with open(self.get_lease_path(device_name, generation),
+                          'r') as f:
+                    entry = json.load(f)
+            except FileNotFoundError:
+                # Removed by a new owner after it claimed a newer generation
+                continue
+            return Lease(generation, entry["owner"], entry["state"],
+                         entry["expires_at"])
+        return None
+
+    def write_lease(self, path: str, lease: Lease, exclusive: bool) -> None:
+        """
+        Write a lease file. With exclusive, raises FileExistsError if the
+        file exists, otherwise its content is replaced atomically.
+        """
+        entry: Dict[str, Any] = {
+            "owner": lease.owner,
+            "state": lease.state,
+            "expires_at": lease.expires_at
+        }
+        tmp_file = f"{path}.{self.worker_id}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        try:
+            if exclusive:
+                os.link(tmp_file, path)
+            else:
+                os.replace(tmp_file, path)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def claim(self, device_name: str) -> bool:
+        """
+        Claim a device that has no lease or whose lease expired. Returns
+        whether this worker holds the lease now.
+        """
+        current = self.read_lease(device_name)
+        if current is not None:
+            if current.state in FINAL_STATES:
+                return False
+            if current.owner == self.worker_id and device_name in self.held:
+                return True
+            if current.expires_at > time.time():
+                return False
+            logging.warning(
+                f"Lease of device {device_name} held by {current.owner} "
+                f"expired, taking the device over.")
+
+        lease = Lease(0 if current is None else current.generation + 1,
+                      self.worker_id, "running",
+                      time.time() + self.ttl_s)
+        os.makedirs(self.get_device_dir(device_name), exist_ok=True)
+        try:
+            self.write_lease(self.get_lease_path(device_name,
+                                                 lease.generation),
+                             lease,
+                             exclusive=True)
+        except FileExistsError:
+            # Another worker claimed the same generation first
+            return False
+        with self.lock:
+            self.held[device_name] = lease
+
+        # Older generations are no longer needed
+        for generation in range(lease.generation):
+            try:
+                os.remove(self.get_lease_path(device_name, generation))
+            except FileNotFoundError:
+                pass
+        return True
+
+    def is_current(self, device_name: str, lease: Lease) -> bool:
+        current = self.read_lease(device_name)
+        return current is not None and current.generation == lease.generation
+
+    def owns(self, device_name: str) -> bool:
+        """
+        Whether this worker still holds the lease of a device: its lease is
+        the current one and has not expired.
+        """
+        with self.lock:
+            lease = self.held.get(device_name)
+        return (lease is not None and lease.expires_at > time.time()
+                and self.is_current(device_name, lease))
+
+    def renew(self, device_name: str, state: str = "running") -> bool:
+        """
+        Extend the lease of a device (or set its final state). Returns
+        False and forgets the lease if another worker took the device over.
+        """
+        with self.lock:
+            lease = self.held.get(device_name)
+            if lease is None:
+                return False
+            if not self.is_current(device_name, lease):
+                del self.held[device_name]
+                logging.error(f"Lost the lease of device {device_name}.")
+                return False
+            lease = lease._replace(state=state,
+                                   expires_at=time.time() + self.ttl_s)
+            self.write_lease(self.get_lease_path(device_name,
+                                                 lease.generation),
+                             lease,
+                             exclusive=False)
+            if state in FINAL_STATES:
+                del self.held[device_name]
+            else:
+                self.held[device_name] = lease
+        return True
+
+    def release(self, device_name: str, state: str) -> bool:
+        """
+        Mark the lease of a device as "done" or "failed". Returns False if
+        another worker took the device over.
+        """
+        return self.renew(device_name, state)
+
+    def forget(self, device_name: str) -> None:
+        """
+        Stop renewing the lease of a device, e.g. after its release failed,
+        so that it expires and another worker takes the device over.
+        """
+        with self.lock:
+            self.held.pop(device_name, None)
+
+    def renew_leases(self) -> None:
+        while not self.stop.wait(self.ttl_s / 3):
+            with self.lock:
+                device_names = list(self.held)
+            for device_name in device_names:
+                try:
+                    self.renew(device_name)
+                except OSError as e:
+                    logging.error(
+                        f"Error renewing the lease of device {device_name}: {e}")
+
+    def get_states(self,
+                   device_names: Iterable[str]) -> Dict[str, Optional[str]]:
+        """Return the lease state of every device (None without a lease)."""
+        states: Dict[str, Optional[str]] = {}
+        for device_name in device_names:
+            lease = self.read_lease(device_name)
+            states[device_name] = None if lease is None else lease.state
+        return states
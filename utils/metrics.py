@@ -0,0 +1,264 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+
+from .tracing import span
+
+# Run metrics of the downloader:
+#
+# - stage timers: the time spent in the stages "fetch" (telemetry requests),
+#   "convert" (JSON to DataFrame), "pivot" (long to wide format) and "write"
+#   (saving to Parquet). Stages run concurrently on the worker threads, so
+#   the times are summed over all threads and can exceed the wall time.
+# - counters, e.g. requests by status, retries, bytes received and rows
+#   written per device and key.
+# - histograms, e.g. of the request latency and the rows per page.
+#
+# Every metric has a name and optional labels. At the end of a run, the
+# metrics are written as JSON report and as Prometheus textfile (for the
+# node_exporter textfile collector).
+
+PROMETHEUS_PREFIX = "thingsboard_downloader"
+
+LATENCY_BUCKETS_S = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                     10.0, 30.0, 60.0)
+ROWS_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Counts of observations per bucket (upper bounds), plus their sum."""
+
+    def __init__(self, bounds: Sequence[float]) -> None:
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> List[Tuple[str, int]]:
+        """Return the cumulative count per upper bound, ending with "+Inf"."""
+        result = []
+        total = 0
+        for bound, count in zip([*map(str, self.bounds), "+Inf"],
+                                self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+metrics_lock = threading.Lock()
+counters: Dict[Tuple[str, Labels], float] = {}
+histograms: Dict[Tuple[str, Labels], Histogram] = {}
+
+
+def get_labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def increment(name: str, value: float = 1, **labels: Any) -> None:
+    """Add value to a counter."""
+    metric = (name, get_labels(labels))
+    with metrics_lock:
+        counters[metric] = counters.get(metric, 0) + value
+
+
+def observe(name: str, value: float, bounds: Sequence[float],
+            **labels: Any) -> None:
+    """Add an observation to a histogram with the given bucket bounds."""
+    metric = (name, get_labels(labels))
+    with metrics_lock:
+        if metric not in histograms:
+            histograms[metric] = Histogram(bounds)
+        histograms[metric].observe(value)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """
+    Add the time spent in the with-block to the given stage (and record it
+    as span if tracing is enabled).
+    """
+    start = time.perf_counter()
+    try:
+        with span(stage, cat="stage"):
+            yield
+    finally:
+        observe("stage_seconds",
+                time.perf_counter() - start,
+                LATENCY_BUCKETS_S,
+                stage=stage)
+
+
+def reset_metrics() -> None:
+    """Remove all counters and histograms."""
+    with metrics_lock:
+        counters.clear()
+        histograms.clear()
+
+
+def get_stage_times() -> Dict[str, float]:
+    """Return the total time spent per stage in seconds."""
+    with metrics_lock:
+        return {
+            dict(labels)["stage"]: histogram.sum
+            for (name, labels), histogram in histograms.items()
+            if name == "stage_seconds"
+        }
+
+
+def get_report(**run_info: Any) -> Dict[str, Any]:
+    """
+    Return a snapshot of all metrics as JSON-serializable report:
+
+        {**run_info,
+         "stages_s": {"fetch": 12.3, ...},
+         "counters": {"requests": [{"labels": {...}, "value": 42}, ...]},
+         "histograms": {"request_seconds": [{"labels": {...}, "count": 42,
+                        "sum": 3.1, "buckets": {"0.005": 0, ...}}, ...]}}
+
+    The bucket counts are cumulative, like in Prometheus.
+    """
+    stage_times = get_stage_times()
+    report: Dict[str, Any] = {
+        **run_info, "stages_s": stage_times,
+        "counters": {},
+        "histograms": {}
+    }
+    with metrics_lock:
+        for (name, labels), value in sorted(counters.items()):
+            report["counters"].setdefault(name, []).append({
+                "labels": dict(labels),
+                "value": value
+            })
+        for (name, labels), histogram in sorted(histograms.items()):
+            report["histograms"].setdefault(name, []).append({
+                "labels": dict(labels),
+                "count": histogram.count,
+                "sum": histogram.sum,
+                "buckets": dict(histogram.cumulative_counts())
+            })
+    return report
+
+
+def merge_reports(reports: List[Dict[str, Any]],
+                  **run_info: Any) -> Dict[str, Any]:
+    """
+    Merge the reports of several processes (e.g. the workers of a
+    distributed run) into one report: stage times, counters and histograms
+    with the same labels are summed.
+    """
+    stages_s: Dict[str, float] = {}
+    merged_counters: Dict[Tuple[str, Labels], float] = {}
+    merged_histograms: Dict[Tuple[str, Labels], Dict[str, Any]] = {}
+    for report in reports:
+        for stage, seconds in report["stages_s"].items():
+            stages_s[stage] = stages_s.get(stage, 0.0) + seconds
+        for name, entries in report["counters"].items():
+            for entry in entries:
+                metric = (name, get_labels(entry["labels"]))
+                merged_counters[metric] = merged_counters.get(
+                    metric, 0) + entry["value"]
+        for name, entries in report["histograms"].items():
+            for entry in entries:
+                metric = (name, get_labels(entry["labels"]))
+                merged = merged_histograms.setdefault(
+                    metric, {
+                        "count": 0,
+                        "sum": 0.0,
+                        "buckets": dict.fromkeys(entry["buckets"], 0)
+                    })
+                merged["count"] += entry["count"]
+                merged["sum"] += entry["sum"]
+                for bound, count in entry["buckets"].items():
+                    merged["buckets"][bound] = merged["buckets"].get(
+                        bound, 0) + count
+
+    merged_report: Dict[str, Any] = {
+        **run_info, "stages_s": stages_s,
+        "counters": {},
+        "histograms": {}
+    }
+    for (name, labels), value in sorted(merged_counters.items()):
+        merged_report["counters"].setdefault(name, []).append({
+            "labels": dict(labels),
+            "value": value
+        })
+    for (name, labels), histogram in sorted(merged_histograms.items()):
+        merged_report["histograms"].setdefault(name, []).append({
+            "labels": dict(labels),
+            **histogram
+        })
+    return merged_report
+
+
+def get_counter_total(report: Dict[str, Any], name: str) -> float:
+    """Return the sum of a counter over all labels of a report."""
+    return sum(c["value"] for c in report["counters"].get(name, []))
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (name + '="' + value.replace("\\", "\\\\").replace(
+        '"', '\\"').replace("\n", "\\n") + '"'
+               for name, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_prometheus(report: Dict[str, Any]) -> str:
+    """Format the counters and histograms of a report in the Prometheus text format."""
+    lines = []
+    for name, series in report["counters"].items():
+        metric = f"{PROMETHEUS_PREFIX}_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        for s in series:
+            lines.append(f"{metric}{format_labels(s['labels'])} {s['value']}")
+
+    for name, series in report["histograms"].items():
+        metric = f"{PROMETHEUS_PREFIX}_{name}"
+        lines.append(f"# TYPE {metric} histogram")
+        for s in series:
+            for bound, count in s["buckets"].items():
+                labels = format_labels({**s["labels"], "le": bound})
+                lines.append(f"{metric}_bucket{labels} {count}")
+            labels = format_labels(s["labels"])
+            lines.append(f"{metric}_sum{labels} {s['sum']}")
+            lines.append(f"{metric}_count{labels} {s['count']}")
+
+    for name in ("run_duration_seconds", "run_end_timestamp_seconds"):
+        if name in report:
+            metric = f"{PROMETHEUS_PREFIX}_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {report[name]}")
+    return "\n".join(lines) + "\n"
+
+
+def write_atomic(file_path: str, content: str) -> None:
+    """Write a file by replacing it with a temporary file, so readers never see a partial file."""
+    # The process id keeps processes that write the same file apart
+    tmp_file = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(tmp_file, file_path)
+
+
+def write_report(report: Dict[str, Any], file_path: str) -> None:
+    """Write a report as JSON file."""
+    write_atomic(file_path, json.dumps(report, indent=4))
+
+
+def write_prometheus_textfile(report: Dict[str, Any], file_path: str) -> None:
+    """Write a report as Prometheus textfile (the file name must end in .prom)."""
+    write_atomic(file_path, format_prometheus(report))
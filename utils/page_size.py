@@ -0,0 +1,86 @@
+import os
+import json
+import logging
+import threading
+from typing import Dict
+
+from .metrics import write_atomic
+from .paths import PAGE_SIZES_FILE
+
+
+class PageSizeController:
+    """
+    Tunes the telemetry "limit" (page size) per device from the observed
+    response latency, payload size and rows per page.
+
+    - A full page that is answered well below target_latency_s grows the
+      limit towards the target (at most doubling it per page).
+    - A response slower than target_latency_s, larger than max_page_mb or a
+      failed request shrinks the limit proportionally (at least halving it
+      for failures).
+    - The limit always stays within [min_limit, max_limit].
+
+    The tuned limits are loaded from and saved to data/page_sizes.json, so
+    that the next run starts with them.
+    """
+
+    def __init__(self, default_limit: int, min_limit: int, max_limit: int,
+                 target_latency_s: float, max_page_mb: float) -> None:
+        self.default_limit = default_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency_s = target_latency_s
+        self.max_page_bytes = max_page_mb * 1024**2
+        self.lock = threading.Lock()
+        self.limits: Dict[str, int] = {}
+
+        if os.path.exists(PAGE_SIZES_FILE):
+            try:
+                with open(PAGE_SIZES_FILE, 'r') as f:
+                    self.limits = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f"Error reading tuned page sizes: {e}")
+
+    def clamp(self, limit: float) -> int:
+        return int(min(self.max_limit, max(self.min_limit, limit)))
+
+    def get(self, device_id: str) -> int:
+        """Return the current limit of a device."""
+        with self.lock:
+            return self.clamp(self.limits.get(device_id, self.default_limit))
+
+    def observe(self, device_id: str, limit: int, rows: int,
+                latency_s: float, payload_bytes: int) -> None:
+        """
+        Adjust the limit of a device after a page request with the given
+        limit returned at most rows rows per key.
+        """
+        factor = 1.0
+        if latency_s > self.target_latency_s:
+            factor = self.target_latency_s / latency_s
+        elif rows >= limit:
+            # Only full pages tell whether a larger page would be useful
+            factor = min(2.0, self.target_latency_s / max(latency_s, 1e-3))
+        if payload_bytes > self.max_page_bytes:
+            factor = min(factor, self.max_page_bytes / payload_bytes)
+
+        with self.lock:
+            self.limits[device_id] = self.clamp(limit * factor)
+
+    def observe_error(self, device_id: str, limit: int) -> None:
+        """Halve the limit of a device after a failed page request."""
+        with self.lock:
+            self.limits[device_id] = self.clamp(limit / 2)
+
+    def save(self) -> None:
+        """
+        Persist the tuned limits atomically. The limits are only a hint for
+        the next run, so an error is logged instead of failing the download.
+        """
+        with self.lock:
+            try:
+                write_atomic(PAGE_SIZES_FILE,
+                             json.dumps(self.limits, indent=4, sort_keys=True))
+            except OSError as e:
+                logging.error(f"Error saving the page sizes to "
+                              f"{PAGE_SIZES_FILE}: {e}")
@@ -1,6 +1,19 @@
 import os
 
 PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-DATA_DIR = os.path.join(PROJECT_DIR, "data")
-LOG_DIR = os.path.join(PROJECT_DIR, "logs")
-CONFIG_DIR = os.path.join(PROJECT_DIR, "config")
+
+# The data, log and config folders can be moved with environment variables,
+# e.g. to run the downloader against a separate folder in benchmarks.
+DATA_DIR = os.environ.get("TB_DATA_DIR") or os.path.join(PROJECT_DIR, "data")
+LOG_DIR = os.environ.get("TB_LOG_DIR") or os.path.join(PROJECT_DIR, "logs")
+CONFIG_DIR = os.environ.get("TB_CONFIG_DIR") or os.path.join(
+    PROJECT_DIR, "config")
+STAGING_DIR = os.path.join(DATA_DIR, ".staging")
+ROLLUPS_DIR = os.path.join(DATA_DIR, "rollups")
+HOT_CACHE_DIR = os.path.join(DATA_DIR, "hot")
+HTTP_CACHE_DIR = os.path.join(DATA_DIR, "http_cache")
+WATERMARKS_FILE = os.path.join(DATA_DIR, "watermarks.json")
+PAGE_SIZES_FILE = os.path.join(DATA_DIR, "page_sizes.json")
+CHECKPOINT_FILE = os.path.join(DATA_DIR, "checkpoint.json")
+DEVICE_CHECKPOINTS_DIR = os.path.join(DATA_DIR, ".checkpoints")
+LEASES_DIR = os.path.join(DATA_DIR, ".leases")
@@ -0,0 +1,168 @@
+import zlib
+import queue
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .metrics import LATENCY_BUCKETS_S, get_stage_times, observe, reset_metrics
+from .tracing import (StageProfiles, TraceEvent, add_stage_profiles,
+                      add_trace_events, get_stage_profiles, get_trace_events,
+                      get_tracing_options, is_tracing, reset_tracing,
+                      start_tracing, stop_tracing)
+
+# The download runs as a pipeline of two stages that overlap:
+#
+# - the download workers fetch pages and convert them to DataFrames,
+# - the writers pivot the pages of every checkpoint and write them to
+#   Parquet (including the rollups), optionally in a process pool.
+#
+# Every device is assigned to one writer, whose bounded queue keeps the
+# saves of the device in order and holds back the download workers of the
+# device while the writer is behind.
+
+Job = Tuple[Future, Optional[Future], Optional[Callable[[], None]],
+            Callable[..., Any], Tuple[Any, ...], Callable[[Any], None]]
+
+
+def init_write_process(level: int, log_format: str,
+                       log_files: List[str]) -> None:
+    """Log to the files of the parent process from a write process."""
+    logging.basicConfig(
+        level=level,
+        format=log_format,
+        handlers=[logging.FileHandler(file) for file in log_files] +
+        [logging.StreamHandler()])
+
+
+def run_with_stage_times(
+    tracing_options: Optional[Dict[str, Any]], function: Callable[..., Any],
+    *args: Any
+) -> Tuple[Any, Dict[str, float], List[TraceEvent], StageProfiles]:
+    """
+    Run a function in a write process and return its result together with
+    the time it spent per stage, which the parent adds to its metrics, and
+    (with tracing_options of the parent) the spans and the stage profiles
+    it recorded, which the parent adds to its trace.
+    """
+    reset_metrics()
+    reset_tracing()
+    if tracing_options is None and is_tracing():
+        stop_tracing()
+    elif tracing_options is not None and not is_tracing():
+        start_tracing(**tracing_options)
+    result = function(*args)
+    return (result, get_stage_times(), get_trace_events(),
+            get_stage_profiles())
+
+
+def create_process_pool(processes: int) -> ProcessPoolExecutor:
+    """
+    Create a pool of write processes. The processes are spawned instead of
+    forked, because forking a process that already runs Polars' thread pool
+    can deadlock the child.
+    """
+    root = logging.getLogger()
+    log_files = [
+        handler.baseFilename for handler in root.handlers
+        if isinstance(handler, logging.FileHandler)
+    ]
+    log_format = next((handler.formatter._fmt for handler in root.handlers
+                       if handler.formatter is not None
+                       and handler.formatter._fmt), logging.BASIC_FORMAT)
+    return ProcessPoolExecutor(max_workers=processes,
+                               mp_context=multiprocessing.get_context("spawn"),
+                               initializer=init_write_process,
+                               initargs=(root.level, log_format, log_files))
+
+
+class WritePipeline:
+    """
+    Writer threads with one bounded queue each. Jobs of the same device
+    always go to the same writer and run in the order they were submitted.
+    With processes > 0, the writers run their jobs in a process pool.
+    """
+
+    def __init__(self, writers: int, queue_size: int, processes: int) -> None:
+        self.pool = create_process_pool(processes) if processes else None
+        self.queues: List["queue.Queue[Optional[Job]]"] = [
+            queue.Queue(maxsize=queue_size) for _ in range(writers)
+        ]
+        self.threads = [
+            threading.Thread(target=self.run_writer,
+                             args=(job_queue, ),
+                             name=f"writer-{i}",
+                             daemon=True)
+            for i, job_queue in enumerate(self.queues)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self,
+               device_name: str,
+               function: Callable[..., Any],
+               *args: Any,
+               on_done: Callable[[Any], None],
+               after: Optional[Future] = None,
+               before: Optional[Callable[[], None]] = None) -> Future:
+        """
+        Queue function(*args) on the writer of the device, blocking while
+        its queue is full, and return a future of its completion. on_done
+        is called with the result in the writer thread. If after failed,
+        the job is skipped and fails as well, so that a task never commits
+        progress past a failed save. before is called in the writer thread
+        right before the job runs; if it raises, the job is skipped and
+        fails with its error.
+        """
+        future: Future = Future()
+        writer = zlib.crc32(device_name.encode()) % len(self.queues)
+        self.queues[writer].put(
+            (future, after, before, function, args, on_done))
+        return future
+
+    def run_writer(self, job_queue: "queue.Queue[Optional[Job]]") -> None:
+        while True:
+            job = job_queue.get()
+            if job is None:
+                job_queue.task_done()
+                return
+            future, after, before, function, args, on_done = job
+            future.set_running_or_notify_cancel()
+            try:
+                if after is not None and after.exception() is not None:
+                    raise RuntimeError("Skipped after a failed save.")
+                if before is not None:
+                    before()
+                if self.pool is not None:
+                    result, stage_times, events, profiles = self.pool.submit(
+                        run_with_stage_times, get_tracing_options(), function,
+                        *args).result()
+                    add_trace_events(events)
+                    add_stage_profiles(profiles)
+                    for stage, seconds in stage_times.items():
+                        observe("stage_seconds",
+                                seconds,
+                                LATENCY_BUCKETS_S,
+                                stage=stage)
+                else:
+                    result = function(*args)
+                on_done(result)
+                future.set_result(None)
+            except BaseException as e:
+                future.set_exception(e)
+            job_queue.task_done()
+
+    def wait(self) -> None:
+        """Wait until the queued jobs are finished, keeping the writers."""
+        for job_queue in self.queues:
+            job_queue.join()
+
+    def close(self) -> None:
+        """Finish the queued jobs and stop the writers."""
+        for job_queue in self.queues:
+            job_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.pool is not None:
+            self.pool.shutdown()
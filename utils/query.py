@@ -0,0 +1,169 @@
+import os
+import polars as pl
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from .data_files import Segment, get_legacy_file_path, get_segments
+from .rollups import ROLLUP_STATS
+from .watermarks import NON_KEY_COLUMNS
+from .paths import DATA_DIR, ROLLUPS_DIR
+
+# Read API over the local Parquet store. Queries are planned from the
+# folder and file names alone: year folders and segments (whose names carry
+# their time range) outside the queried range are never opened. The
+# remaining files are scanned lazily with the ts filter pushed down to the
+# Parquet reader, so row groups outside the range are skipped by their ts
+# statistics, and only the requested columns are read.
+
+
+def get_year(ts: int) -> int:
+    return datetime.fromtimestamp(ts / 1000, tz=timezone.utc).year
+
+
+def get_year_paths(base_path: str, start_ts: Optional[int],
+                   end_ts: Optional[int]) -> List[str]:
+    """Return the year folders of base_path that overlap [start_ts, end_ts)."""
+    if not os.path.isdir(base_path):
+        return []
+    start_year = get_year(start_ts) if start_ts is not None else None
+    end_year = get_year(end_ts - 1) if end_ts is not None else None
+
+    paths = []
+    for year in sorted(os.listdir(base_path)):
+        if not (year.isdigit() and os.path.isdir(os.path.join(base_path, year))):
+            continue
+        if start_year is not None and int(year) < start_year:
+            continue
+        if end_year is not None and int(year) > end_year:
+            continue
+        paths.append(os.path.join(base_path, year))
+    return paths
+
+
+def get_overlap_groups(segments: List[Segment]) -> List[List[Segment]]:
+    """
+    Group segments whose time ranges overlap (transitively), ordered by
+    time. Only segments within a group can hold the same timestamps.
+    """
+    groups: List[List[Segment]] = []
+    group_end = None
+    for segment in sorted(segments, key=lambda segment: segment.min_ts):
+        if group_end is not None and segment.min_ts <= group_end:
+            groups[-1].append(segment)
+            group_end = max(group_end, segment.max_ts)
+        else:
+            groups.append([segment])
+            group_end = segment.max_ts
+    return groups
+
+
+def scan_files(files: List[str], columns: Optional[List[str]],
+               start_ts: Optional[int],
+               end_ts: Optional[int]) -> pl.LazyFrame:
+    """
+    Scan Parquet files lazily, filtered to [start_ts, end_ts) and projected
+    to the given columns (or all columns) that exist in each file.
+    """
+    frames = []
+    for file in files:
+        lf = pl.scan_parquet(file)
+        if start_ts is not None:
+            lf = lf.filter(pl.col("ts") >= start_ts)
+        if end_ts is not None:
+            lf = lf.filter(pl.col("ts") < end_ts)
+        if columns is not None:
+            schema = pl.read_parquet_schema(file)
+            lf = lf.select([c for c in columns if c in schema])
+        frames.append(lf)
+    return pl.concat(frames, how="diagonal_relaxed")
+
+
+def scan_device(path: str, device_name: str, columns: Optional[List[str]],
+                start_ts: Optional[int],
+                end_ts: Optional[int]) -> Optional[pl.LazyFrame]:
+    """Scan the data of a device in one year folder, sorted by ts."""
+    segments = [
+        segment for segment in get_segments(path, device_name)
+        if (start_ts is None or segment.max_ts >= start_ts) and (
+            end_ts is None or segment.min_ts < end_ts)
+    ]
+    frames = []
+    for group in get_overlap_groups(segments):
+        # Within a group, merge rows with the same ts column by column like
+        # read_segments, preferring the newest segment.
+        lf = scan_files([
+            segment.path
+            for segment in sorted(group, key=lambda segment: segment.sequence)
+        ], columns, start_ts, end_ts)
+        if len(group) > 1:
+            lf = lf.group_by("ts", maintain_order=True).agg(
+                pl.all().drop_nulls().last())
+        frames.append(lf.sort("ts"))
+
+    legacy_file = get_legacy_file_path(path, device_name)
+    if os.path.exists(legacy_file):
+        frames.append(scan_files([legacy_file], columns, start_ts, end_ts))
+
+    if not frames:
+        return None
+    return pl.concat(frames, how="diagonal_relaxed")
+
+
+def scan_local_data(devices: Optional[List[str]] = None,
+                    start_ts: Optional[int] = None,
+                    end_ts: Optional[int] = None,
+                    keys: Optional[List[str]] = None,
+                    tier: Optional[str] = None) -> pl.LazyFrame:
+    """
+    Return a LazyFrame over the local data of the given devices (default:
+    all) between start_ts (inclusive) and end_ts (exclusive), in ms, with
+    the columns ts, datetime, system_name and the given keys (default: all).
+    With tier (e.g. "1h"), the rollup tier is queried instead of the raw
+    data, and every key is returned as <key>_min, <key>_max, <key>_mean and
+    <key>_count. Keys without data are returned as null columns.
+
+    The rows are sorted by ts per device, and devices follow each other in
+    the given order.
+    """
+    base_path = DATA_DIR if tier is None else os.path.join(ROLLUPS_DIR, tier)
+    columns = None
+    if keys is not None:
+        key_columns = keys if tier is None else [
+            f"{key}_{stat}" for key in keys for stat in ROLLUP_STATS
+        ]
+        columns = [*NON_KEY_COLUMNS, *key_columns]
+
+    year_paths = get_year_paths(base_path, start_ts, end_ts)
+    if devices is None:
+        devices = sorted({
+            entry.removesuffix(".parquet")
+            for path in year_paths for entry in os.listdir(path)
+        })
+
+    frames = []
+    for device_name in devices:
+        for path in year_paths:
+            lf = scan_device(path, device_name, columns, start_ts, end_ts)
+            if lf is not None:
+                frames.append(lf)
+
+    schema: Dict[str, pl.DataType] = {
+        "ts": pl.Int64(),
+        "datetime": pl.Datetime("us"),
+        "system_name": pl.Utf8()
+    }
+    if not frames:
+        return pl.LazyFrame(schema={
+            **schema,
+            **{c: pl.Float64()
+               for c in columns or [] if c not in schema}
+        })
+
+    lf = pl.concat(frames, how="diagonal_relaxed")
+    if columns is not None:
+        # Add requested keys without any data, and fix the column order
+        lf = lf.with_columns([
+            pl.lit(None, dtype=pl.Float64).alias(c)
+            for c in columns if c not in lf.collect_schema()
+        ]).select(columns)
+    return lf
@@ -0,0 +1,169 @@
+import time
+import uuid
+import logging
+import requests
+import polars as pl
+from typing import Dict, List, Optional, Tuple
+
+from .download import DownloadTask, get_key_batches
+from .query import scan_local_data
+from .rollups import parse_duration
+from .window_planner import probe_density
+from .watermarks import get_device_watermarks
+from .metrics import increment
+from .config_files import load_json_config
+
+config = load_json_config("config.json")
+
+# Reconciliation finds holes that the watermarks cannot see, e.g. data that
+# arrived late on ThingsBoard or pages lost in a failed run. The range of
+# every key (up to its watermark) is split into buckets, and the number of
+# local measurements per bucket is compared with an agg=COUNT request. Only
+# the buckets in which ThingsBoard holds more measurements are downloaded
+# again; saving them merges the missing rows into the stored data.
+#
+# Buckets in which the local data holds more measurements (e.g. data deleted
+# by a TTL on ThingsBoard) are only logged. Measurements that cannot be
+# converted to a number are stored as nulls, so their buckets never match
+# and are downloaded again by every reconciliation.
+
+
+def get_reconcile_settings() -> Tuple[int, Optional[int], int]:
+    """
+    Return the bucket length in ms, the start timestamp of the reconciled
+    range and the maximum number of buckets per agg=COUNT request from the
+    "reconcile" config. The range starts "lookback_days" before now, or at
+    "start_unix_ms" of the download config if lookback_days is null. If
+    both are null, the start is None (the start of the local data).
+    """
+    settings = config.get("reconcile") or {}
+    bucket_ms = parse_duration(settings.get("bucket") or "1h")
+    lookback_days = settings.get("lookback_days", 7)
+    if lookback_days is None:
+        start_ts = config["download"]["start_unix_ms"]
+    else:
+        start_ts = int(time.time() * 1000) - lookback_days * 86400000
+    max_buckets = settings.get("max_buckets_per_request") or 500
+    return bucket_ms, start_ts, max_buckets
+
+
+def get_local_counts(device_name: str, keys: List[str], start_ts: int,
+                     end_ts: int, bucket_ms: int) -> Dict[int, Dict[str, int]]:
+    """Count the local measurements of every key per bucket start."""
+    df_counts = scan_local_data([device_name], start_ts, end_ts, keys) \
+        .group_by((pl.col("ts") // bucket_ms * bucket_ms).alias("bucket")) \
+        .agg([pl.col(key).count() for key in keys]).collect()
+    return {
+        row["bucket"]: {key: row[key]
+                        for key in keys}
+        for row in df_counts.iter_rows(named=True)
+    }
+
+
+def get_remote_counts(jwt_token: str, device_id: str, keys: List[str],
+                      start_ts: int, end_ts: int, bucket_ms: int,
+                      max_buckets: int,
+                      session: requests.Session) -> Dict[int, Dict[str, int]]:
+    """
+    Count the measurements of every key per bucket start on ThingsBoard,
+    with one agg=COUNT request per max_buckets buckets.
+    """
+    counts = {}
+    for chunk_start in range(start_ts, end_ts, max_buckets * bucket_ms):
+        chunk_end = min(end_ts, chunk_start + max_buckets * bucket_ms)
+        for bucket in probe_density(jwt_token, device_id, keys, chunk_start,
+                                    chunk_end, (chunk_end - chunk_start) //
+                                    bucket_ms, session):
+            counts[bucket.start] = bucket.counts
+    return counts
+
+
+def get_missing_ranges(buckets: List[int],
+                       bucket_ms: int) -> List[Tuple[int, int]]:
+    """Merge sorted bucket starts into consecutive half-open ranges."""
+    ranges: List[Tuple[int, int]] = []
+    for bucket in buckets:
+        if ranges and ranges[-1][1] == bucket:
+            ranges[-1] = (ranges[-1][0], bucket + bucket_ms)
+        else:
+            ranges.append((bucket, bucket + bucket_ms))
+    return ranges
+
+
+def plan_reconcile_tasks(
+        jwt_token: str, device_name: str, device_id: str, keys: List[str],
+        session: requests.Session,
+        dry_run: bool) -> Tuple[List[DownloadTask], Tuple[int, int]]:
+    """
+    Plan the download tasks that fill the holes of a device's local data,
+    and estimate the number of requests and rows they need. Has the same
+    signature as plan_device_tasks, so that download_devices can run it
+    instead.
+
+    Every key is reconciled from the start of the reconciled range up to
+    the end of the bucket that holds its watermark; keys without local data
+    are left to the regular download. Every range of consecutive mismatched
+    buckets becomes one task with an exclusive end, shared by the keys
+    (up to "keys_per_request") that miss the same range.
+    """
+    bucket_ms, start_ts, max_buckets = get_reconcile_settings()
+    limit = config["download"]["limit"] or 1000
+    if start_ts is None:
+        start_ts = scan_local_data([device_name], keys=keys).select(
+            pl.col("ts").min()).collect().item()
+        if start_ts is None:
+            return [], (0, 0)
+    start_ts = start_ts // bucket_ms * bucket_ms
+    watermarks = get_device_watermarks(device_name, keys)
+    key_end = {
+        key: (watermarks[key] // bucket_ms + 1) * bucket_ms
+        for key in keys if watermarks.get(key, 0) >= start_ts
+    }
+    if not key_end:
+        return [], (0, 0)
+
+    missing: Dict[Tuple[int, int], List[str]] = {}
+    missing_rows: Dict[str, int] = {}
+    mismatched, surplus = 0, 0
+    for batch in get_key_batches(key_end):
+        end_ts = max(key_end[key] for key in batch)
+        local_counts = get_local_counts(device_name, batch, start_ts, end_ts,
+                                        bucket_ms)
+        remote_counts = get_remote_counts(jwt_token, device_id, batch,
+                                          start_ts, end_ts, bucket_ms,
+                                          max_buckets, session)
+        for key in batch:
+            buckets = []
+            for bucket, counts in sorted(remote_counts.items()):
+                if bucket >= key_end[key]:
+                    break
+                local = local_counts.get(bucket, {}).get(key, 0)
+                if counts[key] > local:
+                    buckets.append(bucket)
+                    missing_rows[key] = missing_rows.get(key, 0) + counts[key]
+                elif counts[key] < local:
+                    surplus += 1
+            mismatched += len(buckets)
+            for bucket_range in get_missing_ranges(buckets, bucket_ms):
+                missing.setdefault(bucket_range, []).append(key)
+
+    increment("reconcile_buckets_mismatched", mismatched, device=device_name)
+    logging.info(f"Reconciling device {device_name}: {mismatched} bucket(s) "
+                 f"to download again in {len(missing)} range(s).")
+    if surplus:
+        logging.warning(
+            f"{surplus} bucket(s) of device {device_name} hold more local "
+            f"measurements than ThingsBoard, they are kept.")
+
+    tasks = []
+    for (range_start, range_end), range_keys in sorted(missing.items()):
+        for batch in get_key_batches({key: 0 for key in range_keys}):
+            tasks.append(
+                DownloadTask(uuid.uuid4().hex, device_name,
+                             {key: range_start
+                              for key in batch}, range_end, True))
+
+    estimated_rows = sum(missing_rows.values())
+    estimated_requests = sum(
+        -(-rows // limit) for rows in missing_rows.values())
+    return tasks, (estimated_requests, estimated_rows)
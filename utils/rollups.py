@@ -0,0 +1,161 @@
+import os
+import polars as pl
+from typing import List, Tuple
+
+from .data_files import get_segments, read_segments, save_local_data
+from .watermarks import NON_KEY_COLUMNS
+from .config_files import load_json_config
+from .paths import DATA_DIR, ROLLUPS_DIR
+
+config = load_json_config("config.json")
+
+# Rollup tiers store the min, max, mean and count of every key per time
+# bucket (e.g. 1 minute, 1 hour and 1 day) next to the raw data:
+#
+#   data/rollups/<tier>/<year>/<device>/month=<MM>/<segment>.parquet
+#
+# with the same segment layout as the raw data and the columns ts (bucket
+# start), datetime, system_name and <key>_min, <key>_max, <key>_mean,
+# <key>_count. After every save of raw data, only the buckets touched by the
+# new rows are recomputed: the finest tier from the stored raw rows of these
+# buckets, every coarser tier from the tier below it. A recomputed bucket is
+# written as a new row that supersedes the stored one, unchanged buckets are
+# skipped.
+
+ROLLUP_STATS = ("min", "max", "mean", "count")
+DURATION_UNITS_MS = {"s": 1000, "m": 60000, "h": 3600000, "d": 86400000}
+DAY_MS = DURATION_UNITS_MS["d"]
+
+
+def parse_duration(duration: str) -> int:
+    """Convert a duration like "1m", "15m", "1h" or "1d" to milliseconds."""
+    number, unit = duration[:-1], duration[-1]
+    if not number.isdigit() or unit not in DURATION_UNITS_MS:
+        raise ValueError(f"Invalid rollup tier: {duration}")
+    return int(number) * DURATION_UNITS_MS[unit]
+
+
+def get_rollup_tiers() -> List[Tuple[str, int]]:
+    """
+    Return the configured rollup tiers as (name, bucket length in ms) from
+    the finest to the coarsest, or an empty list if rollups are disabled.
+    Buckets must divide a day, so that they never span two years.
+    """
+    settings = config.get("rollups") or {}
+    if not settings.get("enabled"):
+        return []
+    tiers = sorted(((name, parse_duration(name))
+                    for name in settings.get("tiers") or ["1m", "1h", "1d"]),
+                   key=lambda tier: tier[1])
+    for name, every in tiers:
+        if DAY_MS % every:
+            raise ValueError(f"Rollup tier {name} does not divide a day.")
+    return tiers
+
+
+def get_rollup_path(tier: str, year: int) -> str:
+    return os.path.join(ROLLUPS_DIR, tier, str(year))
+
+
+def raw_to_stats(df_wide: pl.DataFrame) -> pl.DataFrame:
+    """
+    Convert wide raw data to long-format stats (ts, key, min, max, mean,
+    count). Keys stored as strings are skipped.
+    """
+    keys = [
+        c for c, dtype in df_wide.schema.items()
+        if c not in NON_KEY_COLUMNS and (dtype.is_numeric() or dtype == pl.Boolean)
+    ]
+    value = pl.col("value")
+    return df_wide.with_columns(pl.col(keys).cast(pl.Float64)).unpivot(
+        index="ts",
+        on=keys,
+        variable_name="key",
+        value_name="value").drop_nulls("value").select(
+            "ts", "key", value.alias("min"), value.alias("max"),
+            value.alias("mean"), pl.lit(1, dtype=pl.Int64).alias("count"))
+
+
+def tier_to_stats(df_wide: pl.DataFrame) -> pl.DataFrame:
+    """Convert a wide rollup tier to long-format stats."""
+    keys = [
+        c.removesuffix("_count") for c in df_wide.columns
+        if c.endswith("_count")
+    ]
+    return pl.concat([
+        df_wide.select("ts",
+                       pl.lit(key).alias("key"),
+                       *[
+                           pl.col(f"{key}_{stat}").alias(stat)
+                           for stat in ROLLUP_STATS
+                       ]).drop_nulls("count") for key in keys
+    ])
+
+
+def aggregate_stats(df_stats: pl.DataFrame, every: int) -> pl.DataFrame:
+    """Combine long-format stats into buckets of every milliseconds."""
+    return df_stats.with_columns(
+        (pl.col("ts") // every * every).alias("ts")).group_by(
+            "ts", "key").agg(
+                pl.col("min").min(),
+                pl.col("max").max(),
+                ((pl.col("mean") * pl.col("count")).sum() /
+                 pl.col("count").sum()).alias("mean"),
+                pl.col("count").sum())
+
+
+def stats_to_wide(df_stats: pl.DataFrame, device_name: str) -> pl.DataFrame:
+    """Pivot long-format stats to the wide rollup format."""
+    df_wide = df_stats.pivot(index="ts", on="key", values=list(ROLLUP_STATS))
+    # The pivot names the columns <stat>_<key>
+    renames = {}
+    for column in df_wide.columns:
+        for stat in ROLLUP_STATS:
+            if column.startswith(f"{stat}_"):
+                renames[column] = f"{column.removeprefix(f'{stat}_')}_{stat}"
+                break
+    return df_wide.rename(renames).sort("ts") \
+        .with_columns(pl.from_epoch("ts", time_unit="ms").alias("datetime")) \
+        .with_columns(pl.lit(device_name).alias("system_name"))
+
+
+def update_rollups(device_name: str, year: int, min_ts: int,
+                   max_ts: int) -> None:
+    """
+    Recompute the buckets of all rollup tiers of a device that contain
+    timestamps between min_ts and max_ts from the stored data of the year.
+    Must be called with the device's lock held. Raises RuntimeError if a
+    save fails.
+    """
+    source_path = os.path.join(DATA_DIR, str(year))
+    to_stats = raw_to_stats
+
+    for tier, every in get_rollup_tiers():
+        start = min_ts // every * every
+        end = (max_ts // every + 1) * every - 1
+        segments = [
+            segment for segment in get_segments(source_path, device_name)
+            if segment.min_ts <= end and segment.max_ts >= start
+        ]
+        if not segments:
+            return
+        df_source = read_segments(segments, start, end)
+        if df_source.height == 0:
+            return
+
+        df_tier = stats_to_wide(aggregate_stats(to_stats(df_source), every),
+                                device_name)
+        tier_path = get_rollup_path(tier, year)
+        os.makedirs(tier_path, exist_ok=True)
+        saved = save_local_data(
+            path=tier_path,
+            file_name=device_name,
+            df=df_tier,
+            max_segments=config.get("storage",
+                                    {}).get("max_segments_per_partition"))
+        if not saved:
+            raise RuntimeError(
+                f"Saving rollup tier {tier} for device {device_name} failed.")
+
+        source_path = tier_path
+        to_stats = tier_to_stats
@@ -0,0 +1,139 @@
+import os
+import math
+import uuid
+import shutil
+import logging
+import polars as pl
+from datetime import datetime, timezone
+from typing import Iterator, List, Tuple
+
+from .metrics import timed
+from .os_functions import ensure_data_dir
+from .paths import STAGING_DIR
+
+# Rough in-memory size of one long-format row (ts, key, value) while it is
+# pivoted, including the group-by state and the wide output.
+BYTES_PER_LONG_ROW = 64
+
+
+def get_staging_path(device_name: str, task_id: str) -> str:
+    """Return the staging folder of one download task of a device."""
+    return os.path.join(STAGING_DIR, device_name, task_id)
+
+
+def clear_staged_data(staging_path: str) -> None:
+    """Remove all pages staged in a staging folder."""
+    if os.path.exists(staging_path):
+        shutil.rmtree(staging_path)
+
+
+def get_staged_files(staging_path: str) -> List[str]:
+    if not os.path.exists(staging_path):
+        return []
+    return sorted(
+        os.path.join(staging_path, f) for f in os.listdir(staging_path)
+        if f.endswith(".parquet"))
+
+
+class StagingBuffer:
+    """
+    Collects downloaded long-format pages and spills them to a Parquet file
+    in staging_path once more than max_rows rows are buffered, so that a
+    download task never holds more than max_rows rows in memory.
+    """
+
+    def __init__(self, staging_path: str, max_rows: int) -> None:
+        self.staging_path = staging_path
+        self.max_rows = max_rows
+        self.pages: List[pl.DataFrame] = []
+        self.rows = 0
+
+    def append(self, df: pl.DataFrame) -> None:
+        self.pages.append(df)
+        self.rows += df.height
+        if self.rows >= self.max_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.pages:
+            return
+        ensure_data_dir(self.staging_path)
+        file_path = os.path.join(self.staging_path,
+                                 f"{uuid.uuid4().hex}.parquet")
+        pl.concat(self.pages).write_parquet(file_path)
+        self.pages = []
+        self.rows = 0
+
+
+def get_time_slices(min_ts: int, max_ts: int,
+                    n_slices: int) -> List[Tuple[int, int]]:
+    """
+    Split [min_ts, max_ts] into n_slices half-open intervals of equal length,
+    additionally cut at every year boundary so that no slice spans two years.
+    """
+    width = max(1, math.ceil((max_ts + 1 - min_ts) / n_slices))
+    bounds = set(range(min_ts, max_ts + 1, width))
+
+    first_year = datetime.fromtimestamp(min_ts / 1000, tz=timezone.utc).year
+    last_year = datetime.fromtimestamp(max_ts / 1000, tz=timezone.utc).year
+    for year in range(first_year + 1, last_year + 1):
+        bounds.add(
+            int(datetime(year, 1, 1, tzinfo=timezone.utc).timestamp() * 1000))
+
+    edges = sorted(bounds) + [max_ts + 1]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def pivot_staged_data(device_name: str, staging_path: str,
+                      memory_budget_mb: int) -> Iterator[pl.DataFrame]:
+    """
+    Pivot the long-format pages of a device staged in staging_path into wide
+    format with a lazy Polars query and yield the result in time slices.
+
+    The number of slices is chosen so that the estimated memory of pivoting
+    one slice stays within memory_budget_mb, and slices never span two years.
+    Every yielded DataFrame therefore belongs to a single year and can be
+    saved on its own.
+    """
+    files = get_staged_files(staging_path)
+    if not files:
+        return
+
+    lf = pl.scan_parquet(files)
+    stats = lf.select(
+        pl.col("ts").min().alias("min_ts"),
+        pl.col("ts").max().alias("max_ts"),
+        pl.len().alias("rows")).collect(engine="streaming")
+    min_ts, max_ts, rows = stats.row(0)
+    if rows == 0:
+        return
+    keys = lf.select(pl.col("key").unique(maintain_order=True)).collect(
+        engine="streaming")["key"].to_list()
+    # Keys stored as strings take their values from the text column
+    text_keys = set()
+    if "text" in lf.collect_schema():
+        text_keys = set(
+            lf.filter(pl.col("text").is_not_null()).select(
+                pl.col("key").unique()).collect(engine="streaming")["key"])
+
+    n_slices = max(
+        1,
+        math.ceil(rows * BYTES_PER_LONG_ROW / (memory_budget_mb * 1024**2)))
+    slices = get_time_slices(min_ts, max_ts, n_slices)
+    logging.info(f"Pivoting {rows} staged rows for device {device_name} "
+                 f"in {len(slices)} slice(s).")
+
+    for slice_start, slice_end in slices:
+        # Long-to-wide pivot as a group-by, which (unlike DataFrame.pivot)
+        # runs lazily on the streaming engine.
+        with timed("pivot"):
+            df_wide = lf.filter((pl.col("ts") >= slice_start) & (pl.col("ts") < slice_end)) \
+                .group_by("ts") \
+                .agg([pl.col("text" if key in text_keys else "value").filter(pl.col("key") == key).first().alias(key) for key in keys]) \
+                .sort("ts") \
+                .with_columns(pl.from_epoch("ts", time_unit="ms").alias("datetime")) \
+                .with_columns(pl.lit(device_name).alias("system_name")) \
+                .collect(engine="streaming")
+
+        if df_wide.height > 0:
+            yield df_wide
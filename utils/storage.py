@@ -0,0 +1,120 @@
+import math
+import polars as pl
+from typing import Dict, List, NamedTuple, Optional
+
+from .config_files import load_json_config
+
+config = load_json_config("config.json")
+
+# Storage options of the Parquet files (the "storage" section of the config):
+#
+#   "compression": "zstd", "compression_level": null,
+#   "row_group_duration_s": 86400,
+#   "system_name": "string" or "categorical",
+#   "key_dtypes": {"key_1": "Float32", "key_2": "Int32", "key_3": "String"}
+#
+# Keys without a dtype are stored as Float64. Keys stored as String keep
+# the values as downloaded instead of converting them to numbers. Changing
+# the options only affects newly written segments; readers combine segments
+# with different dtypes by casting to the common supertype. Use
+# benchmarks/storage_benchmark.py to compare the options on local data.
+
+KEY_DTYPES: Dict[str, pl.DataType] = {
+    "Float32": pl.Float32(),
+    "Float64": pl.Float64(),
+    "Int8": pl.Int8(),
+    "Int16": pl.Int16(),
+    "Int32": pl.Int32(),
+    "Int64": pl.Int64(),
+    "Boolean": pl.Boolean(),
+    "String": pl.Utf8()
+}
+
+
+class StorageSettings(NamedTuple):
+    compression: str
+    compression_level: Optional[int]
+    # Target time range of a row group in ms, or None for the default size
+    row_group_ms: Optional[int]
+    categorical_system_name: bool
+    key_dtypes: Dict[str, pl.DataType]
+
+
+def get_storage_settings() -> StorageSettings:
+    """Return the storage options from the config file."""
+    settings = config.get("storage") or {}
+    system_name = settings.get("system_name") or "string"
+    if system_name not in ("string", "categorical"):
+        raise ValueError(f"Invalid system_name storage: {system_name}")
+    key_dtypes = {}
+    for key, dtype in (settings.get("key_dtypes") or {}).items():
+        if dtype not in KEY_DTYPES:
+            raise ValueError(f"Invalid dtype of key {key}: {dtype}")
+        key_dtypes[key] = KEY_DTYPES[dtype]
+
+    row_group_duration_s = settings.get("row_group_duration_s")
+    return StorageSettings(
+        compression=settings.get("compression") or "zstd",
+        compression_level=settings.get("compression_level"),
+        row_group_ms=int(row_group_duration_s * 1000)
+        if row_group_duration_s else None,
+        categorical_system_name=system_name == "categorical",
+        key_dtypes=key_dtypes)
+
+
+def get_text_keys(settings: Optional[StorageSettings] = None) -> List[str]:
+    """Return the keys that are stored as strings."""
+    settings = settings or get_storage_settings()
+    return [
+        key for key, dtype in settings.key_dtypes.items() if dtype == pl.Utf8
+    ]
+
+
+def prepare_for_storage(
+        df: pl.DataFrame,
+        settings: Optional[StorageSettings] = None) -> pl.DataFrame:
+    """
+    Cast the keys to their configured dtypes and system_name to a
+    categorical if configured. Casting to an integer dtype truncates the
+    decimals, and values out of the dtype's range become null.
+    """
+    settings = settings or get_storage_settings()
+    casts: Dict[str, pl.DataType] = {
+        key: dtype
+        for key, dtype in settings.key_dtypes.items() if key in df.columns
+    }
+    if settings.categorical_system_name and "system_name" in df.columns:
+        casts["system_name"] = pl.Categorical()
+    if not casts:
+        return df
+    return df.with_columns(
+        [pl.col(column).cast(dtype, strict=False) for column, dtype in casts.items()])
+
+
+def get_row_group_size(df: pl.DataFrame, row_group_ms: int) -> int:
+    """
+    Return the number of rows that covers about row_group_ms of the (sorted)
+    DataFrame at its average density. Polars writes row groups of equal row
+    counts, so the row groups follow the time ranges only approximately.
+    """
+    min_ts, max_ts = df.select(
+        pl.col("ts").min().alias("min_ts"),
+        pl.col("ts").max().alias("max_ts")).row(0)
+    return max(1,
+               math.ceil(df.height / max(1, (max_ts - min_ts + 1) / row_group_ms)))
+
+
+def write_parquet_file(df: pl.DataFrame,
+                       file_path: str,
+                       settings: Optional[StorageSettings] = None) -> None:
+    """Write a DataFrame sorted by ts to a Parquet file with the storage options."""
+    settings = settings or get_storage_settings()
+    df = prepare_for_storage(df, settings)
+    row_group_size = None
+    if settings.row_group_ms is not None and df.height > 0:
+        row_group_size = get_row_group_size(df, settings.row_group_ms)
+    df.write_parquet(
+        file_path,
+        compression=settings.compression,  # type: ignore[arg-type]
+        compression_level=settings.compression_level,
+        row_group_size=row_group_size)
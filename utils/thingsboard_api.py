@@ -1,10 +1,18 @@
+import json
 import requests
+from requests.adapters import HTTPAdapter
 import logging
+import random
+import threading
 import time
 from datetime import datetime
-from typing import Dict, Any, Optional, List
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, Optional, List, Set
 
 from .config_files import load_json_config
+from .metrics import LATENCY_BUCKETS_S, increment, observe
+from .tracing import instant, span
+from .http_cache import page_cache
 
 config = load_json_config("config.json")
 
@@ -15,8 +23,159 @@ THINGSBOARD_USER_NAME = config["thingsboard"].get("username", "username")
 THINGSBOARD_USER_PASSWORD = config["thingsboard"].get("password", "password")
 
 
+# Retry settings for transient errors (connection errors, timeouts, 429, 5xx)
+RETRY_CONFIG = config["thingsboard"].get("retries") or {}
+MAX_RETRIES: int = RETRY_CONFIG.get("max_retries", 5)
+BACKOFF_BASE_S: float = RETRY_CONFIG.get("backoff_base_s", 0.5)
+BACKOFF_MAX_S: float = RETRY_CONFIG.get("backoff_max_s", 60.0)
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+REQUEST_TIMEOUT_S: float = config["thingsboard"].get("timeout_s", 120.0)
+
+
+class RateLimiter:
+    """
+    Spaces requests to at most max_requests_per_second (if set) across all
+    threads, and pauses all requests after the server asked to back off with
+    a Retry-After header.
+    """
+
+    def __init__(self, max_requests_per_second: Optional[float]) -> None:
+        self.min_interval_s = (1 / max_requests_per_second
+                               if max_requests_per_second else 0.0)
+        self.lock = threading.Lock()
+        self.next_request_time = 0.0
+
+    def wait(self) -> None:
+        """Block until the next request may be sent."""
+        with self.lock:
+            now = time.monotonic()
+            request_time = max(now, self.next_request_time)
+            self.next_request_time = request_time + self.min_interval_s
+        if request_time > now:
+            time.sleep(request_time - now)
+
+    def pause(self, seconds: float) -> None:
+        """Delay all requests by at least the given number of seconds."""
+        with self.lock:
+            self.next_request_time = max(self.next_request_time,
+                                         time.monotonic() + seconds)
+
+
+rate_limiter = RateLimiter(config["thingsboard"].get("max_requests_per_second"))
+
+# The current JWT token and all tokens it replaced. Requests made with a
+# replaced token transparently use the current one.
+token_lock = threading.RLock()
+current_token: Optional[str] = None
+replaced_tokens: Set[str] = set()
+
+
+def create_session(pool_size: int = 10) -> requests.Session:
+    """
+    Create a persistent session whose connection pool can hold pool_size
+    connections to the ThingsBoard host, so that concurrent downloads can
+    reuse their connections instead of opening new ones.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_retry_after(response: requests.Response) -> Optional[float]:
+    """Parse the Retry-After header (seconds or HTTP date) of a response."""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_date = parsedate_to_datetime(retry_after)
+        return max(0.0, retry_date.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def send_request(method: str,
+                 url: str,
+                 session: Optional[requests.Session] = None,
+                 **kwargs: Any) -> requests.Response:
+    """
+    Send a request and retry it on connection errors, timeouts and the
+    status codes 429, 500, 502, 503 and 504, with jittered exponential
+    backoff. A Retry-After header pauses all requests for the given time.
+    A 401 response to an authorized request refreshes the JWT token once and
+    repeats the request with the new token.
+    Raises HTTPError for all other 4xx/5xx responses, or when retries are
+    exhausted.
+    """
+    kwargs.setdefault("timeout", REQUEST_TIMEOUT_S)
+    headers: Dict[str, str] = kwargs.get("headers") or {}
+    token_refreshed = False
+    attempt = 0
+
+    while True:
+        rate_limiter.wait()
+        if "X-Authorization" in headers:
+            token = get_current_token(headers["X-Authorization"].removeprefix(
+                "Bearer "))
+            headers["X-Authorization"] = f"Bearer {token}"
+
+        retry_after: Optional[float] = None
+        try:
+            if session is None:
+                response = requests.request(method, url, **kwargs)
+            else:
+                response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            increment("requests", status=type(e).__name__)
+            if attempt >= MAX_RETRIES:
+                raise
+            logging.warning(f"Request to {url} failed: {e}")
+            retry_reason = type(e).__name__
+        else:
+            increment("requests", status=response.status_code)
+            if (response.status_code == 401 and "X-Authorization" in headers
+                    and not token_refreshed):
+                logging.info("JWT token expired, requesting a new one.")
+                with span("token_refresh"):
+                    refresh_jwt_token(token, session)
+                token_refreshed = True
+                continue
+            if (response.status_code not in RETRY_STATUS_CODES
+                    or attempt >= MAX_RETRIES):
+                try:
+                    response.raise_for_status()
+                except requests.HTTPError as http_err:
+                    logging.error("HTTP error occurred: %s - %s",
+                                  response.status_code, response.text)
+                    raise http_err
+                return response
+            retry_after = get_retry_after(response)
+            logging.warning(
+                f"Request to {url} returned {response.status_code}.")
+            retry_reason = str(response.status_code)
+
+        attempt += 1
+        increment("retries", reason=retry_reason)
+        instant("retry", reason=retry_reason, attempt=attempt)
+        delay = random.uniform(
+            0, min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2**attempt))
+        if retry_after is not None:
+            rate_limiter.pause(retry_after)
+            delay = max(delay, retry_after)
+        logging.warning(
+            f"Retrying in {delay:.1f} s (attempt {attempt}/{MAX_RETRIES}).")
+        time.sleep(delay)
+
+
 # Function to authenticate and retrieve JWT token
 def get_jwt_token(session: Optional[requests.Session] = None) -> str:
+    global current_token
+
     login_url: str = f"{THINGSBOARD_HOST}/api/auth/login"
     payload: Dict[str, str] = {
         "username": THINGSBOARD_USER_NAME,
@@ -24,20 +183,49 @@ def get_jwt_token(session: Optional[requests.Session] = None) -> str:
     }
     headers: Dict[str, str] = {"Content-Type": "application/json"}
 
-    if session is None:
-        response = requests.post(login_url, json=payload, headers=headers)
-    else:
-        response = session.post(login_url, json=payload, headers=headers)
-    response.raise_for_status()  # Raises HTTPError for 4xx/5xx responses
+    # Raises HTTPError for 4xx/5xx responses
+    response = send_request("POST",
+                            login_url,
+                            session=session,
+                            json=payload,
+                            headers=headers)
 
     token: Optional[str] = response.json().get("token")
     if token is None:
         raise ValueError("JWT token not found in the response.")
+
+    with token_lock:
+        if current_token is not None and current_token != token:
+            replaced_tokens.add(current_token)
+        current_token = token
     return token
 
 
+def refresh_jwt_token(expired_token: str,
+                      session: Optional[requests.Session] = None) -> str:
+    """
+    Replace an expired JWT token with a new one. If several threads notice
+    the same expired token, only the first one logs in again.
+    """
+    with token_lock:
+        if expired_token != current_token and current_token is not None:
+            return current_token
+        # Mark the token as replaced before logging in again, so that other
+        # threads wait for the new token instead of logging in themselves.
+        replaced_tokens.add(expired_token)
+        return get_jwt_token(session=session)
+
+
+def get_current_token(jwt_token: str) -> str:
+    """Return the token that replaced jwt_token, or jwt_token itself."""
+    with token_lock:
+        if jwt_token in replaced_tokens and current_token is not None:
+            return current_token
+    return jwt_token
+
+
 # Function to fetch telemetry data
-def get_telemetry_data(
+def get_telemetry_body(
         jwt_token: str,
         device_id: str,
         keys: str | List[str],
@@ -47,8 +235,12 @@ def get_telemetry_data(
         agg: Optional[str] = None,
         limit: Optional[int] = None,
         orderBy: Optional[str] = None,
-        session: Optional[requests.Session] = None) -> Dict[str, Any]:
+        session: Optional[requests.Session] = None,
+        response_info: Optional[Dict[str, Any]] = None) -> bytes:
     """
+    Return the raw JSON body of a telemetry request, so that it can be
+    decoded straight into columns (see read_telemetry_json).
+
     From ThingsBoard API documentation:
     
     keys - comma-separated list of telemetry keys to fetch.
@@ -58,6 +250,16 @@ def get_telemetry_data(
     agg - the aggregation function. One of MIN, MAX, AVG, SUM, COUNT, NONE.
     limit - the max amount of data points to return or intervals to process.
     orderBy - the order of results. One of ASC, DESC.
+
+    The response is requested with gzip/deflate transfer encoding, which
+    requests asks for by default. If response_info is given, it is filled
+    with the response's "latency_s" and (decompressed) payload size in
+    "bytes". Both are also recorded in the run metrics, together with the
+    compressed size on the wire.
+
+    With the HTTP page cache enabled, requests whose endTs lies far enough
+    in the past are answered from the cache if possible; response_info then
+    also holds "cached": True.
     """
     telemetry_url: str = f"{THINGSBOARD_HOST}/api/plugins/telemetry/DEVICE/{device_id}/values/timeseries"
 
@@ -78,22 +280,70 @@ def get_telemetry_data(
     }
     params = {k: v for k, v in params.items() if v is not None}
 
+    cache = page_cache if page_cache is not None and page_cache.is_cacheable(
+        endTS) else None
+    if cache is not None:
+        request_start = time.perf_counter()
+        body = cache.get(THINGSBOARD_HOST, device_id, params)
+        increment("http_cache_requests",
+                  result="miss" if body is None else "hit")
+        if body is not None:
+            if response_info is not None:
+                response_info["latency_s"] = time.perf_counter() - request_start
+                response_info["bytes"] = len(body)
+                response_info["cached"] = True
+            return body
+
     headers: Dict[str, str] = {
         "Content-Type": "application/json",
         "X-Authorization": f"Bearer {jwt_token}"
     }
 
-    if session is None:
-        response = requests.get(telemetry_url, headers=headers, params=params)
-    else:
-        response = session.get(telemetry_url, headers=headers, params=params)
-    try:
-        response.raise_for_status()
-    except requests.HTTPError as http_err:
-        logging.error("HTTP error occurred: %s - %s", response.status_code,
-                      response.text)
-        raise http_err
-    return response.json()
+    request_start = time.perf_counter()
+    response = send_request("GET",
+                            telemetry_url,
+                            session=session,
+                            headers=headers,
+                            params=params)
+
+    latency_s = time.perf_counter() - request_start
+    observe("telemetry_request_seconds",
+            latency_s,
+            LATENCY_BUCKETS_S,
+            device_id=device_id,
+            agg=agg or "NONE")
+    increment("bytes_received", len(response.content), device_id=device_id)
+    # The bytes read from the connection, before decompression
+    increment("bytes_transferred", response.raw.tell(), device_id=device_id)
+
+    if response_info is not None:
+        response_info["latency_s"] = latency_s
+        response_info["bytes"] = len(response.content)
+    if cache is not None:
+        cache.put(THINGSBOARD_HOST, device_id, params, response.content)
+    return response.content
+
+
+def get_telemetry_data(jwt_token: str,
+                       device_id: str,
+                       keys: str | List[str],
+                       interval: Optional[int] = None,
+                       startTS: Optional[int] = None,
+                       endTS: Optional[int] = None,
+                       agg: Optional[str] = None,
+                       limit: Optional[int] = None,
+                       orderBy: Optional[str] = None,
+                       session: Optional[requests.Session] = None,
+                       response_info: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Fetch telemetry like get_telemetry_body and decode it into a dict
+    {key: [{"ts": ..., "value": ...}, ...]}. Meant for small responses, e.g.
+    aggregates; pages of raw data are decoded with read_telemetry_json.
+    """
+    return json.loads(
+        get_telemetry_body(jwt_token, device_id, keys, interval, startTS,
+                           endTS, agg, limit, orderBy, session,
+                           response_info))
 
 
 def get_earliest_thingsboard_timestamp(
@@ -151,14 +401,8 @@ def get_telemetry_keys(
         "X-Authorization": f"Bearer {jwt_token}"
     }
 
-    if session is None:
-        response = requests.get(telemetry_url, headers=headers)
-    else:
-        response = session.get(telemetry_url, headers=headers)
-    try:
-        response.raise_for_status()
-    except requests.HTTPError as http_err:
-        logging.error("HTTP error occurred: %s - %s", response.status_code,
-                      response.text)
-        raise http_err
+    response = send_request("GET",
+                            telemetry_url,
+                            session=session,
+                            headers=headers)
     return response.json()
@@ -0,0 +1,405 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from .config_files import load_json_config
+
+config = load_json_config("config.json")
+
+# Opt-in tracing of a run. Every span is a complete event in the Chrome
+# trace-event format, which chrome://tracing and https://ui.perfetto.dev
+# open directly:
+#
+#   {"traceEvents": [{"name": "page", "cat": "download", "ph": "X",
+#                     "ts": <start, us>, "dur": <us>, "pid": ..., "tid": ...,
+#                     "args": {"device_id": ..., "rows": ...}}, ...]}
+#
+# Spans nest by time on the thread that recorded them: run > task (a key
+# batch of a device) > page > fetch/convert on the download workers, and
+# save > pivot/write/rollup on the writers. Every device also gets an
+# async span from its first to its last task, shown on a track of its own,
+# and token refreshes and retries are instant events. Timestamps are taken
+# from the monotonic clock, which the write processes share.
+#
+# With a profiler, the spans of the stages in "profile_stages" are
+# profiled as well, either by cProfile (deterministic, one .prof file per
+# stage for pstats/snakeviz) or by sampling the stacks of the threads in
+# these stages every "sample_interval_ms" (one .folded file per stage for
+# flamegraph.pl/speedscope). The profiles are written next to the trace.
+# Write processes trace with the options of the parent and send their
+# spans and profiles back with the result of every save.
+
+TraceEvent = Dict[str, Any]
+# The raw cProfile statistics and the sampled stacks of every stage, as
+# they are sent from a write process to its parent
+StageProfiles = Tuple[Dict[str, Any], Dict[str, Dict[str, int]]]
+
+
+class TracingSettings(NamedTuple):
+    enabled: bool
+    trace_file: Optional[str]
+    profiler: Optional[str]
+    profile_stages: List[str]
+    sample_interval_ms: float
+    max_events: int
+
+
+PROFILERS = ("cprofile", "sampling")
+
+trace_lock = threading.Lock()
+trace_events: List[TraceEvent] = []
+dropped_events = 0
+# Threads whose name was recorded as metadata event
+named_threads: Set[int] = set()
+tracing_enabled = False
+max_trace_events = 0
+
+profiler_name: Optional[str] = None
+profiled_stages: Set[str] = set()
+sample_interval_ms_setting: float = 10
+# cProfile statistics and sampled stacks (folded) per stage
+stage_profiles: Dict[str, pstats.Stats] = {}
+stage_samples: Dict[str, "Counter[str]"] = {}
+# Stack of the open profiled spans per thread, read by the sampler
+thread_stages: Dict[int, List[str]] = {}
+thread_profile = threading.local()
+sampler_stop = threading.Event()
+sampler_thread: Optional[threading.Thread] = None
+
+
+def get_tracing_settings() -> TracingSettings:
+    """Return the settings of the "tracing" section of the config."""
+    settings = config.get("tracing") or {}
+    return TracingSettings(
+        enabled=bool(settings.get("enabled")),
+        trace_file=settings.get("trace_file"),
+        profiler=settings.get("profiler"),
+        profile_stages=settings.get("profile_stages") or ["pivot", "write"],
+        sample_interval_ms=settings.get("sample_interval_ms") or 10,
+        max_events=settings.get("max_events") or 1000000)
+
+
+def is_tracing() -> bool:
+    return tracing_enabled
+
+
+def start_tracing(profiler: Optional[str] = None,
+                  profile_stages: Optional[List[str]] = None,
+                  sample_interval_ms: float = 10,
+                  max_events: int = 1000000) -> None:
+    """
+    Start recording spans, and profiling the given stages with profiler
+    ("cprofile" or "sampling") if it is set.
+    """
+    global tracing_enabled, max_trace_events, profiler_name, sampler_thread
+    global sample_interval_ms_setting
+    if profiler is not None and profiler not in PROFILERS:
+        raise ValueError(f"Unknown profiler {profiler}, use one of "
+                         f"{', '.join(PROFILERS)}.")
+    max_trace_events = max_events
+    profiler_name = profiler
+    sample_interval_ms_setting = sample_interval_ms
+    profiled_stages.clear()
+    profiled_stages.update(profile_stages or [])
+    tracing_enabled = True
+    if profiler == "sampling":
+        sampler_stop.clear()
+        sampler_thread = threading.Thread(target=sample_stacks,
+                                          args=(sample_interval_ms / 1000, ),
+                                          name="trace-sampler",
+                                          daemon=True)
+        sampler_thread.start()
+
+
+def get_tracing_options() -> Optional[Dict[str, Any]]:
+    """
+    Return the arguments of start_tracing of the running trace (None if
+    tracing is off), so that a write process traces in the same way.
+    """
+    if not tracing_enabled:
+        return None
+    return {
+        "profiler": profiler_name,
+        "profile_stages": sorted(profiled_stages),
+        "sample_interval_ms": sample_interval_ms_setting,
+        "max_events": max_trace_events
+    }
+
+
+def stop_tracing() -> None:
+    """Stop recording spans and profiles; the recorded ones are kept."""
+    global tracing_enabled, sampler_thread
+    tracing_enabled = False
+    if sampler_thread is not None:
+        sampler_stop.set()
+        sampler_thread.join()
+        sampler_thread = None
+
+
+def now_us() -> float:
+    return time.perf_counter_ns() / 1000
+
+
+def add_event(event: TraceEvent) -> None:
+    """Record an event of the current thread (and its name once)."""
+    global dropped_events
+    tid = threading.get_native_id()
+    event["pid"] = os.getpid()
+    event["tid"] = tid
+    with trace_lock:
+        if len(trace_events) >= max_trace_events:
+            dropped_events += 1
+            return
+        if tid not in named_threads:
+            named_threads.add(tid)
+            trace_events.append({
+                "name": "thread_name",
+                "ph": "M",
+                "pid": event["pid"],
+                "tid": tid,
+                "args": {
+                    "name": threading.current_thread().name
+                }
+            })
+        trace_events.append(event)
+
+
+@contextmanager
+def span(name: str, cat: str = "download",
+         **args: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Record the with-block as a span. Yields the span's args, so that sizes
+    known only at the end (e.g. rows) can be added to them.
+    """
+    if not tracing_enabled:
+        yield args
+        return
+    profiled = profiler_name is not None and name in profiled_stages
+    if profiled:
+        begin_profile(name)
+    start = now_us()
+    try:
+        yield args
+    finally:
+        end = now_us()
+        if profiled:
+            end_profile(name)
+        add_event({
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": start,
+            "dur": end - start,
+            "args": args
+        })
+
+
+def instant(name: str, cat: str = "download", **args: Any) -> None:
+    """Record an event without duration, e.g. a token refresh."""
+    if tracing_enabled:
+        add_event({
+            "name": name,
+            "cat": cat,
+            "ph": "i",
+            "s": "t",
+            "ts": now_us(),
+            "args": args
+        })
+
+
+def begin_async(name: str, span_id: str, **args: Any) -> None:
+    """
+    Begin a span that may end on another thread, e.g. the download of a
+    device. Spans with the same name share a track per span_id.
+    """
+    if tracing_enabled:
+        add_event({
+            "name": name,
+            "cat": name,
+            "ph": "b",
+            "id": span_id,
+            "ts": now_us(),
+            "args": args
+        })
+
+
+def end_async(name: str, span_id: str, **args: Any) -> None:
+    if tracing_enabled:
+        add_event({
+            "name": name,
+            "cat": name,
+            "ph": "e",
+            "id": span_id,
+            "ts": now_us(),
+            "args": args
+        })
+
+
+def begin_profile(stage: str) -> None:
+    """Start profiling a stage on the current thread."""
+    if profiler_name == "sampling":
+        with trace_lock:
+            thread_stages.setdefault(threading.get_ident(), []).append(stage)
+        return
+    # cProfile profiles the outermost profiled span of a thread
+    if getattr(thread_profile, "stage", None) is not None:
+        return
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Another profiler is active (e.g. a debugger, or on Python 3.12+
+        # the cProfile of another thread)
+        return
+    thread_profile.stage = stage
+    thread_profile.profile = profile
+
+
+def end_profile(stage: str) -> None:
+    """Stop profiling a stage on the current thread and keep its statistics."""
+    if profiler_name == "sampling":
+        with trace_lock:
+            stages = thread_stages.get(threading.get_ident())
+            if stages:
+                stages.pop()
+        return
+    if getattr(thread_profile, "stage", None) != stage:
+        return
+    profile = thread_profile.profile
+    profile.disable()
+    thread_profile.stage = None
+    with trace_lock:
+        if stage in stage_profiles:
+            stage_profiles[stage].add(profile)
+        else:
+            stage_profiles[stage] = pstats.Stats(profile)
+
+
+def get_folded_stack(frame: Any) -> str:
+    """Format a stack as "outermost;...;innermost" frames."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                     f":{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def sample_stacks(interval_s: float) -> None:
+    """Count the stacks of all threads in a profiled stage (sampler thread)."""
+    while not sampler_stop.wait(interval_s):
+        frames = sys._current_frames()
+        with trace_lock:
+            sampled = [(thread_id, stages[-1])
+                       for thread_id, stages in thread_stages.items()
+                       if stages]
+        for thread_id, stage in sampled:
+            frame = frames.get(thread_id)
+            if frame is None:
+                continue
+            stack = get_folded_stack(frame)
+            with trace_lock:
+                stage_samples.setdefault(stage, Counter())[stack] += 1
+
+
+def get_trace_events() -> List[TraceEvent]:
+    with trace_lock:
+        return list(trace_events)
+
+
+def add_trace_events(events: List[TraceEvent]) -> None:
+    """Add the events recorded by a write process."""
+    global dropped_events
+    with trace_lock:
+        room = max(0, max_trace_events - len(trace_events))
+        trace_events.extend(events[:room])
+        dropped_events += len(events) - len(events[:room])
+
+
+def get_stage_profiles() -> StageProfiles:
+    """Return the profiles of the stages in a form that can be pickled."""
+    with trace_lock:
+        return ({
+            stage: stats.stats  # type: ignore[attr-defined]
+            for stage, stats in stage_profiles.items()
+        }, {stage: dict(stacks)
+            for stage, stacks in stage_samples.items()})
+
+
+def add_stage_profiles(profiles: StageProfiles) -> None:
+    """Add the profiles of the stages recorded by a write process."""
+    raw_profiles, samples = profiles
+    with trace_lock:
+        for stage, raw_stats in raw_profiles.items():
+            stats = pstats.Stats()
+            stats.stats = raw_stats  # type: ignore[attr-defined]
+            stats.get_top_level_stats()
+            if stage in stage_profiles:
+                stage_profiles[stage].add(stats)
+            else:
+                stage_profiles[stage] = stats
+        for stage, stacks in samples.items():
+            stage_samples.setdefault(stage, Counter()).update(stacks)
+
+
+def reset_tracing() -> None:
+    """
+    Remove the recorded events and profiles. The names of the threads were
+    already recorded, so they are not recorded again.
+    """
+    global dropped_events
+    with trace_lock:
+        trace_events.clear()
+        stage_profiles.clear()
+        stage_samples.clear()
+        dropped_events = 0
+
+
+def write_trace(file_path: str) -> List[str]:
+    """
+    Write the recorded spans as Chrome trace (and the profiles of the
+    stages next to it). Returns the written files.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+    with trace_lock:
+        events = [{
+            "name": "process_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "tid": 0,
+            "args": {
+                "name": "thingsboard-downloader"
+            }
+        }, *trace_events]
+        profiles = dict(stage_profiles)
+        samples = {stage: dict(stacks) for stage, stacks in stage_samples.items()}
+        if dropped_events:
+            logging.warning(f"The trace holds the first {len(trace_events)} "
+                            f"events, {dropped_events} were dropped "
+                            f"(max_events).")
+
+    tmp_file = f"{file_path}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    os.replace(tmp_file, file_path)
+    written = [file_path]
+
+    base = file_path.removesuffix(".json")
+    for stage, stats in profiles.items():
+        stats.dump_stats(f"{base}.{stage}.prof")
+        written.append(f"{base}.{stage}.prof")
+    for stage, stacks in samples.items():
+        with open(f"{base}.{stage}.folded", 'w', encoding='utf-8') as f:
+            for stack, count in sorted(stacks.items()):
+                f.write(f"{stack} {count}\n")
+        written.append(f"{base}.{stage}.folded")
+    return written
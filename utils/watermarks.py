@@ -0,0 +1,167 @@
+import os
+import json
+import logging
+import threading
+import polars as pl
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .data_files import get_segments, get_legacy_file_path
+from .paths import DATA_DIR, WATERMARKS_FILE
+
+# The watermark index stores the latest downloaded timestamp of every
+# (device, key) in data/watermarks.json:
+#
+#   {"device_name_1": {"key_1": 1738759266000, "key_2": 1738759265000}, ...}
+#
+# It is updated after every save and rebuilt from the local Parquet files for
+# devices that are missing in it, so it can be deleted at any time.
+# The index is kept in memory and only read from the file again after
+# another process (e.g. another worker of a distributed run) replaced it;
+# the watermarks of both are then merged. Two processes that replace the
+# file at the same moment can lose each other's latest update, which only
+# makes the next download of the affected keys start earlier.
+
+watermarks_lock = threading.Lock()
+cached_watermarks: Optional[Dict[str, Dict[str, int]]] = None
+# Modification time of the file when it was last read or written
+cached_mtime_ns: Optional[int] = None
+
+# Columns of the wide format that are not telemetry keys
+NON_KEY_COLUMNS = ("ts", "datetime", "system_name")
+
+
+def load_watermarks() -> Dict[str, Dict[str, int]]:
+    """Load the watermark index, or return an empty index if it does not exist."""
+    if not os.path.exists(WATERMARKS_FILE):
+        return {}
+    try:
+        with open(WATERMARKS_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error(f"Error reading watermark index, rebuilding it: {e}")
+        return {}
+
+
+def get_mtime_ns(file_path: str) -> Optional[int]:
+    try:
+        return os.stat(file_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def dump_watermarks(watermarks: Dict[str, Dict[str, int]]) -> None:
+    """Write the watermark index atomically by replacing it with a temporary file."""
+    global cached_mtime_ns
+    tmp_file = f"{WATERMARKS_FILE}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(watermarks, f, indent=4, sort_keys=True)
+    os.replace(tmp_file, WATERMARKS_FILE)
+    cached_mtime_ns = get_mtime_ns(WATERMARKS_FILE)
+
+
+def merge_watermarks(watermarks: Dict[str, Dict[str, int]],
+                     other: Dict[str, Dict[str, int]]) -> None:
+    """Raise the watermarks to the ones of another index."""
+    for device_name, key_timestamps in other.items():
+        device_watermarks = watermarks.setdefault(device_name, {})
+        for key, ts in key_timestamps.items():
+            device_watermarks[key] = max(ts, device_watermarks.get(key, ts))
+
+
+def get_watermark_index() -> Dict[str, Dict[str, int]]:
+    """
+    Return the in-memory watermark index, merged with the file if another
+    process replaced it (called with the lock held).
+    """
+    global cached_watermarks, cached_mtime_ns
+    mtime_ns = get_mtime_ns(WATERMARKS_FILE)
+    if cached_watermarks is None or mtime_ns != cached_mtime_ns:
+        watermarks = load_watermarks()
+        if cached_watermarks is not None:
+            merge_watermarks(watermarks, cached_watermarks)
+        cached_watermarks = watermarks
+        cached_mtime_ns = mtime_ns
+    return cached_watermarks
+
+
+def get_key_timestamps(df: pl.DataFrame) -> Dict[str, int]:
+    """Return the latest timestamp with a value for every key column of a wide DataFrame."""
+    key_columns = [c for c in df.columns if c not in NON_KEY_COLUMNS]
+    if not key_columns or df.height == 0:
+        return {}
+    row = df.select([
+        pl.col("ts").filter(pl.col(key).is_not_null()).max().alias(key)
+        for key in key_columns
+    ]).row(0, named=True)
+    return {key: int(ts) for key, ts in row.items() if ts is not None}
+
+
+def update_watermarks(device_name: str, key_timestamps: Dict[str,
+                                                            int]) -> None:
+    """Raise the watermarks of a device to the given timestamps and persist the index."""
+    if not key_timestamps:
+        return
+    with watermarks_lock:
+        watermarks = get_watermark_index()
+        merge_watermarks(watermarks, {device_name: key_timestamps})
+        dump_watermarks(watermarks)
+
+
+def rebuild_device_watermarks(device_name: str,
+                              keys: List[str]) -> Dict[str, int]:
+    """
+    Rebuild the watermarks of a device from the local Parquet files.
+
+    Segments are visited from the newest to the oldest time range (known from
+    their file names) and only the 'ts' column and the key columns that are
+    still missing a watermark are read, so usually only the latest segments
+    of the latest year are touched.
+    """
+    files: List[str] = []
+    for year_dir in sorted(Path(DATA_DIR).iterdir(), reverse=True):
+        if not (year_dir.is_dir() and year_dir.name.isdigit()):
+            continue
+        legacy_file = get_legacy_file_path(str(year_dir), device_name)
+        if os.path.exists(legacy_file):
+            files.append(legacy_file)
+        segments = get_segments(str(year_dir), device_name)
+        files.extend(segment.path for segment in sorted(
+            segments, key=lambda segment: segment.max_ts, reverse=True))
+
+    watermarks: Dict[str, int] = {}
+    for file in files:
+        missing_keys = [key for key in keys if key not in watermarks]
+        if not missing_keys:
+            break
+        columns = pl.read_parquet_schema(file)
+        file_keys = [key for key in missing_keys if key in columns]
+        if not file_keys:
+            continue
+        df = pl.read_parquet(file, columns=["ts", *file_keys])
+        for key, ts in get_key_timestamps(df).items():
+            watermarks[key] = max(ts, watermarks.get(key, ts))
+
+    logging.info(
+        f"Rebuilt watermarks of device {device_name} from {len(files)} file(s)."
+    )
+    return watermarks
+
+
+def get_device_watermarks(device_name: str,
+                          keys: List[str]) -> Dict[str, int]:
+    """
+    Return the watermarks of a device from the index. If the device is not
+    in the index, its watermarks are rebuilt from the local Parquet files and
+    added to the index.
+    """
+    with watermarks_lock:
+        watermarks = get_watermark_index()
+        if device_name in watermarks:
+            return dict(watermarks[device_name])
+
+        device_watermarks = rebuild_device_watermarks(device_name, keys)
+        if device_watermarks:
+            watermarks[device_name] = dict(device_watermarks)
+            dump_watermarks(watermarks)
+        return device_watermarks
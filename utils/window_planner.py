@@ -0,0 +1,121 @@
+import math
+import requests
+from typing import Dict, List, NamedTuple, Tuple
+
+from .thingsboard_api import get_telemetry_data
+
+
+class Bucket(NamedTuple):
+    """Measurement counts per key within the half-open interval [start, end)."""
+    start: int
+    end: int
+    counts: Dict[str, int]
+
+
+def probe_density(jwt_token: str, device_id: str, keys: List[str],
+                  startTS: int, endTS: int, buckets: int,
+                  session: requests.Session) -> List[Bucket]:
+    """
+    Count the measurements of every key in (at most) the given number of
+    equally sized buckets between startTS and endTS with a single agg=COUNT
+    request.
+    """
+    interval = max(1, math.ceil((endTS - startTS) / buckets))
+    n_buckets = max(1, math.ceil((endTS - startTS) / interval))
+
+    telemetry_data = get_telemetry_data(jwt_token=jwt_token,
+                                        device_id=device_id,
+                                        keys=keys,
+                                        startTS=startTS,
+                                        endTS=endTS,
+                                        agg="COUNT",
+                                        interval=interval,
+                                        limit=n_buckets + 1,
+                                        orderBy="ASC",
+                                        session=session)
+
+    result = [
+        Bucket(startTS + i * interval,
+               min(endTS, startTS + (i + 1) * interval),
+               {key: 0
+                for key in keys}) for i in range(n_buckets)
+    ]
+    for key, points in telemetry_data.items():
+        if key not in keys:
+            continue
+        for point in points:
+            # The timestamp of an aggregated point lies within its interval
+            i = min(n_buckets - 1,
+                    max(0, (int(point["ts"]) - startTS) // interval))
+            result[i].counts[key] += int(float(point["value"]))
+
+    return result
+
+
+def get_bucket_rows(bucket: Bucket) -> int:
+    """Return the count of the densest key, which drives the paging."""
+    return max(bucket.counts.values(), default=0)
+
+
+def refine_density(jwt_token: str, device_id: str, keys: List[str],
+                   buckets: List[Bucket], probe_buckets: int, window_rows: int,
+                   max_depth: int, session: requests.Session) -> List[Bucket]:
+    """
+    Probe buckets that hold more than window_rows rows again with a finer
+    resolution (up to max_depth times), so that dense bursts in a long, mostly
+    empty range can still be split into several windows.
+    """
+    if max_depth <= 0:
+        return buckets
+
+    refined = []
+    for bucket in buckets:
+        if get_bucket_rows(bucket) > window_rows and bucket.end - bucket.start > 1:
+            finer = probe_density(jwt_token, device_id, keys, bucket.start,
+                                  bucket.end, probe_buckets, session)
+            refined.extend(
+                refine_density(jwt_token, device_id, keys, finer,
+                               probe_buckets, window_rows, max_depth - 1,
+                               session))
+        else:
+            refined.append(bucket)
+    return refined
+
+
+def plan_windows(buckets: List[Bucket], endTS: int,
+                 window_rows: int) -> List[Tuple[int, int]]:
+    """
+    Split the probed range into consecutive half-open windows [start, end)
+    at bucket boundaries, so that the densest key of every window has about
+    window_rows measurements. The last window ends at endTS.
+    """
+    windows: List[Tuple[int, int]] = []
+    window_start = buckets[0].start
+    rows = 0
+
+    for bucket in buckets:
+        rows += get_bucket_rows(bucket)
+        if rows >= window_rows and bucket.end < endTS:
+            windows.append((window_start, bucket.end))
+            window_start = bucket.end
+            rows = 0
+
+    windows.append((window_start, endTS))
+    return windows
+
+
+def estimate_window(buckets: List[Bucket], window: Tuple[int, int],
+                    limit: int) -> Tuple[int, int]:
+    """
+    Estimate the number of requests and rows needed to download a window of
+    a key batch. Every page returns up to limit rows per key, so the densest
+    key determines the number of requests.
+    """
+    window_start, window_end = window
+    key_rows: Dict[str, int] = {}
+    for bucket in buckets:
+        if window_start <= bucket.start < window_end:
+            for key, count in bucket.counts.items():
+                key_rows[key] = key_rows.get(key, 0) + count
+    return max(key_rows.values(),
+               default=0) // limit + 1, sum(key_rows.values())